@@ -0,0 +1,99 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+
+_routing = ContextVar('db_routing', default=None)
+
+
+class Routing:
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+@contextmanager
+def replica_routing():
+    """Track the writes made in the block and let it opt in to replica reads."""
+    token = _routing.set(Routing())
+    try:
+        yield _routing.get()
+    finally:
+        _routing.reset(token)
+
+
+class ReplicaRouter:
+    """Sends reads to a replica when the surrounding ``replica_routing`` block chose one.
+
+    Reads inside a transaction or after a write in the same block, and every
+    write, go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        routing = _routing.get()
+        if routing is None or routing.replica is None or routing.wrote:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary.
+        return False if db in replicas() else None
+
+
+def _pin_key(user_id):
+    return f'db:primary:{user_id}'
+
+
+def sticky_cache():
+    return caches[getattr(settings, 'DATABASE_REPLICA_CACHE_ALIAS', 'default')]
+
+
+def pin_to_primary(user_id):
+    seconds = getattr(settings, 'DATABASE_REPLICA_STICKY_SECONDS', 10)
+    if seconds:
+        sticky_cache().set(_pin_key(user_id), True, seconds)
+
+
+def pinned_to_primary(user_id):
+    return sticky_cache().get(_pin_key(user_id)) is not None
+
+
+class ReplicaReadsMixin:
+    """Serves a viewset's safe requests from a replica.
+
+    A user who wrote through the viewset reads from the primary for the next
+    ``DATABASE_REPLICA_STICKY_SECONDS`` so their own changes never look lost
+    to replication lag.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_routing() as routing:
+            response = super().dispatch(request, *args, **kwargs)
+        if routing.wrote and self.request.user.is_authenticated:
+            pin_to_primary(self.request.user.pk)
+        return response
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        routing = _routing.get()
+        if routing is None or request.method not in SAFE_METHODS or not replicas():
+            return
+        if not pinned_to_primary(request.user.pk):
+            routing.replica = random.choice(replicas())
@@ -0,0 +1,229 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+
+
+logger = logging.getLogger(__name__)
+
+_profile = ContextVar('profile', default=None)
+
+
+class Profile:
+    """SQL and quote provider work done while the profile is active."""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.provider_calls = 0
+        self.provider_time = 0.0
+        self.started = time.perf_counter()
+        self.latency = None
+        self._lock = threading.Lock()
+
+    def add(self, sql_count=0, sql_time=0.0, provider_calls=0, provider_time=0.0):
+        profile = self
+        while profile is not None:
+            with profile._lock:
+                profile.sql_count += sql_count
+                profile.sql_time += sql_time
+                profile.provider_calls += provider_calls
+                profile.provider_time += provider_time
+            profile = profile.parent
+
+    def as_dict(self):
+        return {
+            'sql_count': self.sql_count,
+            'sql_ms': round(self.sql_time * 1000, 2),
+            'provider_calls': self.provider_calls,
+            'provider_ms': round(self.provider_time * 1000, 2),
+            'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+        }
+
+
+def _record_query(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add(sql_count=1, sql_time=time.perf_counter() - started)
+
+
+def _wrap_connection(connection, **kwargs):
+    # First in the list, which makes it the outermost wrapper: execute_wrapper
+    # blocks append and pop at the end, so they still remove their own.
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+_installed = False
+
+
+def install():
+    """Count the queries of every connection, including ones opened later on other threads."""
+    global _installed
+    if not _installed:
+        connection_created.connect(_wrap_connection, dispatch_uid='core.profiling')
+        _installed = True
+    for connection in connections.all(initialized_only=True):
+        _wrap_connection(connection)
+
+
+@contextmanager
+def profile():
+    """Profile the block; nested profiles also count towards the enclosing ones."""
+    install()
+    current = Profile(parent=_profile.get())
+    token = _profile.set(current)
+    try:
+        yield current
+    finally:
+        _profile.reset(token)
+        current.latency = time.perf_counter() - current.started
+
+
+def record_provider_call(elapsed):
+    profile = _profile.get()
+    if profile is not None:
+        profile.add(provider_calls=1, provider_time=elapsed)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class Metrics:
+    """Per-process request histograms by view and method, in the Prometheus text format."""
+
+    LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+    SERIES = [
+        ('http_request_duration_seconds', 'Request latency.', 'latency', LATENCY_BUCKETS),
+        ('http_request_sql_queries', 'SQL queries per request.', 'sql_count', QUERY_BUCKETS),
+        ('http_request_sql_duration_seconds', 'Time spent in SQL per request.', 'sql_time', LATENCY_BUCKETS),
+        ('http_request_provider_calls', 'Quote provider calls per request.', 'provider_calls', QUERY_BUCKETS),
+        ('http_request_provider_duration_seconds', 'Time spent in quote providers per request.', 'provider_time', LATENCY_BUCKETS),
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._histograms = {
+                name: defaultdict(lambda buckets=buckets: Histogram(buckets))
+                for name, _, _, buckets in self.SERIES
+            }
+
+    def observe(self, labels, profile):
+        with self._lock:
+            for name, _, attribute, _ in self.SERIES:
+                self._histograms[name][labels].observe(getattr(profile, attribute))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, help_text, _, buckets in self.SERIES:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (view, method, status), histogram in sorted(self._histograms[name].items()):
+                    labels = f'view="{view}",method="{method}",status="{status}"'
+                    cumulative = 0
+                    for bound, count in zip([*buckets, '+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class ProfilingMiddleware:
+    """Profiles every request when ``PROFILING_ENABLED`` is set.
+
+    The numbers go out as a ``Server-Timing`` header plus ``X-SQL-Queries``
+    and ``X-Provider-Calls`` (``PROFILING_HEADERS``), as one JSON log line
+    per request (``PROFILING_LOG``) and into the histograms served by
+    ``metrics_view``. When disabled the middleware removes itself at startup.
+    """
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        install()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with profile() as current:
+            response = self.get_response(request)
+        return self.report(request, response, current)
+
+    async def __acall__(self, request):
+        with profile() as current:
+            response = await self.get_response(request)
+        return self.report(request, response, current)
+
+    def report(self, request, response, current):
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        metrics.observe((view, request.method, response.status_code), current)
+        if getattr(settings, 'PROFILING_HEADERS', True):
+            response['Server-Timing'] = (
+                f'sql;dur={current.sql_time * 1000:.1f};desc="{current.sql_count} queries", '
+                f'provider;dur={current.provider_time * 1000:.1f};desc="{current.provider_calls} calls", '
+                f'total;dur={current.latency * 1000:.1f}'
+            )
+            response['X-SQL-Queries'] = str(current.sql_count)
+            response['X-Provider-Calls'] = str(current.provider_calls)
+        if getattr(settings, 'PROFILING_LOG', True):
+            logger.info(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                **current.as_dict(),
+            }))
+        return response
+
+
+def metrics_view(request):
+    if not getattr(settings, 'PROFILING_ENABLED', False):
+        return HttpResponseNotFound()
+    token = getattr(settings, 'PROFILING_METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
@@ -69,6 +70,7 @@ SIMPLE_JWT = {
 
 
 MIDDLEWARE = [
+    'core.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -103,17 +105,110 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-   'default': {
+def postgres(host, port):
+    conn_max_age = os.getenv('DB_CONN_MAX_AGE', '60')
+    return {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': os.getenv('POSTGRES_DB', 'mydatabase'),
         'USER': os.getenv('POSTGRES_USER', 'myuser'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'mypassword'),
-        'HOST': 'db',
-        'PORT': '5432',
+        'HOST': host,
+        'PORT': port,
+        # Seconds a connection is reused across requests: 0 closes it after
+        # every request, an empty value keeps it open indefinitely.
+        'CONN_MAX_AGE': int(conn_max_age) if conn_max_age else None,
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
+        # Required behind a transaction pooling PgBouncer, where a cursor
+        # cannot outlive its transaction.
+        'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_PGBOUNCER', 'False') == 'True',
     }
+
+
+DATABASES = {
+    'default': postgres(os.getenv('POSTGRES_HOST', 'db'), os.getenv('POSTGRES_PORT', '5432')),
 }
 
+# Read-only replicas as comma separated host[:port] entries. Safe requests to
+# the portfolio and investment viewsets read from them, except for users who
+# wrote in the last DATABASE_REPLICA_STICKY_SECONDS (tracked in the
+# DATABASE_REPLICA_CACHE_ALIAS cache, which must be shared between processes).
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    host, _, port = replica.strip().partition(':')
+    DATABASES[f'replica{number}'] = {**postgres(host, port or '5432'), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica{number}')
+
+# The test suite always has a replica alias mirroring the test database, so
+# routing tests can opt in to it.
+if 'test' in sys.argv[1:2] and not DATABASE_REPLICAS:
+    DATABASES['replica'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['core.db_routers.ReplicaRouter']
+DATABASE_REPLICA_STICKY_SECONDS = int(os.getenv('DB_REPLICA_STICKY_SECONDS', '10'))
+DATABASE_REPLICA_CACHE_ALIAS = os.getenv('DB_REPLICA_CACHE_ALIAS', 'default')
+
+
+# Profiling
+# Per-request SQL and quote provider counts and timings, sent as response
+# headers and JSON log lines on the core.profiling logger, and aggregated per
+# view at /metrics/ (per process; protect it with PROFILING_METRICS_TOKEN).
+
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_HEADERS = os.getenv('PROFILING_HEADERS', 'True') == 'True'
+PROFILING_LOG = os.getenv('PROFILING_LOG', 'True') == 'True'
+PROFILING_METRICS_TOKEN = os.getenv('PROFILING_METRICS_TOKEN') or None
+
+
+# Market data
+# Dotted path to a portfolio_management.quotes.QuoteProvider subclass, or a
+# comma separated list of them to fail over in that order.
+
+QUOTE_PROVIDER = os.getenv('QUOTE_PROVIDER', 'portfolio_management.quotes.YFinanceProvider')
+# Each provider is called at most QUOTE_RATE_LIMIT times per second (0 for no
+# limit) in bursts of QUOTE_RATE_BURST, is skipped for QUOTE_BREAKER_RESET
+# seconds after QUOTE_BREAKER_THRESHOLD consecutive failures and is not asked
+# again for QUOTE_NEGATIVE_TTL seconds about symbols it had no quote for.
+QUOTE_RATE_LIMIT = float(os.getenv('QUOTE_RATE_LIMIT', '5'))
+QUOTE_RATE_BURST = int(os.getenv('QUOTE_RATE_BURST', '10'))
+QUOTE_BREAKER_THRESHOLD = int(os.getenv('QUOTE_BREAKER_THRESHOLD', '5'))
+QUOTE_BREAKER_RESET = float(os.getenv('QUOTE_BREAKER_RESET', '30'))
+QUOTE_NEGATIVE_TTL = int(os.getenv('QUOTE_NEGATIVE_TTL', '900'))
+PRICE_FETCH_BATCH_SIZE = int(os.getenv('PRICE_FETCH_BATCH_SIZE', '100'))
+PRICE_FETCH_WORKERS = int(os.getenv('PRICE_FETCH_WORKERS', '4'))
+PRICE_FETCH_TIMEOUT = float(os.getenv('PRICE_FETCH_TIMEOUT', '10'))
+PRICE_FETCH_RETRIES = int(os.getenv('PRICE_FETCH_RETRIES', '2'))
+
+# Current prices are cached per process for PRICE_CACHE_TTL seconds and, when
+# PRICE_CACHE_ALIAS names one of CACHES, shared between processes.
+PRICE_CACHE_TTL = int(os.getenv('PRICE_CACHE_TTL', '60'))
+PRICE_CACHE_SIZE = int(os.getenv('PRICE_CACHE_SIZE', '10000'))
+PRICE_CACHE_ALIAS = os.getenv('PRICE_CACHE_ALIAS') or None
+
+# Holdings saved without a known price are revalued by a background worker
+# pool in this process; `manage.py backfill_prices` sweeps anything left over.
+PRICE_BACKFILL_ENABLED = os.getenv('PRICE_BACKFILL_ENABLED', 'True') == 'True'
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', '2'))
+# A price refresh job still queued or running after this many seconds is
+# considered abandoned and no longer blocks new ones.
+PRICE_REFRESH_STALE_AFTER = int(os.getenv('PRICE_REFRESH_STALE_AFTER', '3600'))
+
+# Portfolios are valued in this currency, converting holdings with the rates
+# stored by update_fx_rates; leave unset to sum amounts in their own currencies.
+PORTFOLIO_BASE_CURRENCY = os.getenv('PORTFOLIO_BASE_CURRENCY') or None
+FX_RATE_CACHE_TTL = int(os.getenv('FX_RATE_CACHE_TTL', '300'))
+
+# Price changes are pushed to clients of the price_stream endpoint (served over
+# ASGI) through this channel layer; the in-memory one only reaches listeners
+# in the same process.
+PRICE_STREAM_LAYER = os.getenv('PRICE_STREAM_LAYER', 'portfolio_management.streaming.InMemoryChannelLayer')
+PRICE_STREAM_KEEPALIVE = int(os.getenv('PRICE_STREAM_KEEPALIVE', '15'))
+
+# The dashboard endpoint caches each user's payload in this cache until their
+# portfolios are recomputed; use a shared backend when running several processes.
+DASHBOARD_CACHE_ALIAS = os.getenv('DASHBOARD_CACHE_ALIAS', 'default')
+DASHBOARD_CACHE_TTL = int(os.getenv('DASHBOARD_CACHE_TTL', '300'))
+DASHBOARD_MONTHS = int(os.getenv('DASHBOARD_MONTHS', '12'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
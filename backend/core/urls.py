@@ -16,9 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from core.profiling import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('users.urls')),
     path('api/portfolio/', include('portfolio_management.urls')),
+    path('metrics/', metrics_view, name='metrics'),
 ]
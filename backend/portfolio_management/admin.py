@@ -1,8 +1,23 @@
 from django.contrib import admin
-from .models import Portfolio, Investment, CurrentPrice, MonthlyPerformance, Holding
+from .models import Portfolio, Investment, CurrentPrice, MonthlyPerformance, Holding, PriceHistory, Position, PriceRefreshJob, FxRate
+from .recompute import mark_portfolio_dirty
 
 admin.site.register(Portfolio)
 admin.site.register(Investment)
-admin.site.register(Holding)
 admin.site.register(CurrentPrice)
 admin.site.register(MonthlyPerformance)
+admin.site.register(PriceHistory)
+admin.site.register(Position)
+admin.site.register(PriceRefreshJob)
+admin.site.register(FxRate)
+
+
+@admin.register(Holding)
+class HoldingAdmin(admin.ModelAdmin):
+    def delete_queryset(self, request, queryset):
+        # Bulk deletes skip Holding.delete, so recount the positions here.
+        keys = list(queryset.values_list('portfolio_id', 'symbol').distinct())
+        with Position.recounting(keys):
+            super().delete_queryset(request, queryset)
+        for portfolio_id in {portfolio_id for portfolio_id, _ in keys}:
+            mark_portfolio_dirty(portfolio_id)
@@ -0,0 +1,285 @@
+import logging
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from .backfill import backfill_price_history, history_backfill, last_closed_day
+from .fx import base_currency
+from .models import FxRate, Investment, MonthlyPerformance, Portfolio, PriceHistory
+
+
+logger = logging.getLogger(__name__)
+
+TRADING_DAYS = 252
+BACKFILL_BATCH_SIZE = 500
+
+
+def transactions_frame(investments):
+    columns = ['portfolio', 'date', 'symbol', 'transaction_type', 'quantity', 'price', 'currency']
+    rows = investments.order_by('date', 'id').values_list('portfolio_id', *columns[1:])
+    transactions = pd.DataFrame.from_records(list(rows), columns=columns)
+    transactions['date'] = pd.to_datetime(transactions['date'])
+    transactions['price'] = transactions['price'].astype(float)
+    transactions['shares'] = np.where(transactions['transaction_type'] == 'Buy', 1, -1) * transactions['quantity']
+    # Money put into (positive) or taken out of (negative) the portfolio.
+    transactions['flow'] = transactions['shares'] * transactions['price']
+    return transactions
+
+
+def to_base_currency(transactions, closes):
+    """Convert trade prices and closes with the exchange rate of their day.
+
+    Each symbol's closes are in the currency it was last traded in. Days
+    before the first stored rate use the earliest one.
+    """
+    base = base_currency()
+    foreign = sorted(set(transactions['currency']) - {base}) if base else []
+    if not foreign:
+        return transactions, closes
+    days = closes.index.union(pd.DatetimeIndex(transactions['date'].unique()))
+    rates = FxRate.history(foreign, base, days.min().date(), days.max().date())
+    rates = rates.reindex(rates.index.union(days)).ffill().bfill().reindex(days)
+    unknown = rates.columns[rates.isna().all()]
+    if len(unknown):
+        logger.warning("No %s exchange rates stored for %s; using their own amounts", base, ', '.join(unknown))
+    rates = rates.fillna(1.0)
+    rates[base] = 1.0
+
+    trade_rates = rates.stack().reindex(pd.MultiIndex.from_arrays([transactions['date'], transactions['currency']]))
+    price = transactions['price'] * trade_rates.to_numpy()
+    transactions = transactions.assign(price=price, flow=transactions['shares'] * price)
+    currencies = transactions.groupby('symbol')['currency'].last().reindex(closes.columns)
+    return transactions, closes * rates.reindex(closes.index)[currencies].to_numpy()
+
+
+def close_prices(transactions, end, background=False):
+    """Closes of every traded symbol from its first trade up to ``end``.
+
+    With ``background`` missing history is downloaded on the worker pool and
+    only what is stored already is returned; storing it bumps the portfolio
+    versions, so conditional requests see the new closes.
+    """
+    starts = {symbol: day.date() for symbol, day in transactions.groupby('symbol')['date'].min().items()}
+    # Only the ranges missing from the local store go to the provider.
+    if not background:
+        backfill_price_history(starts, end.date())
+    elif history_backfill.missing_ranges(starts, min(end.date(), last_closed_day())):
+        history_backfill.schedule(starts, end.date())
+    return PriceHistory.closes(starts, min(starts.values()), end.date())
+
+
+def valuation(transactions, closes, end):
+    """Daily per-symbol market values plus total value and external flows.
+
+    Days before a symbol's first known close, or symbols with no history at
+    all, are valued at the last traded price.
+    """
+    days = pd.bdate_range(transactions['date'].min(), end).union(pd.DatetimeIndex(transactions['date'].unique()))
+    shares = transactions.pivot_table(index='date', columns='symbol', values='shares', aggfunc='sum')
+    shares = shares.reindex(days).fillna(0).cumsum()
+    trade_prices = transactions.pivot_table(index='date', columns='symbol', values='price', aggfunc='last')
+    prices = closes.reindex(index=days, columns=shares.columns).ffill()
+    prices = prices.fillna(trade_prices.reindex(days).ffill())
+
+    values = (shares * prices).astype(float)
+    frame = values.copy()
+    frame['value'] = values.sum(axis=1)
+    flows = transactions['flow']
+    frame['flow'] = flows.groupby(transactions['date']).sum().reindex(days, fill_value=0.0)
+    frame['inflow'] = flows.clip(lower=0).groupby(transactions['date']).sum().reindex(days, fill_value=0.0)
+    return frame
+
+
+def daily_returns(frame):
+    # Purchases are treated as made at the start of the day and sales at the
+    # end, so neither a buy below the close nor a full exit distorts the day.
+    previous = frame['value'].shift(1).fillna(0.0)
+    inflow = frame['inflow']
+    outflow = inflow - frame['flow']
+    base = previous + inflow
+    returns = (frame['value'] + outflow - base) / base
+    return returns.where(base > 0, 0.0)
+
+
+def xirr(amounts, years, iterations=200):
+    # Bisect on the continuously compounded rate, where the NPV of a usual
+    # investment history is monotonic.
+    if not (amounts > 0).any() or not (amounts < 0).any():
+        return None
+
+    def npv(rate):
+        return np.sum(amounts * np.exp(-rate * years))
+
+    low, high = -10.0, 10.0
+    if np.sign(npv(low)) == np.sign(npv(high)):
+        return None
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        if np.sign(npv(middle)) == np.sign(npv(low)):
+            low = middle
+        else:
+            high = middle
+    return np.expm1((low + high) / 2)
+
+
+def metrics(frame, transactions):
+    returns = daily_returns(frame)
+    growth = (1 + returns).cumprod()
+    periods = len(returns) - 1
+
+    twr = growth.iloc[-1] - 1
+    drawdown = growth / growth.cummax() - 1
+
+    days = frame.index
+    amounts = -frame['flow'].to_numpy(dtype=float)
+    amounts[-1] += frame['value'].iloc[-1]
+    years = (days - days[0]).days.to_numpy() / 365.0
+    nonzero = amounts != 0
+    mwr = xirr(amounts[nonzero], years[nonzero])
+
+    symbols = [column for column in frame.columns if column not in ('value', 'flow', 'inflow')]
+    net_flows = transactions.groupby('symbol')['flow'].sum().reindex(symbols, fill_value=0)
+    final_values = frame[symbols].iloc[-1]
+    pnl = final_values - net_flows
+    invested = transactions.loc[transactions['flow'] > 0, 'flow'].sum()
+    total_value = frame['value'].iloc[-1]
+
+    return {
+        'start': days[0].date(),
+        'end': days[-1].date(),
+        'value': total_value,
+        'time_weighted_return': twr,
+        'time_weighted_return_annualized': (1 + twr) ** (TRADING_DAYS / periods) - 1 if periods else None,
+        'money_weighted_return': mwr,
+        'volatility': returns.iloc[1:].std(ddof=1) * np.sqrt(TRADING_DAYS) if periods > 1 else None,
+        'max_drawdown': drawdown.min(),
+        'contributions': [
+            {
+                'symbol': symbol,
+                'value': final_values[symbol],
+                'pnl': pnl[symbol],
+                'weight': final_values[symbol] / total_value if total_value else None,
+                'contribution': pnl[symbol] / invested if invested else None,
+            }
+            for symbol in symbols
+        ],
+    }
+
+
+def _clean(value):
+    if isinstance(value, dict):
+        return {key: _clean(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_clean(item) for item in value]
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else round(float(value), 6)
+    return value
+
+
+def portfolio_analytics(portfolio_id, end=None, closes=None, series=False, background=False):
+    transactions = transactions_frame(Investment.objects.filter(portfolio_id=portfolio_id))
+    if transactions.empty:
+        return None
+    end = pd.Timestamp(end or date.today())
+    if closes is None:
+        closes = close_prices(transactions, end, background=background)
+    transactions, closes = to_base_currency(transactions, closes)
+    frame = valuation(transactions, closes, end)
+    result = metrics(frame, transactions)
+    if series:
+        returns = daily_returns(frame)
+        result['series'] = [
+            {'date': day.date(), 'value': value, 'flow': flow, 'return': daily_return}
+            for day, value, flow, daily_return in zip(frame.index, frame['value'], frame['flow'], returns)
+        ]
+    return _clean(result)
+
+
+def remaining_cost(transactions):
+    """Cost basis of the lots still held after each transaction.
+
+    Lots are sold first in, first out, so the cost of everything sold so far
+    is the cumulative purchase cost interpolated at the cumulative number of
+    shares sold.
+    """
+    position = transactions.groupby(['portfolio', 'symbol']).ngroup()
+    buys = transactions['shares'].clip(lower=0)
+    bought = buys.groupby(position).cumsum().to_numpy(dtype=float)
+    spent = (buys * transactions['price']).groupby(position).cumsum()
+    sold = (-transactions['shares'].clip(upper=0)).groupby(position).cumsum().to_numpy(dtype=float)
+
+    # Interpolate every position in one call by shifting each onto its own
+    # stretch of the axis, starting from a zero cost origin.
+    width = bought.max() + 1
+    offset = position.to_numpy() * width
+    origins = np.unique(position) * width
+    xp = np.concatenate([origins, bought + offset])
+    fp = np.concatenate([np.zeros(len(origins)), spent.to_numpy(dtype=float)])
+    order = np.lexsort((fp, xp))
+    consumed = np.interp(sold + offset, xp[order], fp[order])
+    return spent - consumed
+
+
+def monthly_history(transactions, closes, end):
+    """Month-end value, capital gain and performance of every portfolio.
+
+    Positions are valued at the last close of each month (the last traded
+    price for symbols without history) and the month of ``end`` at ``end``.
+    Returns a long DataFrame with one row per portfolio and month from the
+    portfolio's first trade onwards.
+    """
+    transactions = transactions.assign(
+        cost=remaining_cost(transactions),
+        period=transactions['date'].dt.to_period('M'),
+    )
+    periods = pd.period_range(transactions['period'].min(), pd.Timestamp(end).to_period('M'), freq='M')
+    positions = ['portfolio', 'symbol']
+
+    shares = transactions.pivot_table(index='period', columns=positions, values='shares', aggfunc='sum')
+    shares = shares.reindex(periods).fillna(0).cumsum()
+    cost = transactions.pivot_table(index='period', columns=positions, values='cost', aggfunc='last')
+    cost = cost.reindex(periods).ffill().fillna(0)
+
+    symbols = shares.columns.get_level_values('symbol')
+    month_closes = closes.loc[:pd.Timestamp(end)].resample('ME').last()
+    month_closes.index = month_closes.index.to_period('M')
+    trade_prices = transactions.pivot_table(index='period', columns='symbol', values='price', aggfunc='last')
+    prices = month_closes.reindex(index=periods, columns=trade_prices.columns).ffill()
+    prices = prices.fillna(trade_prices.reindex(periods).ffill())
+
+    values = shares * prices[symbols].to_numpy()
+    value = values.T.groupby(level='portfolio').sum().T
+    cost = cost.T.groupby(level='portfolio').sum().T
+    # Like Portfolio.set_performance, months without a cost basis stay at zero.
+    held = cost > 0
+    history = pd.DataFrame({
+        'value': value.where(held, 0.0).stack(),
+        'capital_gain': (value - cost).where(held, 0.0).stack(),
+        'performance': ((value - cost) / cost * 100).where(held, 0.0).stack(),
+    }).reset_index(names=['period', 'portfolio'])
+    first = history['portfolio'].map(transactions.groupby('portfolio')['period'].min())
+    history = history[history['period'] >= first]
+    return history.assign(year=history['period'].dt.year, month=history['period'].dt.month).drop(columns='period')
+
+
+def backfill_monthly_performance(portfolio_ids=None, end=None, batch_size=BACKFILL_BATCH_SIZE):
+    """Rebuild MonthlyPerformance from the investment history; returns the rows written.
+
+    Portfolios are replayed ``batch_size`` at a time and each batch is stored
+    before the next one is built, so memory follows the batch size rather
+    than the number of portfolios.
+    """
+    investments = Investment.objects.all()
+    if portfolio_ids is not None:
+        investments = investments.filter(portfolio_id__in=portfolio_ids)
+    traded = list(investments.order_by('portfolio_id').values_list('portfolio_id', flat=True).distinct())
+    end = pd.Timestamp(end or date.today())
+    rows = 0
+    for start in range(0, len(traded), batch_size):
+        batch = traded[start:start + batch_size]
+        transactions = transactions_frame(Investment.objects.filter(portfolio_id__in=batch))
+        transactions, closes = to_base_currency(transactions, close_prices(transactions, end))
+        rows += MonthlyPerformance.store(monthly_history(transactions, closes, end))
+        Portfolio.touch(batch)
+    return rows
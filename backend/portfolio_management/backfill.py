@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import transaction
+
+from .price_cache import price_cache
+from .quotes import PriceFetcher, get_quote_provider
+from .streaming import PriceUpdates
+from .tasks import run_in_background
+
+
+logger = logging.getLogger(__name__)
+
+
+def store_prices(prices):
+    """Save fetched prices, revalue the holdings and refresh the cache; returns the revalued portfolio ids."""
+    from .models import CurrentPrice, Holding
+
+    updates = PriceUpdates.capture(prices)
+    with transaction.atomic():
+        CurrentPrice.store(prices)
+        portfolio_ids = Holding.revalue(prices)
+        if updates is not None:
+            transaction.on_commit(updates.publish)
+    price_cache.set_many(prices)
+    return portfolio_ids
+
+
+def refresh_prices(fetcher=None, progress=None):
+    """Fetch the price of every traded symbol; returns the fetch result and revalued portfolio ids."""
+    from .models import Investment
+
+    symbols = Investment.objects.order_by('symbol').values_list('symbol', flat=True).distinct()
+    result = (fetcher or PriceFetcher()).fetch(symbols, progress=progress)
+    return result, store_prices(result.prices)
+
+
+def backfill_prices(symbols=None, fetcher=None, progress=None):
+    """Fetch prices for holdings still waiting for one and revalue them."""
+    from .models import Holding
+
+    pending = Holding.objects.filter(current_price__isnull=True)
+    if symbols is not None:
+        pending = pending.filter(symbol__in=list(symbols))
+    symbols = pending.order_by('symbol').values_list('symbol', flat=True).distinct()
+
+    result = (fetcher or PriceFetcher()).fetch(symbols, progress=progress)
+    store_prices(result.prices)
+    return result
+
+
+@dataclass
+class HistoryBackfillResult:
+    requests: int = 0
+    rows: int = 0
+    failed: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+
+def last_closed_day():
+    """The most recent day whose closes are final.
+
+    Today's bar keeps moving until the market closes, and a stored day is
+    never downloaded again, so history stops the day before.
+    """
+    return date.today() - timedelta(days=1)
+
+
+def backfill_price_history(starts, end, provider=None, batch_size=None):
+    """Download the daily bars PriceHistory is missing up to ``end``.
+
+    ``starts`` maps each symbol to the first date it is needed from; symbols
+    sharing a missing range are requested together, and ranges the provider
+    recently had no bars for are skipped. ``end`` is capped at
+    ``last_closed_day()``. The portfolios that traded a symbol with new bars
+    get their version bumped, since their analytics change.
+    """
+    from .models import Investment, Portfolio, PriceHistory
+
+    started = time.monotonic()
+    end = min(end, last_closed_day())
+    provider = provider or get_quote_provider()
+    batch_size = min(batch_size or provider.max_batch_size, provider.max_batch_size)
+    result = HistoryBackfillResult()
+    stored = set()
+    for (start, range_end), symbols in history_backfill.missing_ranges(starts, end).items():
+        for i in range(0, len(symbols), batch_size):
+            batch = symbols[i:i + batch_size]
+            result.requests += 1
+            try:
+                bars = provider.history(batch, start, range_end)
+            except Exception:
+                logger.exception("Price history download failed for %s", ', '.join(batch))
+                result.failed.extend(batch)
+                continue
+            result.rows += PriceHistory.store(bars)
+            found = set(bars['symbol'].dropna().unique())
+            history_backfill.remember_empty(set(batch) - found, start, range_end)
+            stored.update(found)
+    if stored:
+        Portfolio.touch(list(Investment.objects.filter(symbol__in=stored).values_list('portfolio_id', flat=True).distinct()))
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+class HistoryBackfillTracker:
+    """Keeps history backfills started from requests from piling up.
+
+    At most one background backfill runs per set of symbols, and ranges the
+    provider had no bars for (holidays, delisted or unknown symbols) are not
+    asked for again for ``PRICE_HISTORY_EMPTY_TTL`` seconds.
+    """
+
+    def __init__(self):
+        self._running = set()
+        self._empty = {}
+        self._lock = threading.Lock()
+
+    @property
+    def empty_ttl(self):
+        return getattr(settings, 'PRICE_HISTORY_EMPTY_TTL', 6 * 3600)
+
+    def missing_ranges(self, starts, end):
+        """PriceHistory.missing_ranges without the ranges known to be empty."""
+        from .models import PriceHistory
+
+        now = time.monotonic()
+        with self._lock:
+            self._empty = {key: expires for key, expires in self._empty.items() if expires > now}
+            ranges = {
+                (start, range_end): [symbol for symbol in symbols if (symbol, start, range_end) not in self._empty]
+                for (start, range_end), symbols in PriceHistory.missing_ranges(starts, end).items()
+            }
+        return {key: symbols for key, symbols in ranges.items() if symbols}
+
+    def remember_empty(self, symbols, start, end):
+        expires = time.monotonic() + self.empty_ttl
+        with self._lock:
+            self._empty.update({(symbol, start, end): expires for symbol in symbols})
+
+    def schedule(self, starts, end):
+        """Backfill on the worker pool unless one for the same symbols is running; returns whether one was started."""
+        key = frozenset(starts)
+        with self._lock:
+            if key in self._running:
+                return False
+            self._running.add(key)
+        run_in_background(self.run, key, starts, end)
+        return True
+
+    def run(self, key, starts, end):
+        try:
+            return backfill_price_history(starts, end)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._running.clear()
+            self._empty.clear()
+
+
+history_backfill = HistoryBackfillTracker()
+
+
+class PriceBackfillQueue:
+    """Collects symbols needing a price and drains them on a background worker.
+
+    Symbols scheduled while a drain is running are picked up by that drain,
+    so bursts of new holdings turn into a few batched fetches.
+    """
+
+    def __init__(self):
+        self._symbols = set()
+        self._lock = threading.Lock()
+        self._draining = False
+
+    def schedule(self, symbols):
+        with self._lock:
+            self._symbols.update(symbols)
+            if self._draining or not self._symbols:
+                return
+            self._draining = True
+        run_in_background(self.drain)
+
+    def drain(self):
+        while True:
+            with self._lock:
+                symbols, self._symbols = self._symbols, set()
+                if not symbols:
+                    self._draining = False
+                    return
+            try:
+                result = backfill_prices(symbols)
+                if result.failed:
+                    logger.warning("No price found for %s", ', '.join(result.failed))
+            except Exception:
+                logger.exception("Price backfill failed for %s", ', '.join(sorted(symbols)))
+
+
+price_backfill = PriceBackfillQueue()
+
+
+def schedule_price_backfill(symbols):
+    if not getattr(settings, 'PRICE_BACKFILL_ENABLED', True):
+        return
+    transaction.on_commit(lambda: price_backfill.schedule(symbols))
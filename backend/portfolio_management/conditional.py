@@ -0,0 +1,41 @@
+import hashlib
+import uuid
+
+from django.db.models import Count, Max, Sum
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from .models import Portfolio
+
+
+def portfolio_state(request, pk=None):
+    """Count, summed version and last change of the portfolios a request reads.
+
+    Computed once per request from the portfolio rows alone, so conditional
+    requests never touch holdings or investments.
+    """
+    if not hasattr(request, '_portfolio_state'):
+        portfolios = Portfolio.objects.filter(user=request.user)
+        if pk is not None:
+            try:
+                portfolios = portfolios.filter(pk=uuid.UUID(str(pk)))
+            except ValueError:
+                portfolios = portfolios.none()
+        request._portfolio_state = portfolios.aggregate(count=Count('id'), version=Sum('version'), updated_at=Max('updated_at'))
+    return request._portfolio_state
+
+
+def portfolio_etag(request, pk=None, *args, **kwargs):
+    state = portfolio_state(request, pk)
+    if not state['count']:
+        return None
+    key = f"{request.user.pk}:{pk}:{state['count']}:{state['version']}:{state['updated_at'].isoformat()}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def portfolio_last_modified(request, pk=None, *args, **kwargs):
+    return portfolio_state(request, pk)['updated_at']
+
+
+portfolio_condition = condition(etag_func=portfolio_etag, last_modified_func=portfolio_last_modified)
+conditional_on_portfolios = method_decorator(portfolio_condition)
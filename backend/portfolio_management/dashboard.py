@@ -0,0 +1,98 @@
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F, OuterRef, Prefetch, Q, Subquery
+
+from .models import CurrentPrice, MonthlyPerformance, Portfolio, Position
+from .serializers import DashboardPortfolioSerializer
+
+
+def dashboard_cache():
+    return caches[getattr(settings, 'DASHBOARD_CACHE_ALIAS', 'default')]
+
+
+def _version_key(user_id):
+    return f'dashboard:version:{user_id}'
+
+
+def invalidate_dashboards(user_ids):
+    cache = dashboard_cache()
+    for user_id in set(user_ids):
+        try:
+            cache.incr(_version_key(user_id))
+        except ValueError:
+            # Nothing cached for this user yet.
+            pass
+
+
+def invalidate_portfolio_dashboards(portfolio_ids):
+    if portfolio_ids:
+        invalidate_dashboards(Portfolio.objects.filter(id__in=portfolio_ids).values_list('user_id', flat=True))
+
+
+def positions_with_prices():
+    current_price = CurrentPrice.objects.filter(symbol=OuterRef('symbol')).values('price')[:1]
+    return Position.objects.annotate(
+        current_price=Subquery(current_price),
+        market_value=F('quantity') * F('current_price'),
+        capital_gain=F('market_value') - F('cost_basis'),
+    )
+
+
+def dashboard_portfolios(user, months=None):
+    """The user's portfolios with positions and recent months prefetched: three queries."""
+    months = months or getattr(settings, 'DASHBOARD_MONTHS', 12)
+    today = date.today()
+    first = today.year * 12 + today.month - months
+    since = Q(year__gt=first // 12) | Q(year=first // 12, month__gt=first % 12)
+    return Portfolio.objects.filter(user=user).order_by('name', 'id').prefetch_related(
+        Prefetch('position_set', queryset=positions_with_prices().order_by('symbol'), to_attr='positions'),
+        Prefetch(
+            'monthlyperformance_set',
+            queryset=MonthlyPerformance.objects.filter(since).order_by('year', 'month'),
+            to_attr='recent_performance',
+        ),
+    )
+
+
+def aggregate_positions(portfolios):
+    totals = defaultdict(lambda: {'quantity': 0, 'cost_basis': Decimal('0'), 'market_value': Decimal('0')})
+    for portfolio in portfolios:
+        for position in portfolio.positions:
+            row = totals[position.symbol]
+            row['quantity'] += position.quantity
+            row['cost_basis'] += position.cost_basis
+            if position.market_value is not None:
+                row['market_value'] += position.market_value
+    return [
+        {
+            'symbol': symbol,
+            'quantity': row['quantity'],
+            'cost_basis': str(row['cost_basis'].quantize(Decimal('0.01'))),
+            'market_value': str(row['market_value'].quantize(Decimal('0.01'))),
+        }
+        for symbol, row in sorted(totals.items())
+    ]
+
+
+def build_dashboard(user):
+    portfolios = list(dashboard_portfolios(user))
+    return {
+        'portfolios': DashboardPortfolioSerializer(portfolios, many=True).data,
+        'positions': aggregate_positions(portfolios),
+    }
+
+
+def get_dashboard(user):
+    """Serve the dashboard from the cache, rebuilding it after an invalidation."""
+    cache = dashboard_cache()
+    version = cache.get_or_set(_version_key(user.id), 1, None)
+    key = f'dashboard:{user.id}:{version}'
+    data = cache.get(key)
+    if data is None:
+        data = build_dashboard(user)
+        cache.set(key, data, getattr(settings, 'DASHBOARD_CACHE_TTL', 300))
+    return data
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DecimalField, Value, When
+
+from .quotes import get_quote_provider
+from .recompute import recompute_portfolios
+
+
+logger = logging.getLogger(__name__)
+
+RATE_FIELD = DecimalField(max_digits=18, decimal_places=8)
+
+
+def base_currency():
+    """Currency portfolios are valued in, or None to sum amounts in their own currencies."""
+    return getattr(settings, 'PORTFOLIO_BASE_CURRENCY', None) or None
+
+
+def fx_symbol(currency, base):
+    return f'{currency}{base}=X'
+
+
+class FxRateCache:
+    """Per-process cache of rates into the base currency.
+
+    The current rates are loaded together in one query and kept for
+    ``FX_RATE_CACHE_TTL`` seconds; historical rates never change and are kept
+    in a bounded LRU.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._current = None
+        self._history = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'FX_RATE_CACHE_TTL', 300)
+
+    def current(self):
+        """``{currency: rate}`` for every currency with a stored rate."""
+        from .models import FxRate, Investment
+
+        base = base_currency()
+        with self._lock:
+            if self._current is not None:
+                cached_base, expires, rates = self._current
+                if cached_base == base and expires > time.monotonic():
+                    return rates
+        rates = FxRate.current(base)
+        unknown = sorted(set(dict(Investment.CURRENCY_CHOICES)) - set(rates) - {base})
+        if unknown:
+            logger.warning("No %s exchange rates stored for %s; using their own amounts", base, ', '.join(unknown))
+        with self._lock:
+            self._current = (base, time.monotonic() + self.ttl, rates)
+        return rates
+
+    def rate_on(self, currency, day):
+        """Rate of ``currency`` on ``day`` (the last one stored before it), or None."""
+        from .models import FxRate
+
+        base = base_currency()
+        if currency == base:
+            return Decimal('1')
+        key = (base, currency, day)
+        with self._lock:
+            if key in self._history:
+                self._history.move_to_end(key)
+                return self._history[key]
+        rate = FxRate.rate_on(currency, base, day)
+        # Rates still missing may be stored later, so only hits are kept.
+        if rate is not None:
+            with self._lock:
+                self._history[key] = rate
+                while len(self._history) > self.maxsize:
+                    self._history.popitem(last=False)
+        return rate
+
+    def clear(self):
+        with self._lock:
+            self._current = None
+            self._history.clear()
+
+
+fx_cache = FxRateCache()
+
+
+def conversion(field='currency'):
+    """Factor converting an amount in the row's ``field`` currency to the base currency.
+
+    The current rates are inlined in a CASE so aggregates convert without a
+    join or lookup per row. Returns None when valuing in native currencies;
+    rows in a currency without a rate keep their own amount, like analytics.
+    """
+    base = base_currency()
+    if base is None:
+        return None
+    rates = fx_cache.current()
+    return Case(
+        When(**{field: base}, then=Value(Decimal('1'))),
+        *[When(**{field: currency}, then=Value(rate)) for currency, rate in rates.items()],
+        default=Value(Decimal('1')),
+        output_field=RATE_FIELD,
+    )
+
+
+def store_fx_rates(rates, day=None):
+    """Save ``{currency: rate}`` as the rates of ``day`` and revalue the portfolios holding those currencies."""
+    from .models import FxRate, Holding
+
+    base = base_currency()
+    with transaction.atomic():
+        FxRate.store(rates, base, day or date.today())
+        fx_cache.clear()
+        transaction.on_commit(fx_cache.clear)
+        portfolio_ids = set(Holding.objects.filter(currency__in=list(rates)).values_list('portfolio_id', flat=True).distinct())
+        if portfolio_ids:
+            recompute_portfolios(portfolio_ids)
+    return portfolio_ids
+
+
+def refresh_fx_rates(currencies, provider=None):
+    """Fetch the current rate of each currency into the base currency; returns the currencies left without one."""
+    base = base_currency()
+    symbols = {fx_symbol(currency, base): currency for currency in currencies if currency != base}
+    if not symbols:
+        return []
+    prices = (provider or get_quote_provider()).fetch(list(symbols))
+    if prices:
+        store_fx_rates({symbols[symbol]: price for symbol, price in prices.items()})
+    missing = [currency for symbol, currency in symbols.items() if symbol not in prices]
+    if missing:
+        logger.warning("No %s exchange rate found for %s", base, ', '.join(missing))
+    return missing
+
+
+def backfill_fx_rates(currencies, start, end, provider=None):
+    """Download the daily rates of each currency into the base currency; returns the rows stored."""
+    from .models import FxRate
+
+    base = base_currency()
+    symbols = {fx_symbol(currency, base): currency for currency in currencies if currency != base}
+    if not symbols:
+        return 0
+    bars = (provider or get_quote_provider()).history(list(symbols), start, end)
+    bars = bars.assign(currency=bars['symbol'].map(symbols))
+    rows = FxRate.store_history(bars, base)
+    fx_cache.clear()
+    return rows
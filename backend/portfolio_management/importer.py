@@ -0,0 +1,269 @@
+import codecs
+import csv
+import json
+import time
+import uuid
+from collections import defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .backfill import schedule_price_backfill
+from .fx import base_currency, fx_cache
+from .models import Holding, Investment, Portfolio, Position
+from .price_cache import price_cache
+from .recompute import deferred_portfolio_updates
+
+
+IMPORT_CHUNK_SIZE = 5000
+FIELDS = ['portfolio', 'symbol', 'quantity', 'transaction_type', 'date', 'price', 'currency']
+
+
+def read_rows(stream, format):
+    """Yield row dicts from a binary CSV, NDJSON or JSON array stream."""
+    if format == 'json':
+        rows = json.load(codecs.getreader('utf-8')(stream))
+        if not isinstance(rows, list):
+            raise ValidationError("Expected a JSON array of investments.")
+        yield from rows
+        return
+
+    lines = codecs.iterdecode(stream, 'utf-8')
+    if format == 'csv':
+        yield from csv.DictReader(lines)
+    elif format == 'ndjson':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValidationError(f"Unsupported import format: {format}")
+
+
+def parse_row(row):
+    missing = [name for name in FIELDS if row.get(name) in (None, '')]
+    if missing:
+        raise ValidationError(f"Missing {', '.join(missing)}")
+    try:
+        portfolio_id = str(uuid.UUID(str(row['portfolio'])))
+        quantity = int(row['quantity'])
+        price = Decimal(str(row['price']))
+        day = date.fromisoformat(str(row['date']))
+    except (TypeError, ValueError, InvalidOperation) as e:
+        raise ValidationError(str(e))
+    if quantity <= 0:
+        raise ValidationError("quantity must be positive")
+    if row['transaction_type'] not in dict(Investment.TRANSACTION_CHOICES):
+        raise ValidationError(f"Unknown transaction_type {row['transaction_type']}")
+    if row['currency'] not in dict(Investment.CURRENCY_CHOICES):
+        raise ValidationError(f"Unknown currency {row['currency']}")
+    investment = Investment(
+        portfolio_id=portfolio_id,
+        symbol=row['symbol'],
+        quantity=quantity,
+        transaction_type=row['transaction_type'],
+        date=day,
+        price=price,
+        currency=row['currency'],
+    )
+    try:
+        # Hold values to the column limits so bulk_create never hits a DataError.
+        investment.clean_fields(exclude=['id', 'portfolio'])
+    except ValidationError as e:
+        raise ValidationError('; '.join(f"{name}: {' '.join(messages)}" for name, messages in e.message_dict.items()))
+    return investment
+
+
+@dataclass
+class ImportResult:
+    rows: int = 0
+    chunks: int = 0
+    portfolio_ids: set = field(default_factory=set)
+    errors: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+
+class InvestmentImporter:
+    """Imports investments in chunks without going through Investment.save.
+
+    Each chunk is written with bulk_create and its effect on the lots is
+    replayed in memory per (portfolio, symbol), then applied with a handful of
+    bulk writes. Portfolio totals are recomputed once when the import ends.
+    With ``atomic`` the whole import commits or nothing does; otherwise every
+    chunk commits on its own and the import stops at the first failing chunk.
+    """
+
+    def __init__(self, user=None, chunk_size=IMPORT_CHUNK_SIZE, atomic=True):
+        self.user = user
+        self.chunk_size = chunk_size
+        self.atomic = atomic
+        self._portfolio_ids = None
+
+    def allowed_portfolio_ids(self):
+        if self._portfolio_ids is None:
+            portfolios = Portfolio.objects.all()
+            if self.user is not None:
+                portfolios = portfolios.filter(user=self.user)
+            self._portfolio_ids = {str(pk) for pk in portfolios.values_list('id', flat=True)}
+        return self._portfolio_ids
+
+    def chunks(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, rows):
+        started = time.monotonic()
+        result = ImportResult()
+        with deferred_portfolio_updates() as dirty:
+            with transaction.atomic() if self.atomic else nullcontext():
+                try:
+                    self.import_chunks(rows, result)
+                except (ValidationError, ValueError, csv.Error) as e:
+                    messages = e.messages if isinstance(e, ValidationError) else [str(e)]
+                    result.errors.append({'row': None, 'error': ' '.join(messages)})
+                if result.errors and self.atomic:
+                    transaction.set_rollback(True)
+                    result.rows = result.chunks = 0
+                    result.portfolio_ids = set()
+            dirty.update(result.portfolio_ids)
+        result.elapsed = time.monotonic() - started
+        return result
+
+    def import_chunks(self, rows, result):
+        for offset, chunk in self._numbered_chunks(rows):
+            investments = self.parse(chunk, offset, result)
+            if result.errors:
+                return
+            with transaction.atomic():
+                self.apply(investments, offset, result)
+                if result.errors:
+                    # Drop the positions apply created for the rejected chunk.
+                    transaction.set_rollback(True)
+            if result.errors:
+                return
+            result.rows += len(investments)
+            result.chunks += 1
+            result.portfolio_ids.update(investment.portfolio_id for investment in investments)
+
+    def _numbered_chunks(self, rows):
+        offset = 0
+        for chunk in self.chunks(rows):
+            yield offset, chunk
+            offset += len(chunk)
+
+    def parse(self, chunk, offset, result):
+        allowed = self.allowed_portfolio_ids()
+        investments = []
+        for number, row in enumerate(chunk, start=offset + 1):
+            try:
+                investment = parse_row(row)
+                if investment.portfolio_id not in allowed:
+                    raise ValidationError(f"Unknown portfolio {investment.portfolio_id}")
+            except ValidationError as e:
+                result.errors.append({'row': number, 'error': ' '.join(e.messages)})
+                continue
+            investments.append(investment)
+        return investments
+
+    def apply(self, investments, offset, result):
+        pairs = {(investment.portfolio_id, investment.symbol) for investment in investments}
+        # Create the positions that do not exist yet and hold every touched
+        # one, in a stable order like Position.lock, so trades on them made
+        # through Investment.save wait for this chunk instead of writing lots
+        # Position.store would then overwrite.
+        Position.objects.bulk_create(
+            [Position(portfolio_id=portfolio_id, symbol=symbol) for portfolio_id, symbol in sorted(pairs)],
+            ignore_conflicts=True,
+            batch_size=1000,
+        )
+        list(Position.objects.select_for_update().filter(
+            portfolio_id__in={portfolio_id for portfolio_id, _ in pairs},
+            symbol__in={symbol for _, symbol in pairs},
+        ).order_by('portfolio_id', 'symbol').values_list('id', flat=True))
+        lots = defaultdict(list)
+        existing = Holding.objects.filter(
+            portfolio_id__in={portfolio_id for portfolio_id, _ in pairs},
+            symbol__in={symbol for _, symbol in pairs},
+        ).order_by('purchase_date', 'id')
+        for holding in existing:
+            key = (str(holding.portfolio_id), holding.symbol)
+            if key in pairs:
+                lots[key].append(holding)
+
+        changed, deleted = {}, []
+        for number, investment in enumerate(investments, start=offset + 1):
+            position = lots[(investment.portfolio_id, investment.symbol)]
+            if investment.transaction_type == 'Buy':
+                self.buy(position, investment, changed)
+            elif not self.sell(position, investment.quantity, changed, deleted):
+                result.errors.append({
+                    'row': number,
+                    'error': "Insufficient quantity available in holdings for selling",
+                })
+        if result.errors:
+            return
+
+        Investment.objects.bulk_create(investments, batch_size=1000)
+        Holding.objects.filter(id__in=deleted).delete()
+        created = [holding for holding in changed.values() if holding.pk is None]
+        updated = [holding for holding in changed.values() if holding.pk is not None]
+        symbols = {holding.symbol for holding in created}
+        prices = price_cache.get_many(symbols)
+        for holding in created:
+            holding.current_price = prices.get(holding.symbol)
+        for holding in created + updated:
+            holding.capital_gain, holding.performance = holding.calculate_performance() or (None, None)
+        Holding.objects.bulk_create(created, batch_size=1000)
+        Holding.objects.bulk_update(updated, ['quantity', 'capital_gain', 'performance'], batch_size=1000)
+        Position.store({
+            key: (sum(lot.quantity for lot in position), sum(lot.quantity * lot.purchase_price for lot in position))
+            for key, position in lots.items()
+        })
+        pending = sorted(symbols - set(prices))
+        if pending:
+            schedule_price_backfill(pending)
+
+    def buy(self, position, investment, changed):
+        for holding in position:
+            if (holding.purchase_price, holding.purchase_date, holding.currency) == (investment.price, investment.date, investment.currency):
+                holding.quantity += investment.quantity
+                changed[id(holding)] = holding
+                return
+        holding = Holding(
+            portfolio_id=investment.portfolio_id,
+            symbol=investment.symbol,
+            quantity=investment.quantity,
+            purchase_price=investment.price,
+            purchase_date=investment.date,
+            currency=investment.currency,
+            purchase_fx_rate=fx_cache.rate_on(investment.currency, investment.date) if base_currency() else None,
+        )
+        index = next((i for i, lot in enumerate(position) if lot.purchase_date > investment.date), len(position))
+        position.insert(index, holding)
+        changed[id(holding)] = holding
+
+    def sell(self, position, quantity, changed, deleted):
+        if sum(holding.quantity for holding in position) < quantity:
+            return False
+        while quantity > 0:
+            holding = position[0]
+            sold = min(holding.quantity, quantity)
+            holding.quantity -= sold
+            quantity -= sold
+            if holding.quantity == 0:
+                position.pop(0)
+                changed.pop(id(holding), None)
+                if holding.pk is not None:
+                    deleted.append(holding.pk)
+            else:
+                changed[id(holding)] = holding
+        return True
@@ -0,0 +1,34 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from portfolio_management.backfill import backfill_price_history
+from portfolio_management.models import Investment
+
+class Command(BaseCommand):
+    help = 'Downloads the daily price history missing from the local store for traded symbols'
+
+    def add_arguments(self, parser):
+        parser.add_argument('symbols', nargs='*', help='Only backfill these symbols')
+        parser.add_argument('--start', type=date.fromisoformat, help='First date (default: first trade of each symbol)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last date (default: today)')
+        parser.add_argument('--batch-size', type=int, help='Symbols per provider request')
+
+    def handle(self, *args, **options):
+        first_trades = Investment.objects.values('symbol').annotate(first=Min('date'))
+        if options['symbols']:
+            first_trades = first_trades.filter(symbol__in=options['symbols'])
+        starts = {row['symbol']: row['first'] for row in first_trades}
+        if options['start']:
+            starts = {symbol: options['start'] for symbol in options['symbols'] or starts}
+        elif set(options['symbols']) - set(starts):
+            raise CommandError(f"No trades for {', '.join(sorted(set(options['symbols']) - set(starts)))}; pass --start")
+
+        result = backfill_price_history(starts, options['end'] or date.today(), batch_size=options['batch_size'])
+
+        for symbol in result.failed:
+            self.stdout.write(self.style.WARNING(f"Failed to download price history for {symbol}"))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {result.rows} bars for {len(starts)} symbols in {result.requests} requests in {result.elapsed:.2f}s"
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from portfolio_management.backfill import backfill_prices
+from portfolio_management.quotes import PriceFetcher
+
+class Command(BaseCommand):
+    help = 'Fetches prices for holdings still waiting for one and revalues them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('symbols', nargs='*', help='Only backfill these symbols')
+        parser.add_argument('--batch-size', type=int, help='Symbols per provider request')
+        parser.add_argument('--workers', type=int, help='Concurrent provider requests')
+
+    def handle(self, *args, **options):
+        fetcher = PriceFetcher(batch_size=options['batch_size'], workers=options['workers'])
+        result = backfill_prices(options['symbols'] or None, fetcher=fetcher)
+
+        for symbol in result.failed:
+            self.stdout.write(self.style.WARNING(f"Failed to backfill price for {symbol}"))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled {len(result.prices)}/{result.total} prices in {result.elapsed:.2f}s"
+        ))
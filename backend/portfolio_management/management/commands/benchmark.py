@@ -0,0 +1,147 @@
+import random
+import time
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from core.profiling import profile
+from portfolio_management.backfill import store_prices
+from portfolio_management.models import Investment, MonthlyPerformance, Position
+from portfolio_management.price_cache import price_cache
+from portfolio_management.quotes import FakeQuoteProvider, PriceFetcher
+from portfolio_management.synthetic import DISTRIBUTIONS, delete_synthetic, generate
+
+ENDPOINTS = {
+    'list_portfolios': lambda portfolio: reverse('portfolio-list'),
+    'holdings': lambda portfolio: reverse('investment-holdings-by-portfolio', args=[portfolio.id]),
+    'investments': lambda portfolio: reverse('investment-investments-by-portfolio', args=[portfolio.id]),
+    'positions': lambda portfolio: reverse('investment-positions-by-portfolio', args=[portfolio.id]),
+    'monthly_performance': lambda portfolio: reverse('investment-monthly-performance-by-portfolio', args=[portfolio.id]),
+    'dashboard': lambda portfolio: reverse('dashboard'),
+}
+SCENARIOS = ['buy', 'sell', 'price_refresh', 'update_performance', 'monthly_snapshot', *ENDPOINTS]
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates synthetic data, benchmarks trades, FIFO sells, price refreshes, performance updates, '
+        'the monthly snapshot and the list endpoints against the offline fake quote provider, then deletes the data. '
+        'Only the generated portfolios and symbols are written to.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--portfolios', type=int, default=100)
+        parser.add_argument('--trades', type=int, default=20_000)
+        parser.add_argument('--symbols', type=int, default=200)
+        parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='zipf')
+        parser.add_argument('--iterations', type=int, default=200, help='Operations per scenario')
+        parser.add_argument('--runs', type=int, default=5, help='Runs of the price refresh and monthly snapshot')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Only run these scenarios')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='Keep the generated data')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.iterations = options['iterations']
+        self.runs = options['runs']
+        prefix = f'benchmark-{time.time_ns()}'
+        settings = override_settings(
+            QUOTE_PROVIDER='portfolio_management.quotes.FakeQuoteProvider',
+            PRICE_BACKFILL_ENABLED=False,
+            BACKGROUND_TASKS_EAGER=True,
+            ALLOWED_HOSTS=['*'],
+        )
+        with settings:
+            price_cache.clear()
+            try:
+                self.data = generate(
+                    users=options['users'], portfolios=options['portfolios'], trades=options['trades'],
+                    symbols=options['symbols'], distribution=options['distribution'], seed=options['seed'],
+                    prefix=prefix, symbol_prefix='BENCH',
+                )
+                self.stdout.write(
+                    f"Generated {len(self.data.portfolios)} portfolios and {self.data.trades} trades "
+                    f"on {len(self.data.symbols)} symbols in {self.data.elapsed:.1f}s\n"
+                )
+                self.stdout.write(f"{'scenario':<20} {'ops':>6} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'queries/op':>11}")
+                for name in options['scenario'] or SCENARIOS:
+                    self.report(name, self.measure(*self.scenario(name)))
+            finally:
+                if not options['keep']:
+                    delete_synthetic(prefix, symbol_prefix='BENCH')
+                price_cache.clear()
+
+    def scenario(self, name):
+        """Operation to time and how many times to run it."""
+        if name in ENDPOINTS:
+            client = APIClient()
+
+            def request():
+                portfolio = self.random.choice(self.data.portfolios)
+                client.force_authenticate(portfolio.user)
+                response = client.get(ENDPOINTS[name](portfolio))
+                assert response.status_code == 200, response.status_code
+            return request, self.iterations
+        if name == 'sell':
+            positions = Position.objects.filter(portfolio__in=self.data.portfolios, quantity__gt=1).select_related('portfolio')
+            self.positions = list(positions.order_by('?')[:self.iterations])
+            return self.sell, len(self.positions)
+        return getattr(self, name), self.runs if name in ('price_refresh', 'monthly_snapshot') else self.iterations
+
+    def buy(self):
+        portfolio = self.random.choice(self.data.portfolios)
+        Investment(
+            portfolio=portfolio, symbol=self.random.choice(self.data.symbols), quantity=self.random.randrange(1, 100),
+            transaction_type='Buy', date=date.today(), price=Decimal(self.random.randrange(1000, 50000)) / 100,
+            currency='USD',
+        ).save()
+
+    def sell(self):
+        position = self.positions.pop()
+        # Half the position, so several of its oldest lots are consumed.
+        Investment(
+            portfolio=position.portfolio, symbol=position.symbol, quantity=position.quantity // 2,
+            transaction_type='Sell', date=date.today(), price=Decimal('100'), currency='USD',
+        ).save()
+
+    def price_refresh(self):
+        provider = FakeQuoteProvider()
+        provider.prices = {
+            symbol: provider.quote(symbol) * Decimal(str(round(self.random.uniform(0.9, 1.1), 4)))
+            for symbol in self.data.symbols
+        }
+        # Only the synthetic symbols, so real prices are never overwritten with fake ones.
+        store_prices(PriceFetcher(provider).fetch(self.data.symbols).prices)
+
+    def update_performance(self):
+        self.random.choice(self.data.portfolios).update_performance()
+
+    def monthly_snapshot(self):
+        today = date.today()
+        # Only the synthetic portfolios, so real users' months and versions are left alone.
+        MonthlyPerformance.snapshot(today.month, today.year, portfolio_ids=[portfolio.id for portfolio in self.data.portfolios])
+
+    def measure(self, operation, count):
+        latencies, queries = [], []
+        started = time.perf_counter()
+        for _ in range(count):
+            with profile() as current:
+                operation()
+            latencies.append(current.latency)
+            queries.append(current.sql_count)
+        return time.perf_counter() - started, np.array(latencies), np.array(queries)
+
+    def report(self, name, measurements):
+        elapsed, latencies, queries = measurements
+        if not len(latencies):
+            self.stdout.write(f"{name:<20} {0:>6}")
+            return
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        self.stdout.write(
+            f"{name:<20} {len(latencies):>6} {len(latencies) / elapsed:>10.1f} {p50:>9.2f} {p99:>9.2f} {queries.mean():>11.1f}"
+        )
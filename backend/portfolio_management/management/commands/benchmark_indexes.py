@@ -0,0 +1,136 @@
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum, F, DecimalField
+from users.models import CustomUser
+from portfolio_management.models import Portfolio, Holding, Investment, MonthlyPerformance
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seeds synthetic rows in a rolled back transaction and reports query plans and latency of the hot lookups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Holdings and investments to generate')
+        parser.add_argument('--lots-per-position', type=int, default=20)
+        parser.add_argument('--symbols', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=50, help='Executions per query')
+        parser.add_argument('--compare', action='store_true', help='Also measure with only the plain foreign key indexes')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.repeat = options['repeat']
+        try:
+            with transaction.atomic():
+                self.seed(options['rows'], options['lots_per_position'], options['symbols'])
+                self.report('with indexes')
+                if options['compare']:
+                    self.drop_indexes()
+                    self.report('foreign key indexes only')
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, rows, lots_per_position, symbol_count):
+        started = time.monotonic()
+        user = CustomUser.objects.create(username=f'benchmark-{time.time_ns()}')
+        symbols = [f'S{i:04d}' for i in range(symbol_count)]
+        positions_per_portfolio = 10
+        portfolio_count = max(rows // (lots_per_position * positions_per_portfolio), 1)
+        portfolios = Portfolio.objects.bulk_create(
+            Portfolio(user=user, name=f'Portfolio {i}') for i in range(portfolio_count)
+        )
+        start = date(2015, 1, 1)
+
+        holdings, investments, months = [], [], []
+        for portfolio in portfolios:
+            for symbol in self.random.sample(symbols, min(positions_per_portfolio, symbol_count)):
+                for lot in range(lots_per_position):
+                    day = start + timedelta(days=self.random.randrange(3650))
+                    price = Decimal(self.random.randrange(1000, 50000)) / 100
+                    holdings.append(Holding(
+                        portfolio=portfolio, symbol=symbol, quantity=self.random.randrange(1, 100),
+                        purchase_price=price, purchase_date=day,
+                        current_price=None if lot == 0 and self.random.random() < 0.01 else price,
+                    ))
+                    investments.append(Investment(
+                        portfolio=portfolio, symbol=symbol, quantity=1, transaction_type='Buy',
+                        date=day, price=price, currency='USD',
+                    ))
+            for month in range(120):
+                months.append(MonthlyPerformance(portfolio=portfolio, month=month % 12 + 1, year=2015 + month // 12))
+            if len(holdings) >= 50_000:
+                self.flush(holdings, investments, months)
+        self.flush(holdings, investments, months)
+
+        self.portfolio = self.random.choice(portfolios)
+        self.symbol = Holding.objects.filter(portfolio=self.portfolio).values_list('symbol', flat=True).first()
+        self.stdout.write(
+            f"Seeded {portfolio_count} portfolios, {rows} lots/trades and {portfolio_count * 120} monthly rows "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def flush(self, holdings, investments, months):
+        Holding.objects.bulk_create(holdings, batch_size=5000)
+        Investment.objects.bulk_create(investments, batch_size=5000)
+        MonthlyPerformance.objects.bulk_create(months, batch_size=5000)
+        holdings.clear()
+        investments.clear()
+        months.clear()
+
+    def queries(self):
+        portfolio, symbol = self.portfolio, self.symbol
+        return {
+            'fifo_lots': Holding.objects.filter(portfolio=portfolio, symbol=symbol).order_by('purchase_date'),
+            'holdings_by_symbol': Holding.objects.filter(symbol=symbol).values_list('id', flat=True),
+            'portfolio_totals': Holding.objects.filter(portfolio=portfolio).values('portfolio').annotate(
+                cost=Sum(F('quantity') * F('purchase_price'), output_field=DecimalField()),
+                value=Sum(F('quantity') * F('current_price'), output_field=DecimalField()),
+            ),
+            'investments_by_date': Investment.objects.filter(portfolio=portfolio).order_by('-date')[:100],
+            'monthly_performance': MonthlyPerformance.objects.filter(portfolio=portfolio).order_by('year', 'month'),
+            'pending_prices': Holding.objects.filter(current_price__isnull=True).values('symbol').distinct(),
+        }
+
+    def report(self, label):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{label}"))
+        for name, queryset in self.queries().items():
+            plan = queryset.explain()
+            timings = []
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            self.stdout.write(
+                f"{name:<22} p50 {timings[len(timings) // 2] * 1000:8.2f} ms   "
+                f"p99 {timings[int(len(timings) * 0.99)] * 1000:8.2f} ms"
+            )
+            for line in plan.splitlines():
+                self.stdout.write(f"    {line}")
+
+    def drop_indexes(self):
+        # Plain DDL rather than the schema editor, which SQLite refuses to
+        # use inside a transaction.
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            for model in (Holding, Investment, MonthlyPerformance):
+                for index in model._meta.indexes:
+                    cursor.execute(f'DROP INDEX {quote(index.name)}')
+                cursor.execute(
+                    f'CREATE INDEX {quote(model._meta.model_name + "_bench_fk")} '
+                    f'ON {quote(model._meta.db_table)} ({quote("portfolio_id")})'
+                )
+            if connection.vendor == 'postgresql':
+                cursor.execute('ANALYZE')
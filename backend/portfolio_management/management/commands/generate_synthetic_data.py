@@ -0,0 +1,47 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from portfolio_management.synthetic import DISTRIBUTIONS, delete_synthetic, generate
+
+class Command(BaseCommand):
+    help = 'Generates synthetic users, portfolios and trades priced by the offline fake quote provider'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--portfolios', type=int, default=50, help='Portfolios in total, spread over the users')
+        parser.add_argument('--trades', type=int, default=10_000)
+        parser.add_argument('--symbols', type=int, default=100)
+        parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='zipf', help='How trades spread over symbols')
+        parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent')
+        parser.add_argument('--sell-ratio', type=float, default=0.2, help='Chance that a trade on a held position is a sell')
+        parser.add_argument('--start', type=date.fromisoformat, default=date(2020, 1, 1), help='Date of the first trade')
+        parser.add_argument('--days', type=int, default=1500, help='Days the trades spread over')
+        parser.add_argument('--history', action='store_true', help='Also store daily price history for the symbols')
+        parser.add_argument('--prefix', default='synthetic', help='Username prefix of the generated users')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--delete', action='store_true', help='Delete the data generated with --prefix instead')
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            deleted = delete_synthetic(options['prefix'])
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} rows generated with prefix {options['prefix']}"))
+            return
+
+        data = generate(
+            users=options['users'],
+            portfolios=options['portfolios'],
+            trades=options['trades'],
+            symbols=options['symbols'],
+            distribution=options['distribution'],
+            skew=options['skew'],
+            sell_ratio=options['sell_ratio'],
+            start=options['start'],
+            days=options['days'],
+            seed=options['seed'],
+            prefix=options['prefix'],
+            history=options['history'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {len(data.users)} users, {len(data.portfolios)} portfolios and {data.trades} trades "
+            f"on {len(data.symbols)} symbols in {data.elapsed:.1f}s"
+        ))
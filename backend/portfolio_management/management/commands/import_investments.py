@@ -0,0 +1,36 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from portfolio_management.importer import InvestmentImporter, IMPORT_CHUNK_SIZE, read_rows
+
+class Command(BaseCommand):
+    help = 'Imports investments in bulk from a CSV, NDJSON or JSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'ndjson', 'json'], help='Defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+        parser.add_argument('--per-chunk', action='store_true', help='Commit every chunk instead of the whole import')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or Path(path).suffix.lstrip('.').lower()
+        if format not in ('csv', 'ndjson', 'json'):
+            raise CommandError("Pass --format when it can't be told from the file extension")
+
+        importer = InvestmentImporter(chunk_size=options['chunk_size'], atomic=not options['per_chunk'])
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        with stream:
+            result = importer.run(read_rows(stream, format))
+
+        for error in result.errors:
+            self.stdout.write(self.style.ERROR(f"Row {error['row']}: {error['error']}" if error['row'] else error['error']))
+
+        message = (
+            f"Imported {result.rows} investments in {result.chunks} chunks across "
+            f"{len(result.portfolio_ids)} portfolios in {result.elapsed:.2f}s"
+        )
+        if result.errors:
+            raise CommandError(message)
+        self.stdout.write(self.style.SUCCESS(message))
@@ -1,23 +1,56 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand
-from portfolio_management.models import Portfolio, MonthlyPerformance
-from datetime import datetime
+from django.db import connections
+from portfolio_management.analytics import BACKFILL_BATCH_SIZE, backfill_monthly_performance
+from portfolio_management.models import MonthlyPerformance
+from datetime import date
+
+
+def snapshot_shard(month, year, batch_size, shard, shards):
+    try:
+        return MonthlyPerformance.snapshot(month, year, batch_size, shard, shards)
+    finally:
+        connections.close_all()
+
 
 class Command(BaseCommand):
     help = 'Saves the monthly performance for all portfolios'
 
-    def handle(self, *args, **kwargs):
-        current_month = datetime.now().month
-        current_year = datetime.now().year
-
-        for portfolio in Portfolio.objects.all():
-            monthly_performance, created = MonthlyPerformance.objects.get_or_create(
-                portfolio=portfolio,
-                month=current_month,
-                year=current_year
-            )
-            monthly_performance.value = portfolio.current_value
-            monthly_performance.capital_gain = portfolio.capital_gain
-            monthly_performance.performance = portfolio.performance
-            monthly_performance.save()
-
-        self.stdout.write(self.style.SUCCESS('Monthly performance saved successfully'))
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help='Rebuild every month since the first investment from the investment and price history',
+        )
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to value when backfilling (default: today)')
+        parser.add_argument('--batch-size', type=int, help='Portfolios per upsert (default: 5000), or per replayed batch when backfilling (default: 500)')
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes, each handling a shard of the portfolios (needs a database with concurrent writers such as PostgreSQL)')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            rows = backfill_monthly_performance(end=options['end'], batch_size=options['batch_size'] or BACKFILL_BATCH_SIZE)
+            self.stdout.write(self.style.SUCCESS(f'Backfilled {rows} monthly performance rows'))
+            return
+
+        started = time.monotonic()
+        today = date.today()
+        workers = options['workers']
+        shards = [(today.month, today.year, options['batch_size'] or 5000, shard, workers) for shard in range(workers)]
+
+        if workers > 1:
+            # Forked workers must not share the parent's database connections.
+            connections.close_all()
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(snapshot_shard, *zip(*shards)))
+        else:
+            results = [MonthlyPerformance.snapshot(*shards[0])]
+
+        portfolios = sum(count for count, _ in results)
+        chunks = sum(chunks for _, chunks in results)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Monthly performance saved for {portfolios} portfolios in {chunks} batches '
+            f'across {workers} workers in {elapsed:.2f}s ({portfolios / elapsed if elapsed else 0:.0f} portfolios/s)'
+        ))
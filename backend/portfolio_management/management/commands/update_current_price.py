@@ -1,22 +1,39 @@
 from django.core.management.base import BaseCommand
-from portfolio_management.models import Investment, CurrentPrice, Holding
-from portfolio_management.utils import get_current_price
+from portfolio_management.backfill import refresh_prices
+from portfolio_management.quotes import PriceFetcher
 
 class Command(BaseCommand):
     help = 'Updates the current prices of investments from external API'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Symbols per provider request')
+        parser.add_argument('--workers', type=int, help='Concurrent provider requests')
+        parser.add_argument('--timeout', type=float, help='Seconds before a batch attempt is abandoned')
+        parser.add_argument('--retries', type=int, help='Retries per failed or timed out batch')
+
     def handle(self, *args, **options):
-        symbols = set(Investment.objects.values_list('symbol', flat=True))
-        for symbol in symbols:
-            current_price = get_current_price(symbol)
-            if current_price is not None:
-                CurrentPrice.objects.update_or_create(symbol=symbol, defaults={'price': current_price})
+        self.verbosity = options['verbosity']
+        fetcher = PriceFetcher(
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            timeout=options['timeout'],
+            retries=options['retries'],
+        )
+        result, portfolio_ids = refresh_prices(fetcher, progress=self.report_progress)
+
+        if self.verbosity > 1:
+            for symbol in result.prices:
                 self.stdout.write(self.style.SUCCESS(f"Updated price for {symbol}"))
-                
-                holdings = Holding.objects.filter(symbol=symbol)
-                for holding in holdings:
-                    holding.current_price = current_price
-                    holding.save()
-                    
-            else:
-                self.stdout.write(self.style.WARNING(f"Failed to update price for {symbol}"))
+
+        for symbol in result.failed:
+            self.stdout.write(self.style.WARNING(f"Failed to update price for {symbol}"))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated {len(result.prices)}/{result.total} prices in {result.elapsed:.2f}s "
+            f"({result.batches} batches, {result.retries} retries, {result.timeouts} timeouts, {len(result.failed)} failed); "
+            f"revalued {len(portfolio_ids)} portfolios"
+        ))
+
+    def report_progress(self, result):
+        if self.verbosity > 0:
+            self.stdout.write(f"Fetched {result.done}/{result.total} symbols")
@@ -0,0 +1,29 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from portfolio_management.fx import backfill_fx_rates, base_currency, refresh_fx_rates
+from portfolio_management.models import Investment
+
+class Command(BaseCommand):
+    help = 'Fetches the exchange rates of traded currencies into PORTFOLIO_BASE_CURRENCY and revalues the portfolios'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true', help='Also download the daily rates since the first trade in each currency')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last date of the backfill (default: today)')
+
+    def handle(self, *args, **options):
+        base = base_currency()
+        if base is None:
+            raise CommandError('PORTFOLIO_BASE_CURRENCY is not set')
+        first_trades = dict(Investment.objects.exclude(currency=base).values_list('currency').annotate(first=Min('date')))
+
+        if options['backfill']:
+            end = options['end'] or date.today()
+            rows = sum(backfill_fx_rates([currency], start, end) for currency, start in first_trades.items())
+            self.stdout.write(f"Stored {rows} daily {base} rates for {len(first_trades)} currencies")
+
+        missing = refresh_fx_rates(first_trades)
+        for currency in missing:
+            self.stdout.write(self.style.WARNING(f"No {base} exchange rate found for {currency}"))
+        self.stdout.write(self.style.SUCCESS(f"Updated {len(first_trades) - len(missing)} {base} exchange rates"))
@@ -0,0 +1,72 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:17
+
+import django.db.models.deletion
+from django.contrib.postgres import operations as postgres_operations
+from django.db import migrations, models
+
+
+class AddIndexConcurrently(postgres_operations.AddIndexConcurrently):
+    """CREATE INDEX CONCURRENTLY on PostgreSQL, a plain CREATE INDEX elsewhere."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    # Concurrent index builds cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('portfolio_management', '0002_initial'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='holding',
+            index=models.Index(fields=['portfolio', 'symbol', 'purchase_date'], include=('quantity', 'purchase_price', 'current_price'), name='holding_portfolio_lots_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='holding',
+            index=models.Index(fields=['symbol'], name='holding_symbol_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='holding',
+            index=models.Index(condition=models.Q(('current_price__isnull', True)), fields=['symbol'], name='holding_price_pending_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='investment',
+            index=models.Index(fields=['portfolio', 'date'], name='investment_portfolio_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='investment',
+            index=models.Index(fields=['symbol'], name='investment_symbol_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='monthlyperformance',
+            index=models.Index(fields=['portfolio', 'year', 'month'], name='monthly_perf_period_idx'),
+        ),
+        migrations.AlterField(
+            model_name='holding',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfolio_management.portfolio'),
+        ),
+        migrations.AlterField(
+            model_name='investment',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfolio_management.portfolio'),
+        ),
+        migrations.AlterField(
+            model_name='monthlyperformance',
+            name='portfolio',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfolio_management.portfolio'),
+        ),
+    ]
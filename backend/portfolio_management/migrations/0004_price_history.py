@@ -0,0 +1,29 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_management', '0003_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=10)),
+                ('date', models.DateField()),
+                ('open', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('high', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('low', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('close', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('volume', models.BigIntegerField(null=True)),
+            ],
+            options={
+                'unique_together': {('symbol', 'date')},
+            },
+        ),
+    ]
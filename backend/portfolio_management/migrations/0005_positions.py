@@ -0,0 +1,46 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import DecimalField, F, Sum
+
+
+def build_positions(apps, schema_editor):
+    Holding = apps.get_model('portfolio_management', 'Holding')
+    Position = apps.get_model('portfolio_management', 'Position')
+    totals = Holding.objects.order_by().values('portfolio_id', 'symbol').annotate(
+        total_quantity=Sum('quantity'),
+        total_cost=Sum(F('quantity') * F('purchase_price'), output_field=DecimalField()),
+    ).filter(total_quantity__gt=0)
+    Position.objects.bulk_create(
+        (
+            Position(portfolio_id=row['portfolio_id'], symbol=row['symbol'],
+                     quantity=row['total_quantity'], cost_basis=row['total_cost'])
+            for row in totals.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_management', '0004_price_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Position',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=10)),
+                ('quantity', models.IntegerField(default=0)),
+                ('cost_basis', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('portfolio', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='portfolio_management.portfolio')),
+            ],
+            options={
+                'unique_together': {('portfolio', 'symbol')},
+            },
+        ),
+        migrations.RunPython(build_positions, migrations.RunPython.noop),
+    ]
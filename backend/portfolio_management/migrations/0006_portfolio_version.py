@@ -0,0 +1,24 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:36
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_management', '0005_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='portfolio',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:38
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_management', '0006_portfolio_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceRefreshJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=9)),
+                ('active', models.BooleanField(default=True, null=True, unique=True)),
+                ('total', models.IntegerField(default=0)),
+                ('done', models.IntegerField(default=0)),
+                ('updated', models.IntegerField(default=0)),
+                ('failed_symbols', models.JSONField(default=list)),
+                ('portfolios', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
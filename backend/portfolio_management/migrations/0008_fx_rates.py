@@ -0,0 +1,51 @@
+# Generated by Django 5.0.14 on 2026-10-18 15:45
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def copy_holding_currencies(apps, schema_editor):
+    # Lots take the currency their symbol was last bought in.
+    Holding = apps.get_model('portfolio_management', 'Holding')
+    Investment = apps.get_model('portfolio_management', 'Investment')
+    latest = Investment.objects.filter(
+        portfolio_id=OuterRef('portfolio_id'), symbol=OuterRef('symbol'), transaction_type='Buy',
+    ).order_by('-date').values('currency')[:1]
+    Holding.objects.filter(symbol__in=Investment.objects.exclude(currency='USD').values('symbol')).update(
+        currency=Coalesce(Subquery(latest), Value('USD')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_management', '0007_price_refresh_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='holding',
+            name='currency',
+            field=models.CharField(choices=[('USD', 'USD'), ('EUR', 'EUR'), ('CAD', 'CAD')], default='USD', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='holding',
+            name='purchase_fx_rate',
+            field=models.DecimalField(blank=True, decimal_places=8, max_digits=18, null=True),
+        ),
+        migrations.CreateModel(
+            name='FxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('base', models.CharField(max_length=3)),
+                ('date', models.DateField()),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=18)),
+            ],
+            options={
+                'unique_together': {('currency', 'base', 'date')},
+            },
+        ),
+        migrations.RunPython(copy_holding_currencies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-18 16:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_management', '0008_fx_rates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='holding',
+            name='performance',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+    ]
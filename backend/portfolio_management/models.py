@@ -1,18 +1,31 @@
-from django.db import models, transaction
-from django.db.models import Sum, F, DecimalField
+from django.db import models, transaction, IntegrityError
+from django.db.models import Sum, F, DecimalField, Case, When, Value, Min, Max, Window, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from users.models import CustomUser
-from .utils import get_current_price
+from .price_cache import price_cache
+from .recompute import mark_portfolio_dirty, recompute_portfolios
+from .backfill import refresh_prices, schedule_price_backfill
+from .tasks import run_in_background
+from .fx import RATE_FIELD, base_currency, conversion, fx_cache
+from .quotes import HISTORY_COLUMNS
 import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import islice
+from datetime import timedelta
 from decimal import Decimal
 
+import numpy as np
+import pandas as pd
 
-def get_current_price_for_symbol(symbol):
-    current_price_obj = CurrentPrice.objects.filter(symbol=symbol).first()
-    if current_price_obj:
-        return current_price_obj.price
-    else:
-        return get_current_price(symbol)
+REVALUE_CHUNK_SIZE = 250
+
+
+def get_current_price_for_symbol(symbol, fetch=True):
+    return price_cache.get(symbol, fetch=fetch)
 
 
 class Portfolio(models.Model):
@@ -22,74 +35,198 @@ class Portfolio(models.Model):
     performance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     current_value = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     capital_gain = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Bumped whenever anything shown for the portfolio may have changed; used
+    # for ETag and Last-Modified.
+    version = models.PositiveBigIntegerField(default=1)
+    updated_at = models.DateTimeField(default=timezone.now)
 
 
-    def update_performance(self):
-        total_investment_value = self.holding_set.aggregate(
-            total_investment_value=Sum(F('quantity') * F('purchase_price'), output_field=DecimalField())
-        )['total_investment_value'] or Decimal('0')
+    PERFORMANCE_FIELDS = ['current_value', 'capital_gain', 'performance']
 
-        if total_investment_value == Decimal('0'):
-            return
+    @staticmethod
+    def performance_totals():
+        cost = F('quantity') * F('purchase_price')
+        value = F('quantity') * F('current_price')
+        rate = conversion()
+        if rate is not None:
+            # Lots bought before their purchase rate was known cost the current rate.
+            cost = cost * Coalesce(F('purchase_fx_rate'), rate, output_field=RATE_FIELD)
+            value = value * rate
+        return {
+            'total_investment_value': Sum(cost, output_field=DecimalField()),
+            'total_performance': Sum(value, output_field=DecimalField()),
+        }
 
-        total_performance = self.holding_set.aggregate(
-            total_performance=Sum(F('quantity') * F('current_price'), output_field=DecimalField())
-        )['total_performance'] or Decimal('0')
+    def set_performance(self, total_investment_value, total_performance):
+        total_investment_value = total_investment_value or Decimal('0')
+        if total_investment_value == Decimal('0'):
+            return False
 
+        total_performance = total_performance or Decimal('0')
         percentage_difference = ((total_performance - total_investment_value) / total_investment_value) * Decimal('100')
         self.current_value = total_performance
         self.capital_gain = total_performance - total_investment_value
         self.performance = percentage_difference
-        self.save()
+        return True
+
+    def update_performance(self):
+        totals = self.holding_set.aggregate(**self.performance_totals())
+        if self.set_performance(totals['total_investment_value'], totals['total_performance']):
+            self.save(update_fields=self.PERFORMANCE_FIELDS)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            self.version += 1
+            self.updated_at = timezone.now()
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = [*kwargs['update_fields'], 'version', 'updated_at']
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def touch(cls, portfolio_ids):
+        """Bump the version of the portfolios and drop their users' cached dashboards."""
+        from .dashboard import invalidate_portfolio_dashboards
 
+        cls.objects.filter(id__in=portfolio_ids).update(version=F('version') + 1, updated_at=timezone.now())
+        invalidate_portfolio_dashboards(portfolio_ids)
+
+    @classmethod
+    def bulk_update_performance(cls, portfolio_ids=None):
+        holdings = Holding.objects.all()
+        if portfolio_ids is not None:
+            holdings = holdings.filter(portfolio_id__in=portfolio_ids)
+        totals = holdings.order_by().values('portfolio_id').annotate(**cls.performance_totals())
+
+        portfolios = []
+        for row in totals:
+            portfolio = cls(id=row['portfolio_id'])
+            if portfolio.set_performance(row['total_investment_value'], row['total_performance']):
+                portfolios.append(portfolio)
+        cls.objects.bulk_update(portfolios, cls.PERFORMANCE_FIELDS, batch_size=REVALUE_CHUNK_SIZE)
+        return portfolios
 
 
 class Holding(models.Model):
-    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    CURRENCY_CHOICES = (
+        ('USD', 'USD'),
+        ('EUR', 'EUR'),
+        ('CAD', 'CAD'),
+    )
+    # Lookups by portfolio are served by the composite indexes in Meta.
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
     symbol = models.CharField(max_length=10)
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='USD')
     quantity = models.IntegerField()
     purchase_price = models.DecimalField(max_digits=10, decimal_places=2)
     purchase_date = models.DateField()
     current_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
-    performance = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)
+    performance = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     capital_gain = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    # Base currency units per unit of ``currency`` on the purchase date.
+    purchase_fx_rate = models.DecimalField(max_digits=18, decimal_places=8, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # FIFO lot scans, plus index-only scans for the portfolio totals
+            # on PostgreSQL (other backends ignore the included columns).
+            models.Index(
+                fields=['portfolio', 'symbol', 'purchase_date'],
+                include=['quantity', 'purchase_price', 'current_price'],
+                name='holding_portfolio_lots_idx',
+            ),
+            models.Index(fields=['symbol'], name='holding_symbol_idx'),
+            models.Index(fields=['symbol'], condition=models.Q(current_price__isnull=True), name='holding_price_pending_idx'),
+        ]
 
     @classmethod
-    def update_quantity(cls, portfolio, symbol, quantity_change, purchase_price=None, purchase_date=None):
+    def update_quantity(cls, portfolio, symbol, quantity_change, purchase_price=None, purchase_date=None, currency='USD'):
         with transaction.atomic():
+            # Trades on the same position queue up here; other positions and
+            # portfolios are not blocked.
+            position = Position.lock(portfolio.id, symbol)
             if quantity_change > 0:
-                holding, created = cls.objects.update_or_create(
+                updated = cls.objects.filter(
                     portfolio=portfolio,
                     symbol=symbol,
                     purchase_price=purchase_price,
                     purchase_date=purchase_date,
-                    defaults={'quantity': quantity_change}
+                    currency=currency,
+                ).update(
+                    quantity=F('quantity') + quantity_change,
+                    capital_gain=(F('quantity') + quantity_change) * (F('current_price') - F('purchase_price')),
                 )
-                if not created:
-                    holding.quantity = F('quantity') + quantity_change
-                    holding.save(update_fields=['quantity'])
+                if updated:
+                    Position.adjust(portfolio.id, symbol, quantity_change, quantity_change * Decimal(purchase_price))
+                else:
+                    cls.objects.create(
+                        portfolio=portfolio,
+                        symbol=symbol,
+                        quantity=quantity_change,
+                        purchase_price=purchase_price,
+                        purchase_date=purchase_date,
+                        currency=currency,
+                    )
             else:
-                holdings = cls.objects.filter(portfolio=portfolio, symbol=symbol).order_by('purchase_date')
-                total_holding_quantity = sum(holding.quantity for holding in holdings)
-                
-                if total_holding_quantity < abs(quantity_change):
-                    raise ValidationError("Insufficient quantity available in holdings for selling")
-
-                quantity_to_sell = abs(quantity_change)
-            
-                for holding in holdings:
-                    if quantity_to_sell <= 0:
-                        break
-                    if holding.quantity >= quantity_to_sell:
-                        holding.quantity -= quantity_to_sell
-                        if holding.quantity == 0:
-                            holding.delete()
-                        else:
-                            holding.save()
-                        quantity_to_sell = 0
-                    else:
-                        quantity_to_sell -= holding.quantity
-                        holding.delete()
+                cls.sell(position, abs(quantity_change))
+
+    @classmethod
+    def sell(cls, position, quantity):
+        """Consume lots first in, first out with one delete and at most one update.
+
+        ``position`` must be locked by the caller.
+        """
+        portfolio_id, symbol = position.portfolio_id, position.symbol
+        if position.quantity < quantity:
+            raise ValidationError("Insufficient quantity available in holdings for selling")
+
+        # Only the lots that start before the sold quantity is covered.
+        lots = cls.objects.filter(portfolio_id=portfolio_id, symbol=symbol).annotate(
+            running=Window(Sum('quantity'), order_by=[F('purchase_date').asc(), F('id').asc()]),
+        ).filter(running__lt=F('quantity') + quantity).order_by('purchase_date', 'id').only('id', 'quantity', 'purchase_price')
+
+        remaining, sold_cost, sold_ids = quantity, Decimal('0'), []
+        for lot in lots:
+            sold = min(lot.quantity, remaining)
+            remaining -= sold
+            sold_cost += sold * lot.purchase_price
+            if sold == lot.quantity:
+                sold_ids.append(lot.id)
+            else:
+                left = lot.quantity - sold
+                cls.objects.filter(id=lot.id).update(
+                    quantity=left,
+                    capital_gain=left * (F('current_price') - F('purchase_price')),
+                )
+        if remaining:
+            # The position claimed more than the lots hold; the caller's
+            # transaction rolls back whatever was consumed.
+            raise ValidationError("Insufficient quantity available in holdings for selling")
+        cls.objects.filter(id__in=sold_ids).delete()
+        Position.adjust(portfolio_id, symbol, -quantity, -sold_cost)
+
+    @classmethod
+    def revalue(cls, prices):
+        portfolio_ids = set()
+        items = list(prices.items())
+        for start in range(0, len(items), REVALUE_CHUNK_SIZE):
+            chunk = items[start:start + REVALUE_CHUNK_SIZE]
+            holdings = cls.objects.filter(symbol__in=[symbol for symbol, _ in chunk])
+            holdings.update(current_price=Case(
+                *[When(symbol=symbol, then=Value(price)) for symbol, price in chunk],
+                output_field=cls._meta.get_field('current_price'),
+            ))
+            holdings.update(
+                capital_gain=F('quantity') * (F('current_price') - F('purchase_price')),
+                performance=Case(
+                    When(purchase_price=0, then=Value(None)),
+                    default=(F('current_price') - F('purchase_price')) * Decimal('100') / F('purchase_price'),
+                    output_field=cls._meta.get_field('performance'),
+                ),
+            )
+            portfolio_ids.update(holdings.values_list('portfolio_id', flat=True).distinct())
+
+        recompute_portfolios(portfolio_ids)
+        return portfolio_ids
 
 
     def calculate_performance(self):
@@ -104,12 +241,130 @@ class Holding(models.Model):
         return None
     
 
+    @property
+    def price_pending(self):
+        return self.current_price is None
+
     def save(self, *args, **kwargs):
+        # Never wait on the quote provider here: without a cached price the
+        # holding is saved as pending and revalued by the price backfill.
         if self.current_price is None:
-            self.current_price = get_current_price_for_symbol(self.symbol)
-        self.capital_gain, self.performance = self.calculate_performance()
-        super().save(*args, **kwargs)
-        self.portfolio.update_performance()
+            self.current_price = get_current_price_for_symbol(self.symbol, fetch=False)
+        self.capital_gain, self.performance = self.calculate_performance() or (None, None)
+        adding = self._state.adding
+        if adding and self.purchase_fx_rate is None and base_currency():
+            self.purchase_fx_rate = fx_cache.rate_on(self.currency, self.purchase_date)
+        if adding:
+            super().save(*args, **kwargs)
+            Position.adjust(self.portfolio_id, self.symbol, self.quantity, self.quantity * Decimal(self.purchase_price))
+        else:
+            # An edited lot (through the admin, say) may have left one position and joined another.
+            previous = Holding.objects.filter(pk=self.pk).values_list('portfolio_id', 'symbol')
+            with Position.recounting([*previous, (self.portfolio_id, self.symbol)]):
+                super().save(*args, **kwargs)
+        if self.price_pending:
+            schedule_price_backfill([self.symbol])
+        mark_portfolio_dirty(self.portfolio_id)
+
+    def delete(self, *args, **kwargs):
+        with Position.recounting([(self.portfolio_id, self.symbol)]):
+            deleted = super().delete(*args, **kwargs)
+        mark_portfolio_dirty(self.portfolio_id)
+        return deleted
+
+
+class Position(models.Model):
+    """Open quantity and cost basis of one symbol in a portfolio, kept in step with its lots."""
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
+    symbol = models.CharField(max_length=10)
+    quantity = models.IntegerField(default=0)
+    cost_basis = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ['portfolio', 'symbol']
+
+    def __str__(self):
+        return f"{self.symbol}: {self.quantity}"
+
+    @property
+    def average_cost(self):
+        return self.cost_basis / self.quantity if self.quantity else None
+
+    @classmethod
+    def lock(cls, portfolio_id, symbol):
+        """Lock the position row until the end of the transaction, creating it if needed."""
+        position, created = cls.objects.get_or_create(portfolio_id=portfolio_id, symbol=symbol)
+        if not created:
+            return cls.objects.select_for_update().get(pk=position.pk)
+        # The inserted row is already locked; pick up any lots written
+        # without going through the position.
+        totals = Holding.objects.filter(portfolio_id=portfolio_id, symbol=symbol).aggregate(
+            total_quantity=Sum('quantity'),
+            total_cost=Sum(F('quantity') * F('purchase_price'), output_field=DecimalField()),
+        )
+        if totals['total_quantity']:
+            position.quantity, position.cost_basis = totals['total_quantity'], totals['total_cost']
+            position.save(update_fields=['quantity', 'cost_basis'])
+        return position
+
+    @classmethod
+    def adjust(cls, portfolio_id, symbol, quantity, cost):
+        positions = cls.objects.filter(portfolio_id=portfolio_id, symbol=symbol)
+        if not positions.update(quantity=F('quantity') + quantity, cost_basis=F('cost_basis') + cost):
+            cls.rebuild(portfolio_id, symbol)
+        elif quantity < 0:
+            positions.filter(quantity__lte=0).delete()
+
+    @classmethod
+    def rebuild(cls, portfolio_id, symbol):
+        """Recreate the position from its lots, for lots written without going through it."""
+        totals = Holding.objects.filter(portfolio_id=portfolio_id, symbol=symbol).aggregate(
+            total_quantity=Sum('quantity'),
+            total_cost=Sum(F('quantity') * F('purchase_price'), output_field=DecimalField()),
+        )
+        if not totals['total_quantity']:
+            cls.objects.filter(portfolio_id=portfolio_id, symbol=symbol).delete()
+            return None
+        position, _ = cls.objects.update_or_create(
+            portfolio_id=portfolio_id, symbol=symbol,
+            defaults={'quantity': totals['total_quantity'], 'cost_basis': totals['total_cost']},
+        )
+        return position
+
+    @classmethod
+    @contextmanager
+    def recounting(cls, keys):
+        """Lock the given ``(portfolio_id, symbol)`` positions, then rebuild them from their lots on exit.
+
+        For lots edited or deleted without going through the position.
+        """
+        keys = sorted(set(keys))
+        with transaction.atomic():
+            for portfolio_id, symbol in keys:
+                cls.lock(portfolio_id, symbol)
+            yield
+            for portfolio_id, symbol in keys:
+                cls.rebuild(portfolio_id, symbol)
+
+    @classmethod
+    def store(cls, positions):
+        """Overwrite the given ``{(portfolio_id, symbol): (quantity, cost_basis)}`` positions."""
+        closed = [key for key, (quantity, _) in positions.items() if quantity <= 0]
+        if closed:
+            cls.objects.filter(models.Q(
+                *[models.Q(portfolio_id=portfolio_id, symbol=symbol) for portfolio_id, symbol in closed],
+                _connector=models.Q.OR,
+            )).delete()
+        cls.objects.bulk_create(
+            [
+                cls(portfolio_id=portfolio_id, symbol=symbol, quantity=quantity, cost_basis=cost_basis)
+                for (portfolio_id, symbol), (quantity, cost_basis) in positions.items() if quantity > 0
+            ],
+            update_conflicts=True,
+            unique_fields=['portfolio', 'symbol'],
+            update_fields=['quantity', 'cost_basis'],
+            batch_size=1000,
+        )
 
 
 class Investment(models.Model):
@@ -117,13 +372,9 @@ class Investment(models.Model):
         ('Buy', 'Buy'),
         ('Sell', 'Sell'),
     )
-    CURRENCY_CHOICES = (
-        ('USD', 'USD'),
-        ('EUR', 'EUR'),
-        ('CAD', 'CAD'),
-    )
+    CURRENCY_CHOICES = Holding.CURRENCY_CHOICES
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
     symbol = models.CharField(max_length=10)
     quantity = models.IntegerField()
     transaction_type = models.CharField(max_length=4, choices=TRANSACTION_CHOICES)
@@ -131,20 +382,26 @@ class Investment(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'date'], name='investment_portfolio_date_idx'),
+            models.Index(fields=['symbol'], name='investment_symbol_idx'),
+        ]
+
     def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.transaction_type == 'Buy':
+                Holding.update_quantity(self.portfolio, self.symbol, self.quantity, self.price, self.date, self.currency)
+            elif self.transaction_type == 'Sell':
+                try:
+                    Holding.update_quantity(self.portfolio, self.symbol, -self.quantity, self.price, self.date)
+                except ValueError as e:
+                    self.full_clean()
+                    raise ValidationError({'quantity': [str(e)]})
 
-        if self.transaction_type == 'Buy':
-            Holding.update_quantity(self.portfolio, self.symbol, self.quantity, self.price, self.date)
-        elif self.transaction_type == 'Sell':
-            try:
-                Holding.update_quantity(self.portfolio, self.symbol, -self.quantity, self.price, self.date)
-            except ValueError as e:
-                self.full_clean()
-                raise ValidationError({'quantity': [str(e)]})
-        
-        super().save(*args, **kwargs)
+            super().save(*args, **kwargs)
 
-        self.portfolio.update_performance()
+            mark_portfolio_dirty(self.portfolio_id)
 
 
 class CurrentPrice(models.Model):
@@ -155,9 +412,147 @@ class CurrentPrice(models.Model):
     def __str__(self):
         return f"{self.symbol}: {self.price}"
 
+    @classmethod
+    def store(cls, prices):
+        cls.objects.bulk_create(
+            [cls(symbol=symbol, price=price) for symbol, price in prices.items()],
+            update_conflicts=True,
+            unique_fields=['symbol'],
+            update_fields=['price', 'last_updated'],
+            batch_size=REVALUE_CHUNK_SIZE,
+        )
+
+
+class PriceHistory(models.Model):
+    symbol = models.CharField(max_length=10)
+    date = models.DateField()
+    open = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    high = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    low = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    close = models.DecimalField(max_digits=10, decimal_places=2)
+    volume = models.BigIntegerField(null=True)
+
+    class Meta:
+        unique_together = ['symbol', 'date']
+
+    def __str__(self):
+        return f"{self.symbol} {self.date}: {self.close}"
+
+    @classmethod
+    def store(cls, bars):
+        """Upsert daily bars given as a DataFrame with HISTORY_COLUMNS."""
+        bars = bars.dropna(subset=['close']).round({'open': 2, 'high': 2, 'low': 2, 'close': 2})
+        bars = bars.astype(object).where(bars.notna(), None)
+        cls.objects.bulk_create(
+            [
+                cls(symbol=symbol, date=day.date(), open=open, high=high, low=low, close=close, volume=volume)
+                for symbol, day, open, high, low, close, volume in bars[HISTORY_COLUMNS].itertuples(index=False)
+            ],
+            update_conflicts=True,
+            unique_fields=['symbol', 'date'],
+            update_fields=['open', 'high', 'low', 'close', 'volume'],
+            batch_size=1000,
+        )
+        return len(bars)
+
+    @classmethod
+    def missing_ranges(cls, starts, end):
+        """Group the date ranges not stored yet by range.
+
+        ``starts`` maps each symbol to the first date it is needed from. Only
+        the ranges before the first and after the last stored bar are
+        reported, so gaps left by holidays are never downloaded again.
+        """
+        stored = {
+            row['symbol']: (row['first'], row['last'])
+            for row in cls.objects.filter(symbol__in=list(starts)).values('symbol').annotate(
+                first=Min('date'), last=Max('date'),
+            )
+        }
+        ranges = defaultdict(list)
+        for symbol, start in starts.items():
+            if symbol not in stored:
+                wanted = [(start, end)]
+            else:
+                first, last = stored[symbol]
+                wanted = [(start, first - timedelta(days=1)), (last + timedelta(days=1), end)]
+            for range_start, range_end in wanted:
+                if range_start <= range_end and np.busday_count(range_start, range_end + timedelta(days=1)):
+                    ranges[(range_start, range_end)].append(symbol)
+        return dict(ranges)
+
+    @classmethod
+    def closes(cls, symbols, start, end):
+        """Closing prices as a date x symbol DataFrame."""
+        rows = cls.objects.filter(symbol__in=list(symbols), date__range=(start, end)).values_list('date', 'symbol', 'close')
+        bars = pd.DataFrame.from_records(list(rows), columns=['date', 'symbol', 'close'])
+        bars['date'] = pd.to_datetime(bars['date'])
+        bars['close'] = bars['close'].astype(float)
+        return bars.pivot_table(index='date', columns='symbol', values='close')
+
+
+class FxRate(models.Model):
+    """Daily exchange rate: how many ``base`` units one unit of ``currency`` buys."""
+    currency = models.CharField(max_length=3)
+    base = models.CharField(max_length=3)
+    date = models.DateField()
+    rate = models.DecimalField(max_digits=18, decimal_places=8)
+
+    class Meta:
+        unique_together = ['currency', 'base', 'date']
+
+    def __str__(self):
+        return f"{self.currency}/{self.base} {self.date}: {self.rate}"
+
+    @classmethod
+    def store(cls, rates, base, day):
+        cls.objects.bulk_create(
+            [cls(currency=currency, base=base, date=day, rate=rate) for currency, rate in rates.items()],
+            update_conflicts=True,
+            unique_fields=['currency', 'base', 'date'],
+            update_fields=['rate'],
+        )
+
+    @classmethod
+    def store_history(cls, bars, base):
+        """Upsert daily closes from a DataFrame with currency, date and close columns."""
+        bars = bars.dropna(subset=['currency', 'close'])
+        cls.objects.bulk_create(
+            [
+                cls(currency=currency, base=base, date=day.date(), rate=Decimal(str(round(close, 8))))
+                for currency, day, close in bars[['currency', 'date', 'close']].itertuples(index=False)
+            ],
+            update_conflicts=True,
+            unique_fields=['currency', 'base', 'date'],
+            update_fields=['rate'],
+            batch_size=1000,
+        )
+        return len(bars)
+
+    @classmethod
+    def current(cls, base):
+        """Latest ``{currency: rate}`` into ``base``, in one query."""
+        latest = cls.objects.filter(base=base, currency=OuterRef('currency')).order_by('-date').values('date')[:1]
+        return dict(cls.objects.filter(base=base, date=Subquery(latest)).values_list('currency', 'rate'))
+
+    @classmethod
+    def rate_on(cls, currency, base, day):
+        return cls.objects.filter(currency=currency, base=base, date__lte=day).order_by('-date').values_list('rate', flat=True).first()
+
+    @classmethod
+    def history(cls, currencies, base, start, end):
+        """Rates as a date x currency DataFrame, starting a little before ``start`` so it can be forward filled."""
+        rows = cls.objects.filter(
+            currency__in=list(currencies), base=base, date__range=(start - timedelta(days=10), end),
+        ).values_list('date', 'currency', 'rate')
+        rates = pd.DataFrame.from_records(list(rows), columns=['date', 'currency', 'rate'])
+        rates['date'] = pd.to_datetime(rates['date'])
+        rates['rate'] = rates['rate'].astype(float)
+        return rates.pivot_table(index='date', columns='currency', values='rate').reindex(columns=list(currencies))
+
 
 class MonthlyPerformance(models.Model):
-    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, db_index=False)
     value = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     capital_gain = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     performance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
@@ -166,4 +561,144 @@ class MonthlyPerformance(models.Model):
 
     class Meta:
         unique_together = ['portfolio', 'month', 'year']
+        indexes = [
+            models.Index(fields=['portfolio', 'year', 'month'], name='monthly_perf_period_idx'),
+        ]
+
+    @classmethod
+    def store(cls, history):
+        """Upsert rows from a DataFrame with portfolio, year, month and the value columns."""
+        history = history.round({'value': 2, 'capital_gain': 2, 'performance': 2})
+        cls.objects.bulk_create(
+            [
+                cls(portfolio_id=row.portfolio, year=row.year, month=row.month,
+                    value=Decimal(str(row.value)), capital_gain=Decimal(str(row.capital_gain)),
+                    performance=Decimal(str(row.performance)))
+                for row in history.itertuples(index=False)
+            ],
+            update_conflicts=True,
+            unique_fields=['portfolio', 'month', 'year'],
+            update_fields=['value', 'capital_gain', 'performance'],
+            batch_size=1000,
+        )
+        return len(history)
+
+    @classmethod
+    def snapshot(cls, month, year, batch_size=5000, shard=0, shards=1, portfolio_ids=None):
+        """Recompute the portfolios of one shard and save their values as that month's rows.
+
+        Portfolios are streamed in chunks of ``batch_size``; each chunk is
+        recomputed and written with a single upsert. Shards split the UUID
+        space evenly. ``portfolio_ids`` limits the snapshot to those
+        portfolios. Returns the number of portfolios and chunks.
+        """
+        portfolios = Portfolio.objects.order_by('id')
+        if portfolio_ids is not None:
+            portfolios = portfolios.filter(id__in=portfolio_ids)
+        if shard:
+            portfolios = portfolios.filter(id__gte=uuid.UUID(int=shard * 2 ** 128 // shards))
+        if shard < shards - 1:
+            portfolios = portfolios.filter(id__lt=uuid.UUID(int=(shard + 1) * 2 ** 128 // shards))
+        rows = portfolios.values_list('id', *Portfolio.PERFORMANCE_FIELDS).iterator(chunk_size=batch_size)
+
+        count = chunks = 0
+        for chunk in iter(lambda: list(islice(rows, batch_size)), []):
+            current = {portfolio_id: values for portfolio_id, *values in chunk}
+            for portfolio in Portfolio.bulk_update_performance(list(current)):
+                current[portfolio.id] = [getattr(portfolio, name) for name in Portfolio.PERFORMANCE_FIELDS]
+            Portfolio.touch(list(current))
+            cls.objects.bulk_create(
+                [
+                    cls(portfolio_id=portfolio_id, month=month, year=year,
+                        value=value, capital_gain=capital_gain, performance=performance)
+                    for portfolio_id, (value, capital_gain, performance) in current.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['portfolio', 'month', 'year'],
+                update_fields=['value', 'capital_gain', 'performance'],
+            )
+            count += len(chunk)
+            chunks += 1
+        return count, chunks
+
+
+
+class PriceRefreshJob(models.Model):
+    """A refresh of every traded symbol's price, run on the background worker pool.
+
+    At most one job is queued or running at a time: ``active`` is True only
+    while it is, and is unique.
+    """
+    QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default=QUEUED)
+    active = models.BooleanField(null=True, unique=True, default=True)
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    updated = models.IntegerField(default=0)
+    failed_symbols = models.JSONField(default=list)
+    portfolios = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"Price refresh {self.id}: {self.status}"
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return None
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+    @classmethod
+    def enqueue(cls):
+        """Start a refresh unless one is already queued or running; returns ``(job, created)``."""
+        # A worker that died mid-run never clears its job.
+        stale = timezone.now() - timedelta(seconds=getattr(settings, 'PRICE_REFRESH_STALE_AFTER', 3600))
+        cls.objects.filter(active=True, created_at__lt=stale).update(
+            status=cls.FAILED, active=None, error='Abandoned', finished_at=timezone.now(),
+        )
+        for _ in range(3):
+            try:
+                with transaction.atomic():
+                    job = cls.objects.create()
+            except IntegrityError:
+                job = cls.objects.filter(active=True).first()
+                if job is not None:
+                    return job, False
+                continue
+            transaction.on_commit(lambda: run_in_background(cls.run, job.id))
+            return job, True
+        raise RuntimeError("Could not enqueue a price refresh")
+
+    @classmethod
+    def run(cls, job_id):
+        jobs = cls.objects.filter(id=job_id)
+        jobs.update(status=cls.RUNNING, started_at=timezone.now())
+
+        def progress(result):
+            jobs.update(total=result.total, done=result.done)
 
+        try:
+            result, portfolio_ids = refresh_prices(progress=progress)
+        except Exception as e:
+            jobs.update(status=cls.FAILED, active=None, error=str(e), finished_at=timezone.now())
+            raise
+        jobs.update(
+            status=cls.SUCCEEDED,
+            active=None,
+            total=result.total,
+            done=result.done,
+            updated=len(result.prices),
+            failed_symbols=sorted(result.failed),
+            portfolios=len(portfolio_ids),
+            finished_at=timezone.now(),
+        )
@@ -0,0 +1,109 @@
+import json
+
+from django.db.models import F, Field, Func, Value
+from django.db.models.lookups import GreaterThan, LessThan
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.encoders import JSONEncoder
+
+
+STREAM_CHUNK_SIZE = 2000
+
+
+class Row(Func):
+    """A row value, ``(a, b, ...)``, for comparing several columns at once."""
+    template = '(%(expressions)s)'
+    output_field = Field()
+
+
+class PortfolioCursorPagination(CursorPagination):
+    """Cursor pagination keyed on every ordering field.
+
+    DRF only puts the first ordering field in the cursor and skips the rows
+    sharing it with an OFFSET. Here the position holds the values of the whole
+    ordering, which ends with a unique field and runs in one direction, and a
+    page starts with a row comparison such as ``(date, id) < (%s, %s)`` that
+    the matching index serves directly.
+    """
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def is_requested(self, request):
+        params = request.query_params
+        return self.cursor_query_param in params or self.page_size_query_param in params
+
+    def _get_position_from_instance(self, instance, ordering):
+        return json.dumps([str(getattr(instance, field.lstrip('-'))) for field in self.ordering])
+
+    def _after(self, queryset, position, reverse):
+        try:
+            values = json.loads(position)
+            names = [field.lstrip('-') for field in self.ordering]
+            fields = [queryset.model._meta.get_field(name) for name in names]
+            values = [Value(field.to_python(value), output_field=field) for field, value in zip(fields, values, strict=True)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+        descending = self.ordering[0].startswith('-')
+        lookup = LessThan if descending != reverse else GreaterThan
+        return queryset.filter(lookup(Row(*[F(name) for name in names]), Row(*values)))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # CursorPagination.paginate_queryset with the keyset filter; positions
+        # are unique, so the offset is always zero.
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse, current_position = (self.cursor.reverse, self.cursor.position) if self.cursor else (False, None)
+
+        queryset = queryset.order_by(*(self.reversed_ordering() if reverse else self.ordering))
+        if current_position is not None:
+            queryset = self._after(queryset, current_position, reverse)
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following_position = None
+        if len(results) > len(self.page):
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.next_position = current_position is not None, current_position
+            self.has_previous, self.previous_position = following_position is not None, following_position
+        else:
+            self.has_next, self.next_position = following_position is not None, following_position
+            self.has_previous, self.previous_position = current_position is not None, current_position
+        self.display_page_controls = self.has_previous or self.has_next
+        return self.page
+
+    def reversed_ordering(self):
+        return [field[1:] if field.startswith('-') else f'-{field}' for field in self.ordering]
+
+
+class InvestmentCursorPagination(PortfolioCursorPagination):
+    ordering = ('-date', '-id')
+
+
+class HoldingCursorPagination(PortfolioCursorPagination):
+    ordering = ('purchase_date', 'id')
+
+
+class PositionCursorPagination(PortfolioCursorPagination):
+    ordering = ('symbol', 'id')
+
+
+class MonthlyPerformanceCursorPagination(PortfolioCursorPagination):
+    ordering = ('year', 'month', 'id')
+
+
+def ndjson_response(queryset, serializer_class, chunk_size=STREAM_CHUNK_SIZE):
+    def rows():
+        for obj in queryset.iterator(chunk_size=chunk_size):
+            yield json.dumps(serializer_class(obj).data, cls=JSONEncoder) + '\n'
+
+    return StreamingHttpResponse(rows(), content_type='application/x-ndjson')
@@ -0,0 +1,204 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class PriceCache:
+    """Layered lookup of current prices.
+
+    A symbol is looked up in a per-process LRU, then in the shared Django
+    cache named by ``PRICE_CACHE_ALIAS`` (if any), then in ``CurrentPrice``
+    and finally with the quote provider. Concurrent misses for the same
+    symbol wait for a single fetch instead of each calling the provider.
+    """
+    key_prefix = 'price:'
+    COUNTERS = ('lookups', 'local_hits', 'shared_hits', 'db_hits', 'coalesced', 'misses', 'provider_fetches')
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.counters = Counter()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'PRICE_CACHE_TTL', 60)
+
+    @property
+    def maxsize(self):
+        return getattr(settings, 'PRICE_CACHE_SIZE', 10000)
+
+    @property
+    def lock_timeout(self):
+        return getattr(settings, 'PRICE_FETCH_TIMEOUT', 10)
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'PRICE_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def _get_local(self, symbol):
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is None:
+                return None
+            expires, price = entry
+            if expires < time.monotonic():
+                del self._entries[symbol]
+                return None
+            self._entries.move_to_end(symbol)
+            return price
+
+    def _set_local(self, symbol, price):
+        with self._lock:
+            self._entries[symbol] = (time.monotonic() + self.ttl, price)
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _wait_for_shared(self, shared, symbol):
+        # Another process holds the fetch lock for this symbol; give it a
+        # moment to publish the price before fetching ourselves.
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            price = shared.get(self.key_prefix + symbol)
+            if price is not None:
+                return price
+        return None
+
+    def _fetch(self, symbol):
+        from .models import CurrentPrice
+        from .utils import get_current_price
+
+        shared = self.shared
+        lock_key = f'{self.key_prefix}lock:{symbol}'
+        locked = shared is not None and shared.add(lock_key, 1, self.lock_timeout)
+        if shared is not None and not locked:
+            price = self._wait_for_shared(shared, symbol)
+            if price is not None:
+                self.counters['coalesced'] += 1
+                return price
+        try:
+            self.counters['provider_fetches'] += 1
+            price = get_current_price(symbol)
+            if price is not None:
+                CurrentPrice.store({symbol: price})
+            return price
+        finally:
+            # Only release the lock if it is ours; the holder may still be fetching.
+            if locked:
+                shared.delete(lock_key)
+
+    def _lookup(self, symbol, fetch):
+        shared = self.shared
+        if shared is not None:
+            price = shared.get(self.key_prefix + symbol)
+            if price is not None:
+                self.counters['shared_hits'] += 1
+                self._set_local(symbol, price)
+                return price
+
+        from .models import CurrentPrice
+
+        price = CurrentPrice.objects.filter(symbol=symbol).values_list('price', flat=True).first()
+        if price is not None:
+            self.counters['db_hits'] += 1
+        else:
+            self.counters['misses'] += 1
+            if fetch:
+                price = self._fetch(symbol)
+
+        if price is not None:
+            self.set_many({symbol: price})
+        return price
+
+    def get(self, symbol, fetch=True):
+        self.counters['lookups'] += 1
+        price = self._get_local(symbol)
+        if price is not None:
+            self.counters['local_hits'] += 1
+            return price
+
+        with self._lock:
+            flight = self._inflight.get(symbol)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[symbol] = threading.Event()
+
+        if not leader:
+            flight.wait()
+            price = self._get_local(symbol)
+            if price is not None:
+                self.counters['coalesced'] += 1
+                return price
+            return self._lookup(symbol, fetch)
+
+        try:
+            return self._lookup(symbol, fetch)
+        finally:
+            with self._lock:
+                del self._inflight[symbol]
+            flight.set()
+
+    def get_many(self, symbols):
+        """``{symbol: price}`` for the symbols with a known price, in at most one query.
+
+        Like ``get(symbol, fetch=False)`` for each symbol, without a lookup
+        per symbol and never calling the quote provider.
+        """
+        from .models import CurrentPrice
+
+        prices, missing = {}, []
+        for symbol in dict.fromkeys(symbols):
+            self.counters['lookups'] += 1
+            price = self._get_local(symbol)
+            if price is not None:
+                self.counters['local_hits'] += 1
+                prices[symbol] = price
+            else:
+                missing.append(symbol)
+
+        shared = self.shared
+        if shared is not None and missing:
+            found = {key[len(self.key_prefix):]: price for key, price in shared.get_many([self.key_prefix + symbol for symbol in missing]).items()}
+            self.counters['shared_hits'] += len(found)
+            for symbol, price in found.items():
+                self._set_local(symbol, price)
+            prices.update(found)
+            missing = [symbol for symbol in missing if symbol not in found]
+
+        if missing:
+            found = dict(CurrentPrice.objects.filter(symbol__in=missing).values_list('symbol', 'price'))
+            self.counters['db_hits'] += len(found)
+            self.counters['misses'] += len(missing) - len(found)
+            self.set_many(found)
+            prices.update(found)
+        return prices
+
+    def set_many(self, prices):
+        for symbol, price in prices.items():
+            self._set_local(symbol, price)
+        shared = self.shared
+        if shared is not None and prices:
+            shared.set_many({self.key_prefix + symbol: price for symbol, price in prices.items()}, self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.counters.clear()
+
+    def stats(self):
+        hits = sum(self.counters[name] for name in ('local_hits', 'shared_hits', 'db_hits', 'coalesced'))
+        lookups = self.counters['lookups']
+        return {
+            **{name: self.counters[name] for name in self.COUNTERS},
+            'size': len(self._entries),
+            'hit_ratio': hits / lookups if lookups else 0.0,
+        }
+
+
+price_cache = PriceCache()
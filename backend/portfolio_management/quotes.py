@@ -0,0 +1,598 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from decimal import Decimal
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from core.profiling import record_provider_call
+
+
+logger = logging.getLogger(__name__)
+
+PRICE_QUANTUM = Decimal('0.01')
+HISTORY_COLUMNS = ['symbol', 'date', 'open', 'high', 'low', 'close', 'volume']
+
+
+def to_price(value):
+    return Decimal(str(value)).quantize(PRICE_QUANTUM)
+
+
+class QuoteProvider:
+    """Source of latest and historical prices.
+
+    ``fetch`` receives a batch of symbols and returns a ``{symbol: Decimal}``
+    dict; symbols the provider has no quote for are simply left out.
+    ``history`` returns daily bars between two dates (inclusive) as a long
+    DataFrame with ``HISTORY_COLUMNS``. The async variants run the blocking
+    ones on a worker thread unless a provider has a native implementation.
+    Providers never touch the database.
+    """
+    max_batch_size = 100
+
+    def fetch(self, symbols, timeout=None):
+        raise NotImplementedError
+
+    def history(self, symbols, start, end, timeout=None):
+        raise NotImplementedError
+
+    async def afetch(self, symbols, timeout=None):
+        return await asyncio.to_thread(self.fetch, symbols, timeout)
+
+    async def ahistory(self, symbols, start, end, timeout=None):
+        return await asyncio.to_thread(self.history, symbols, start, end, timeout)
+
+
+class YFinanceProvider(QuoteProvider):
+    # A few days of history so symbols that did not trade today still resolve
+    # to their last close.
+    period = '5d'
+
+    def fetch(self, symbols, timeout=None):
+        symbols = list(symbols)
+        data = yf.download(
+            tickers=symbols,
+            period=self.period,
+            group_by='ticker',
+            auto_adjust=False,
+            threads=False,
+            progress=False,
+            timeout=timeout or 10,
+        )
+        prices = {}
+        for symbol in symbols if data is not None and not data.empty else []:
+            if isinstance(data.columns, pd.MultiIndex):
+                if symbol not in data.columns.get_level_values(0):
+                    continue
+                closes = data[symbol]['Close']
+            else:
+                closes = data['Close']
+            closes = closes.dropna()
+            if not closes.empty:
+                prices[symbol] = to_price(closes.iloc[-1])
+        if symbols and not prices and not self.unknown_symbol(symbols):
+            # yfinance reports outages as an empty or all-NaN frame instead of
+            # raising; fail so the breaker counts it and nothing is negative cached.
+            raise ProviderError(f"Yahoo Finance returned no quotes for {len(symbols)} symbols")
+        return prices
+
+    def unknown_symbol(self, symbols):
+        # A lone symbol yfinance reports as missing ("possibly delisted") is
+        # unknown rather than a sign of an outage. A whole batch coming back
+        # missing is not believed, since failed lookups are reported the same way.
+        errors = getattr(yf.shared, '_ERRORS', {})
+        return len(symbols) == 1 and 'possibly delisted' in errors.get(symbols[0].upper(), '')
+
+    def history(self, symbols, start, end, timeout=None):
+        symbols = list(symbols)
+        data = yf.download(
+            tickers=symbols,
+            start=start,
+            end=end + timedelta(days=1),
+            group_by='ticker',
+            auto_adjust=False,
+            threads=False,
+            progress=False,
+            timeout=timeout or 10,
+        )
+        if data is None or data.empty:
+            return pd.DataFrame(columns=HISTORY_COLUMNS)
+        if not isinstance(data.columns, pd.MultiIndex):
+            data = pd.concat({symbols[0]: data}, axis=1)
+        bars = data.stack(level=0, future_stack=True).rename_axis(['date', 'symbol']).reset_index()
+        bars = bars.rename(columns=str.lower).dropna(subset=['close'])
+        bars['date'] = pd.to_datetime(bars['date']).dt.tz_localize(None).dt.normalize()
+        return bars.reindex(columns=HISTORY_COLUMNS)
+
+
+class FakeQuoteProvider(QuoteProvider):
+    """Deterministic offline provider for tests and benchmarks.
+
+    Symbols listed in ``prices`` get that price, symbols in ``missing`` are
+    never quoted and every other symbol gets a stable price derived from its
+    name.
+    """
+
+    def __init__(self, prices=None, missing=(), latency=0):
+        self.prices = {symbol: to_price(price) for symbol, price in (prices or {}).items()}
+        self.missing = set(missing)
+        self.latency = latency
+        self.calls = 0
+
+    def quote(self, symbol):
+        if symbol in self.prices:
+            return self.prices[symbol]
+        return to_price(10 + zlib.crc32(symbol.encode()) % 50000 / 100)
+
+    def quotes(self, symbols):
+        return {symbol: self.quote(symbol) for symbol in symbols if symbol not in self.missing}
+
+    def fetch(self, symbols, timeout=None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.quotes(symbols)
+
+    async def afetch(self, symbols, timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.quotes(symbols)
+
+    # Every symbol follows its own seeded random walk from a fixed epoch, so a
+    # given day always has the same bar whatever range is requested.
+    epoch = date(2000, 1, 3)
+
+    def history(self, symbols, start, end, timeout=None):
+        self.calls += 1
+        days = pd.bdate_range(self.epoch, end)
+        frames = []
+        for symbol in symbols:
+            if symbol in self.missing:
+                continue
+            rng = np.random.default_rng(zlib.crc32(symbol.encode()))
+            close = float(self.quote(symbol)) * np.exp(np.cumsum(rng.normal(0, 0.01, len(days))))
+            opens = close * (1 + rng.normal(0, 0.005, len(days)))
+            spread = 1 + np.abs(rng.normal(0, 0.005, len(days)))
+            frames.append(pd.DataFrame({
+                'symbol': symbol,
+                'date': days,
+                'open': opens,
+                'high': np.maximum(opens, close) * spread,
+                'low': np.minimum(opens, close) / spread,
+                'close': close,
+                'volume': rng.integers(10_000, 1_000_000, len(days)),
+            }))
+        if not frames:
+            return pd.DataFrame(columns=HISTORY_COLUMNS)
+        bars = pd.concat(frames, ignore_index=True)
+        return bars[bars['date'] >= pd.Timestamp(start)].round({'open': 2, 'high': 2, 'low': 2, 'close': 2})
+
+
+class ProviderUnavailable(Exception):
+    """The provider was not called because its circuit is open or it is rate limited."""
+
+
+class ProviderError(Exception):
+    """The provider was called but failed to answer, without raising an error of its own."""
+
+
+class TokenBucket:
+    """Allows ``rate`` calls per second on average, in bursts of up to ``capacity``."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        # Takes a token if one is available, otherwise returns how long until
+        # the next one is.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def _delays(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self._take()
+            if not delay:
+                return
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise ProviderUnavailable('Rate limit exceeded')
+            yield delay
+
+    def acquire(self, timeout=None):
+        for delay in self._delays(timeout):
+            time.sleep(delay)
+
+    async def aacquire(self, timeout=None):
+        for delay in self._delays(timeout):
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Stops calling a provider after ``threshold`` consecutive failures.
+
+    Once ``reset_timeout`` seconds have passed a single trial call is let
+    through: if it succeeds the circuit closes, if it fails it stays open for
+    another ``reset_timeout``.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'half_open':
+                self.trial = True
+            return state != 'open'
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+class NegativeCache:
+    """Symbols a provider had no quote for, skipped until ``ttl`` seconds pass."""
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, symbol):
+        expires = self._expires.get(symbol)
+        return expires is not None and expires > time.monotonic()
+
+    def add(self, symbols):
+        with self._lock:
+            now = time.monotonic()
+            if len(self._expires) >= self.maxsize:
+                self._expires = {symbol: expires for symbol, expires in self._expires.items() if expires > now}
+            for symbol in symbols:
+                if len(self._expires) < self.maxsize:
+                    self._expires[symbol] = now + self.ttl
+
+
+class GuardedProvider(QuoteProvider):
+    """Wraps a provider with a rate limiter, a circuit breaker and a negative cache.
+
+    Calls that would wait for the rate limiter longer than their timeout, and
+    every call while the circuit is open, raise ``ProviderUnavailable``
+    without reaching the provider. Symbols the provider answers without a
+    quote are not requested again for ``negative_ttl`` seconds.
+    """
+
+    def __init__(self, provider, limiter=None, breaker=None, negative_ttl=0):
+        self.provider = provider
+        self.limiter = limiter
+        self.breaker = breaker or CircuitBreaker()
+        self.negative = NegativeCache(negative_ttl) if negative_ttl else None
+
+    @property
+    def max_batch_size(self):
+        return self.provider.max_batch_size
+
+    def __str__(self):
+        return type(self.provider).__name__
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            raise ProviderUnavailable(f'{self} circuit is open')
+
+    def _unknown(self, symbols):
+        symbols = list(symbols)
+        if self.negative is None:
+            return symbols
+        return [symbol for symbol in symbols if symbol not in self.negative]
+
+    def _settle(self, symbols, prices):
+        if self.negative is not None:
+            self.negative.add(symbol for symbol in symbols if symbol not in prices)
+        return prices
+
+    def _call(self, method, *args, timeout=None):
+        if self.limiter:
+            self.limiter.acquire(timeout)
+        self._check_breaker()
+        started = time.perf_counter()
+        try:
+            result = method(*args, timeout=timeout)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            record_provider_call(time.perf_counter() - started)
+        self.breaker.record_success()
+        return result
+
+    async def _acall(self, method, *args, timeout=None):
+        if self.limiter:
+            await self.limiter.aacquire(timeout)
+        self._check_breaker()
+        started = time.perf_counter()
+        try:
+            result = await method(*args, timeout=timeout)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            record_provider_call(time.perf_counter() - started)
+        self.breaker.record_success()
+        return result
+
+    def fetch(self, symbols, timeout=None):
+        symbols = self._unknown(symbols)
+        if not symbols:
+            return {}
+        return self._settle(symbols, self._call(self.provider.fetch, symbols, timeout=timeout))
+
+    async def afetch(self, symbols, timeout=None):
+        symbols = self._unknown(symbols)
+        if not symbols:
+            return {}
+        return self._settle(symbols, await self._acall(self.provider.afetch, symbols, timeout=timeout))
+
+    def history(self, symbols, start, end, timeout=None):
+        return self._call(self.provider.history, symbols, start, end, timeout=timeout)
+
+    async def ahistory(self, symbols, start, end, timeout=None):
+        return await self._acall(self.provider.ahistory, symbols, start, end, timeout=timeout)
+
+
+class FailoverProvider(QuoteProvider):
+    """Asks each provider in turn for the symbols the previous ones did not quote.
+
+    A provider that raises is skipped; the error is only raised when every
+    provider failed.
+    """
+
+    def __init__(self, providers):
+        self.providers = list(providers)
+
+    @property
+    def max_batch_size(self):
+        return min(provider.max_batch_size for provider in self.providers)
+
+    def _failed(self, provider, error):
+        logger.warning("Quote provider %s failed: %s", provider, error)
+
+    def fetch(self, symbols, timeout=None):
+        remaining, prices, error = list(symbols), {}, None
+        for provider in self.providers:
+            try:
+                prices.update(provider.fetch(remaining, timeout))
+            except Exception as e:
+                self._failed(provider, e)
+                error = e
+                continue
+            error = None
+            remaining = [symbol for symbol in remaining if symbol not in prices]
+            if not remaining:
+                break
+        if error is not None and not prices:
+            raise error
+        return prices
+
+    async def afetch(self, symbols, timeout=None):
+        remaining, prices, error = list(symbols), {}, None
+        for provider in self.providers:
+            try:
+                prices.update(await provider.afetch(remaining, timeout))
+            except Exception as e:
+                self._failed(provider, e)
+                error = e
+                continue
+            error = None
+            remaining = [symbol for symbol in remaining if symbol not in prices]
+            if not remaining:
+                break
+        if error is not None and not prices:
+            raise error
+        return prices
+
+    def history(self, symbols, start, end, timeout=None):
+        bars, error = None, None
+        for provider in self.providers:
+            try:
+                bars = provider.history(symbols, start, end, timeout)
+            except Exception as e:
+                self._failed(provider, e)
+                error = e
+                continue
+            if not bars.empty:
+                return bars
+        if bars is None:
+            raise error
+        return bars
+
+    async def ahistory(self, symbols, start, end, timeout=None):
+        bars, error = None, None
+        for provider in self.providers:
+            try:
+                bars = await provider.ahistory(symbols, start, end, timeout)
+            except Exception as e:
+                self._failed(provider, e)
+                error = e
+                continue
+            if not bars.empty:
+                return bars
+        if bars is None:
+            raise error
+        return bars
+
+
+def guard_provider(provider):
+    rate = getattr(settings, 'QUOTE_RATE_LIMIT', 0)
+    return GuardedProvider(
+        provider,
+        limiter=TokenBucket(rate, getattr(settings, 'QUOTE_RATE_BURST', None)) if rate else None,
+        breaker=CircuitBreaker(
+            getattr(settings, 'QUOTE_BREAKER_THRESHOLD', 5),
+            getattr(settings, 'QUOTE_BREAKER_RESET', 30),
+        ),
+        negative_ttl=getattr(settings, 'QUOTE_NEGATIVE_TTL', 0),
+    )
+
+
+@lru_cache(maxsize=None)
+def _load_provider(paths):
+    providers = [guard_provider(import_string(path)()) for path in paths]
+    return providers[0] if len(providers) == 1 else FailoverProvider(providers)
+
+
+def get_quote_provider():
+    paths = getattr(settings, 'QUOTE_PROVIDER', 'portfolio_management.quotes.YFinanceProvider')
+    if isinstance(paths, str):
+        paths = paths.split(',')
+    return _load_provider(tuple(path.strip() for path in paths if path.strip()))
+
+
+@dataclass
+class FetchResult:
+    total: int = 0
+    prices: dict = field(default_factory=dict)
+    failed: list = field(default_factory=list)
+    batches: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def done(self):
+        return len(self.prices) + len(self.failed)
+
+
+class PriceFetcher:
+    """Fetches prices for many symbols in concurrent multi-symbol batches.
+
+    Each batch attempt runs on a bounded thread pool and is abandoned once it
+    has been running for more than ``timeout`` seconds; failed or timed out batches are retried up to
+    ``retries`` times before their symbols are reported as failed.
+    """
+
+    def __init__(self, provider=None, batch_size=None, workers=None, timeout=None, retries=None, backoff=0.5):
+        self.provider = provider or get_quote_provider()
+        self.batch_size = min(
+            batch_size or getattr(settings, 'PRICE_FETCH_BATCH_SIZE', 100),
+            self.provider.max_batch_size,
+        )
+        self.workers = workers or getattr(settings, 'PRICE_FETCH_WORKERS', 4)
+        self.timeout = timeout or getattr(settings, 'PRICE_FETCH_TIMEOUT', 10)
+        self.retries = getattr(settings, 'PRICE_FETCH_RETRIES', 2) if retries is None else retries
+        self.backoff = backoff
+
+    def batches(self, symbols):
+        symbols = list(symbols)
+        return [symbols[i:i + self.batch_size] for i in range(0, len(symbols), self.batch_size)]
+
+    def _attempt(self, batch, attempt, began):
+        began.append(time.monotonic())
+        if attempt:
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+        return self.provider.fetch(batch, timeout=self.timeout)
+
+    def fetch(self, symbols, progress=None):
+        started = time.monotonic()
+        batches = self.batches(dict.fromkeys(symbols))
+        result = FetchResult(total=sum(len(batch) for batch in batches), batches=len(batches))
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='price-fetch')
+        pending = {}
+
+        def submit(batch, attempt):
+            # Carry the caller's context so provider calls count towards its profile.
+            # The deadline only starts once a worker picks the batch up, so
+            # batches queued behind busy workers are not timed out unstarted.
+            began = []
+            future = executor.submit(contextvars.copy_context().run, self._attempt, batch, attempt, began)
+            pending[future] = (batch, attempt, began)
+
+        def deadline(attempt, began):
+            if not began:
+                return None
+            return began[0] + self.timeout + (self.backoff * 2 ** (attempt - 1) if attempt else 0)
+
+        def settle(batch, attempt, prices):
+            if prices is None and attempt < self.retries:
+                result.retries += 1
+                submit(batch, attempt + 1)
+                return
+            prices = prices or {}
+            result.prices.update(prices)
+            result.failed.extend(symbol for symbol in batch if symbol not in prices)
+            if progress:
+                progress(result)
+
+        try:
+            for batch in batches:
+                submit(batch, 0)
+            while pending:
+                # Unstarted batches have no deadline yet; poll at most once per
+                # timeout so batches that start meanwhile are still checked.
+                deadlines = [deadline(attempt, began) for _, attempt, began in pending.values()]
+                next_deadline = min((d for d in deadlines if d is not None), default=time.monotonic() + self.timeout)
+                finished, _ = wait(pending, timeout=max(min(next_deadline - time.monotonic(), self.timeout), 0), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch, attempt, _ = pending.pop(future)
+                    try:
+                        prices = future.result()
+                    except Exception as e:
+                        logger.warning("Price fetch failed for %s: %s", ', '.join(batch), e)
+                        prices = None
+                    settle(batch, attempt, prices)
+                now = time.monotonic()
+                for future, (batch, attempt, began) in list(pending.items()):
+                    expires = deadline(attempt, began)
+                    if expires is not None and expires <= now and not future.done():
+                        future.cancel()
+                        del pending[future]
+                        result.timeouts += 1
+                        settle(batch, attempt, None)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        result.elapsed = time.monotonic() - started
+        return result
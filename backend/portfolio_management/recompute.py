@@ -0,0 +1,70 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+_local = threading.local()
+
+
+def recompute_portfolios(portfolio_ids):
+    from .models import Portfolio
+
+    Portfolio.bulk_update_performance(portfolio_ids)
+    Portfolio.touch(portfolio_ids)
+
+
+def _batches():
+    if not hasattr(_local, 'batches'):
+        _local.batches = []
+    return _local.batches
+
+
+class DirtyPortfolios:
+    """on_commit callback recomputing every portfolio marked in the transaction."""
+
+    def __init__(self):
+        self.portfolio_ids = set()
+
+    def __call__(self):
+        recompute_portfolios(self.portfolio_ids)
+
+
+def mark_portfolio_dirty(portfolio_id):
+    """Schedule a recompute of the portfolio's totals.
+
+    Inside ``deferred_portfolio_updates`` the recompute happens when the
+    outermost block exits, inside a transaction it happens once on commit and
+    otherwise it happens immediately.
+    """
+    batches = _batches()
+    if batches:
+        batches[-1].add(portfolio_id)
+        return
+
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        recompute_portfolios([portfolio_id])
+        return
+
+    # A rollback discards the callback together with the ids it collected.
+    dirty = next((callback for _, callback, *_ in connection.run_on_commit if isinstance(callback, DirtyPortfolios)), None)
+    if dirty is None:
+        dirty = DirtyPortfolios()
+        transaction.on_commit(dirty)
+    dirty.portfolio_ids.add(portfolio_id)
+
+
+@contextmanager
+def deferred_portfolio_updates():
+    batches = _batches()
+    batch = set()
+    batches.append(batch)
+    try:
+        yield batch
+    finally:
+        batches.pop()
+    if batches:
+        batches[-1].update(batch)
+    elif batch:
+        recompute_portfolios(batch)
@@ -1,10 +1,20 @@
 from rest_framework import serializers
-from .models import Portfolio, Investment, Holding, MonthlyPerformance
+from .models import Portfolio, Investment, Holding, MonthlyPerformance, Position, PriceRefreshJob
 
 class HoldingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Holding
-        fields = ['symbol', 'quantity', 'purchase_price', 'purchase_date', 'current_price', 'performance', 'capital_gain']
+        fields = ['symbol', 'currency', 'quantity', 'purchase_price', 'purchase_date', 'current_price', 'performance', 'capital_gain', 'price_pending']
+
+class PositionSerializer(serializers.ModelSerializer):
+    average_cost = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    current_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    market_value = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+    capital_gain = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = Position
+        fields = ['symbol', 'quantity', 'cost_basis', 'average_cost', 'current_price', 'market_value', 'capital_gain']
 
 class PortfolioSerializer(serializers.ModelSerializer):
 
@@ -33,3 +43,19 @@ class MonthlyPerformanceSerializer(serializers.ModelSerializer):
         model = MonthlyPerformance
         fields = ['id', 'portfolio', 'value', 'capital_gain', 'performance', 'month', 'year']
         read_only_fields = fields
+
+class DashboardPortfolioSerializer(PortfolioSerializer):
+    positions = PositionSerializer(many=True, read_only=True)
+    monthly_performance = MonthlyPerformanceSerializer(many=True, read_only=True, source='recent_performance')
+
+    class Meta(PortfolioSerializer.Meta):
+        fields = PortfolioSerializer.Meta.fields + ['positions', 'monthly_performance']
+
+class PriceRefreshJobSerializer(serializers.ModelSerializer):
+    duration = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = PriceRefreshJob
+        fields = ['id', 'status', 'total', 'done', 'updated', 'failed_symbols', 'portfolios', 'error',
+                  'created_at', 'started_at', 'finished_at', 'duration']
+        read_only_fields = fields
@@ -1,6 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Portfolio, MonthlyPerformance
+from .dashboard import invalidate_dashboards
+from .models import Portfolio, Investment, MonthlyPerformance
+from .recompute import mark_portfolio_dirty
 from decimal import Decimal
 from datetime import datetime
 
@@ -17,4 +19,15 @@ def create_monthly_performance(sender, instance, created, **kwargs):
             performance=Decimal('0'),
             month=month,
             year=year
-        )
\ No newline at end of file
+        )
+
+
+@receiver(post_save, sender=Portfolio)
+@receiver(post_delete, sender=Portfolio)
+def invalidate_dashboard(sender, instance, **kwargs):
+    invalidate_dashboards([instance.user_id])
+
+
+@receiver(post_delete, sender=Investment)
+def investment_deleted(sender, instance, **kwargs):
+    mark_portfolio_dirty(instance.portfolio_id)
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+
+def user_group(user_id):
+    return f'user:{user_id}'
+
+
+class Subscription:
+    """One listener's queue, fed from any thread through its event loop."""
+
+    def __init__(self, group, loop):
+        self.group = group
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class InMemoryChannelLayer:
+    """Process-local groups of subscriptions.
+
+    Messages only reach listeners in the same process; a layer backed by a
+    shared broker can be swapped in with ``PRICE_STREAM_LAYER`` as long as it
+    offers the same methods.
+    """
+
+    def __init__(self):
+        self._groups = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, group, loop=None):
+        subscription = Subscription(group, loop or asyncio.get_running_loop())
+        with self._lock:
+            self._groups[group].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._groups.get(subscription.group)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._groups[subscription.group]
+
+    def groups(self):
+        """Groups with at least one listener, or None if the layer cannot tell."""
+        with self._lock:
+            return set(self._groups)
+
+    def group_send_many(self, messages):
+        """Deliver ``{group: message}``, one message per group."""
+        with self._lock:
+            targets = [(subscription, message) for group, message in messages.items()
+                       for subscription in self._groups.get(group, ())]
+        for subscription, message in targets:
+            subscription.put(message)
+
+
+@lru_cache(maxsize=None)
+def _load_layer(path):
+    return import_string(path)()
+
+
+def get_channel_layer():
+    return _load_layer(getattr(settings, 'PRICE_STREAM_LAYER', 'portfolio_management.streaming.InMemoryChannelLayer'))
+
+
+class PriceUpdates:
+    """Portfolio values before a price update, published as per-user deltas after it."""
+
+    def __init__(self, layer, prices, rows):
+        self.layer = layer
+        self.prices = prices
+        self.rows = rows
+
+    @classmethod
+    def capture(cls, prices):
+        from .models import Holding
+
+        layer = get_channel_layer()
+        groups = layer.groups()
+        if not prices or groups == set():
+            return None
+        holdings = Holding.objects.filter(symbol__in=list(prices))
+        if groups is not None:
+            holdings = holdings.filter(portfolio__user_id__in=[group.split(':', 1)[1] for group in groups])
+        rows = list(holdings.order_by().values_list(
+            'portfolio_id', 'portfolio__user_id', 'symbol', 'portfolio__current_value',
+        ).distinct())
+        return cls(layer, prices, rows) if rows else None
+
+    def publish(self):
+        from .models import Portfolio
+
+        before = {portfolio_id: value for portfolio_id, _, _, value in self.rows}
+        after = Portfolio.objects.filter(id__in=before).values_list('id', 'user_id', *Portfolio.PERFORMANCE_FIELDS)
+        symbols = defaultdict(set)
+        for portfolio_id, _, symbol, _ in self.rows:
+            symbols[portfolio_id].add(symbol)
+
+        messages = {}
+        for portfolio_id, user_id, current_value, capital_gain, performance in after:
+            message = messages.setdefault(user_group(user_id), {'type': 'prices', 'prices': {}, 'portfolios': []})
+            message['prices'].update({symbol: self.prices[symbol] for symbol in symbols[portfolio_id]})
+            message['portfolios'].append({
+                'id': portfolio_id,
+                'current_value': current_value,
+                'change': current_value - before[portfolio_id],
+                'capital_gain': capital_gain,
+                'performance': performance,
+            })
+        self.layer.group_send_many(messages)
+
+
+def sse_event(message):
+    data = json.dumps(message, cls=DjangoJSONEncoder)
+    return f"event: {message['type']}\ndata: {data}\n\n"
@@ -0,0 +1,125 @@
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+
+import numpy as np
+from users.models import CustomUser
+
+from .backfill import backfill_price_history, store_prices
+from .importer import IMPORT_CHUNK_SIZE, InvestmentImporter
+from .models import CurrentPrice, Portfolio, PriceHistory
+from .quotes import FakeQuoteProvider
+
+
+DISTRIBUTIONS = ['uniform', 'zipf']
+
+
+@dataclass
+class SyntheticData:
+    prefix: str
+    users: list = field(default_factory=list)
+    portfolios: list = field(default_factory=list)
+    symbols: list = field(default_factory=list)
+    trades: int = 0
+    elapsed: float = 0.0
+
+
+def symbol_names(prefix, count):
+    return [f'{prefix}{i:04d}' for i in range(count)]
+
+
+def symbol_weights(count, distribution='zipf', skew=1.1):
+    """Share of the trades going to each symbol; with zipf a few symbols get most of them."""
+    if distribution == 'uniform':
+        weights = np.ones(count)
+    elif distribution == 'zipf':
+        weights = 1 / np.arange(1, count + 1) ** skew
+    else:
+        raise ValueError(f"Unknown distribution {distribution}")
+    return weights / weights.sum()
+
+
+def trade_rows(portfolio_ids, symbols, trades, rng, distribution='zipf', skew=1.1, sell_ratio=0.2,
+               start=date(2020, 1, 1), days=1500, provider=None):
+    """Yield investment import rows in date order.
+
+    Trades go to uniformly chosen portfolios and to symbols drawn from
+    ``distribution``. A trade on a position already held is a sell with
+    probability ``sell_ratio`` and never sells more than is held, so every
+    row imports. Prices scatter around the provider's quote.
+    """
+    provider = provider or FakeQuoteProvider()
+    quotes = np.array([float(provider.quote(symbol)) for symbol in symbols])
+    portfolio_picks = rng.integers(0, len(portfolio_ids), trades)
+    symbol_picks = rng.choice(len(symbols), trades, p=symbol_weights(len(symbols), distribution, skew))
+    offsets = np.sort(rng.integers(0, days, trades))
+    quantities = rng.integers(1, 100, trades)
+    sells = rng.random(trades) < sell_ratio
+    prices = np.round(quotes[symbol_picks] * np.exp(rng.normal(0, 0.1, trades)), 2)
+
+    held = defaultdict(int)
+    for portfolio, symbol, offset, quantity, sell, price in zip(portfolio_picks, symbol_picks, offsets, quantities, sells, prices):
+        key = (portfolio, symbol)
+        sell = sell and held[key] > 0
+        quantity = min(int(quantity), held[key]) if sell else int(quantity)
+        held[key] += -quantity if sell else quantity
+        yield {
+            'portfolio': portfolio_ids[portfolio],
+            'symbol': symbols[symbol],
+            'quantity': quantity,
+            'transaction_type': 'Sell' if sell else 'Buy',
+            'date': (start + timedelta(days=int(offset))).isoformat(),
+            'price': f'{price:.2f}',
+            'currency': 'USD',
+        }
+
+
+def generate(users=10, portfolios=50, trades=10_000, symbols=100, distribution='zipf', skew=1.1, sell_ratio=0.2,
+             start=date(2020, 1, 1), days=1500, seed=0, prefix='synthetic', symbol_prefix='SYN',
+             chunk_size=IMPORT_CHUNK_SIZE, history=False, provider=None):
+    """Create users, portfolios and trades through the bulk importer, then price them with ``provider``.
+
+    Users are named ``<prefix>-<n>`` and own the portfolios in turn.
+    Everything generated can be removed again with ``delete_synthetic``.
+    """
+    started = time.monotonic()
+    rng = np.random.default_rng(seed)
+    provider = provider or FakeQuoteProvider()
+    data = SyntheticData(prefix=prefix, symbols=symbol_names(symbol_prefix, symbols))
+
+    accounts = []
+    for number in range(users):
+        user = CustomUser(username=f'{prefix}-{number}')
+        user.set_unusable_password()
+        accounts.append(user)
+    data.users = CustomUser.objects.bulk_create(accounts)
+    data.portfolios = Portfolio.objects.bulk_create(
+        Portfolio(user=data.users[number % users], name=f'{prefix} portfolio {number}') for number in range(portfolios)
+    )
+
+    rows = trade_rows(
+        [str(portfolio.id) for portfolio in data.portfolios], data.symbols, trades, rng,
+        distribution=distribution, skew=skew, sell_ratio=sell_ratio, start=start, days=days, provider=provider,
+    )
+    result = InvestmentImporter(chunk_size=chunk_size, atomic=False).run(rows)
+    if result.errors:
+        raise ValueError(f"Synthetic import failed: {result.errors[0]['error']}")
+    data.trades = result.rows
+
+    if history:
+        backfill_price_history(dict.fromkeys(data.symbols, start), date.today(), provider=provider)
+    store_prices(provider.fetch(data.symbols))
+    data.elapsed = time.monotonic() - started
+    return data
+
+
+def delete_synthetic(prefix='synthetic', symbol_prefix='SYN'):
+    """Remove the users generated with ``prefix`` (with everything they own) and the prices of the synthetic symbols."""
+    deleted, _ = CustomUser.objects.filter(username__startswith=f'{prefix}-').delete()
+    # Only names symbol_names could have produced, never real tickers sharing the prefix.
+    generated = rf'^{re.escape(symbol_prefix)}[0-9]{{4,}}$'
+    CurrentPrice.objects.filter(symbol__regex=generated).delete()
+    PriceHistory.objects.filter(symbol__regex=generated).delete()
+    return deleted
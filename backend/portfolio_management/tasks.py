@@ -0,0 +1,52 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'BACKGROUND_WORKERS', 2),
+                thread_name_prefix='background-task',
+            )
+        return _executor
+
+
+def _run(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(fn, '__qualname__', fn))
+        raise
+    finally:
+        # Connections are per thread; don't leave this worker's open.
+        connections.close_all()
+
+
+def run_in_background(fn, *args, **kwargs):
+    """Run ``fn`` on the in-process worker pool and return its Future.
+
+    With ``BACKGROUND_TASKS_EAGER`` the function runs inline instead, which
+    keeps tests on the test database connection.
+    """
+    if not getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        return get_executor().submit(_run, fn, args, kwargs)
+
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        logger.exception("Background task %s failed", getattr(fn, '__qualname__', fn))
+        future.set_exception(e)
+    return future
@@ -1,8 +1,44 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import date, timedelta
+from io import StringIO
+from decimal import Decimal
+from unittest import mock
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from core.db_routers import ReplicaRouter, replica_routing, sticky_cache
+from core.profiling import metrics, profile
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from django.contrib import admin
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework.test import APIClient
 from users.models import CustomUser
-from .models import Portfolio, Holding, Investment, CurrentPrice, MonthlyPerformance
+from .admin import HoldingAdmin
+from .models import Portfolio, Holding, Investment, CurrentPrice, MonthlyPerformance, PriceHistory, Position, PriceRefreshJob, FxRate
+from .fx import conversion, fx_cache, refresh_fx_rates
+from .quotes import CircuitBreaker, FailoverProvider, FakeQuoteProvider, GuardedProvider, PriceFetcher, ProviderError, ProviderUnavailable, TokenBucket, YFinanceProvider, get_quote_provider
+from .utils import get_current_price
+from .recompute import deferred_portfolio_updates
+from .price_cache import PriceCache, price_cache
+from .models import get_current_price_for_symbol
+from .backfill import PriceBackfillQueue, backfill_price_history, history_backfill, store_prices
+from .streaming import get_channel_layer, user_group
+from rest_framework_simplejwt.tokens import RefreshToken
+from .importer import InvestmentImporter
+from .synthetic import delete_synthetic, generate
+from .analytics import backfill_monthly_performance, portfolio_analytics
+from .dashboard import build_dashboard, dashboard_cache, invalidate_portfolio_dashboards
+import pandas as pd
+
+FAKE_PROVIDER = 'portfolio_management.quotes.FakeQuoteProvider'
 
 class PortfolioTestCase(TestCase):
     def setUp(self):
@@ -26,7 +62,43 @@ class PortfolioTestCase(TestCase):
         self.assertEqual(self.portfolio.performance, 10)
         self.assertEqual(self.portfolio.current_value, 1100)
 
+    def test_update_performance_single_query_and_write(self):
+        Holding.objects.create(
+            portfolio=self.portfolio,
+            symbol='AAPL',
+            quantity=10,
+            purchase_price=100,
+            purchase_date=timezone.now().date(),
+            current_price=110
+        )
+        with self.assertNumQueries(2):
+            self.portfolio.update_performance()
+        self.assertEqual(self.portfolio.capital_gain, 100)
+
+    def test_bulk_update_performance(self):
+        other_portfolio = Portfolio.objects.create(user=self.user, name="Other Portfolio")
+        empty_portfolio = Portfolio.objects.create(user=self.user, name="Empty Portfolio")
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.portfolio, symbol='AAPL', quantity=10, purchase_price=100,
+                    purchase_date=timezone.now().date(), current_price=110),
+            Holding(portfolio=self.portfolio, symbol='MSFT', quantity=5, purchase_price=20,
+                    purchase_date=timezone.now().date(), current_price=10),
+            Holding(portfolio=other_portfolio, symbol='AAPL', quantity=1, purchase_price=100,
+                    purchase_date=timezone.now().date(), current_price=80),
+        ])
+        with self.assertNumQueries(2):
+            Portfolio.bulk_update_performance([self.portfolio.id, other_portfolio.id, empty_portfolio.id])
+
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, 1150)
+        self.assertEqual(self.portfolio.capital_gain, 50)
+        other_portfolio.refresh_from_db()
+        self.assertEqual(other_portfolio.performance, -20)
+        empty_portfolio.refresh_from_db()
+        self.assertEqual(empty_portfolio.current_value, 0)
+
 
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER)
 class InvestmentTestCase(TestCase):
     def setUp(self):
         self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
@@ -129,3 +201,1744 @@ class MonthlyPerformanceTestCase(TestCase):
         self.assertEqual(updated_monthly_performance.value, 1200)
         self.assertEqual(updated_monthly_performance.performance, 20)
 
+
+class FlakyQuoteProvider(FakeQuoteProvider):
+    def __init__(self, failures=1, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def fetch(self, symbols, timeout=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('provider unavailable')
+        return super().fetch(symbols, timeout)
+
+    async def afetch(self, symbols, timeout=None):
+        return self.fetch(symbols, timeout)
+
+
+class PriceFetcherTestCase(TestCase):
+    def test_fetch_in_batches(self):
+        provider = FakeQuoteProvider(prices={'AAPL': 110})
+        symbols = ['AAPL'] + [f'SYM{i}' for i in range(9)]
+        result = PriceFetcher(provider, batch_size=3, workers=2).fetch(symbols)
+        self.assertEqual(result.batches, 4)
+        self.assertEqual(provider.calls, 4)
+        self.assertEqual(len(result.prices), 10)
+        self.assertEqual(result.prices['AAPL'], Decimal('110.00'))
+        self.assertEqual(result.failed, [])
+
+    def test_missing_symbols_are_reported_as_failed(self):
+        provider = FakeQuoteProvider(missing=['NOPE'])
+        result = PriceFetcher(provider).fetch(['AAPL', 'NOPE'])
+        self.assertEqual(list(result.prices), ['AAPL'])
+        self.assertEqual(result.failed, ['NOPE'])
+
+    def test_failed_batch_is_retried(self):
+        provider = FlakyQuoteProvider(failures=1)
+        with self.assertLogs('portfolio_management.quotes', 'WARNING') as logs:
+            result = PriceFetcher(provider, retries=1, backoff=0).fetch(['AAPL'])
+        self.assertIn('Price fetch failed for AAPL: provider unavailable', logs.output[0])
+        self.assertEqual(result.retries, 1)
+        self.assertIn('AAPL', result.prices)
+
+        provider = FlakyQuoteProvider(failures=5)
+        result = PriceFetcher(provider, retries=1, backoff=0).fetch(['AAPL'])
+        self.assertEqual(result.failed, ['AAPL'])
+
+    def test_slow_batch_times_out(self):
+        provider = FakeQuoteProvider(latency=1)
+        started = time.monotonic()
+        result = PriceFetcher(provider, timeout=0.05, retries=0).fetch(['AAPL'])
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(result.timeouts, 1)
+        self.assertEqual(result.failed, ['AAPL'])
+
+    def test_queued_batches_do_not_time_out(self):
+        # Five rounds of batches at 0.2s each: only the time spent running counts.
+        provider = FakeQuoteProvider(latency=0.2)
+        symbols = [f'SYM{i}' for i in range(10)]
+        result = PriceFetcher(provider, batch_size=1, workers=2, timeout=0.5, retries=0).fetch(symbols)
+        self.assertEqual(result.timeouts, 0)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(len(result.prices), 10)
+
+    def test_progress_is_reported_per_batch(self):
+        reports = []
+        PriceFetcher(FakeQuoteProvider(), batch_size=2).fetch(['A', 'B', 'C'], progress=lambda r: reports.append(r.done))
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[-1], 3)
+
+
+class QuoteProviderLayerTestCase(TestCase):
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        started = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+        with self.assertRaises(ProviderUnavailable):
+            bucket.acquire(timeout=0)
+
+    def test_circuit_opens_after_failures_and_recovers(self):
+        flaky = FlakyQuoteProvider(failures=2)
+        provider = GuardedProvider(flaky, breaker=CircuitBreaker(threshold=2, reset_timeout=0.05))
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                provider.fetch(['AAPL'])
+        self.assertEqual(provider.breaker.state, 'open')
+        with self.assertRaises(ProviderUnavailable):
+            provider.fetch(['AAPL'])
+        self.assertEqual(flaky.calls, 0)
+
+        time.sleep(0.06)
+        self.assertEqual(provider.breaker.state, 'half_open')
+        self.assertIn('AAPL', provider.fetch(['AAPL']))
+        self.assertEqual(provider.breaker.state, 'closed')
+
+    def test_failed_trial_reopens_circuit(self):
+        provider = GuardedProvider(FlakyQuoteProvider(failures=2), breaker=CircuitBreaker(threshold=1, reset_timeout=0.05))
+        with self.assertRaises(ConnectionError):
+            provider.fetch(['AAPL'])
+        time.sleep(0.06)
+        with self.assertRaises(ConnectionError):
+            provider.fetch(['AAPL'])
+        self.assertEqual(provider.breaker.state, 'open')
+
+    def test_empty_yfinance_download_is_a_failure(self):
+        provider = GuardedProvider(YFinanceProvider(), breaker=CircuitBreaker(threshold=2), negative_ttl=60)
+        nan_frame = pd.DataFrame({'Close': [float('nan')]}, index=pd.to_datetime(['2024-01-02']))
+        for frame in (pd.DataFrame(), nan_frame):
+            with mock.patch('portfolio_management.quotes.yf.download', return_value=frame):
+                with self.assertRaises(ProviderError):
+                    provider.fetch(['AAPL'])
+        self.assertEqual(provider.breaker.state, 'open')
+        self.assertNotIn('AAPL', provider.negative)
+
+    def test_unknown_yfinance_symbol_is_not_a_failure(self):
+        provider = GuardedProvider(YFinanceProvider(), breaker=CircuitBreaker(threshold=2), negative_ttl=60)
+        errors = {'NOPE': "YFPricesMissingError('$NOPE: possibly delisted; no price data found')"}
+        with mock.patch('portfolio_management.quotes.yf.download', return_value=pd.DataFrame()) as download, \
+                mock.patch('portfolio_management.quotes.yf.shared._ERRORS', errors):
+            for _ in range(5):
+                self.assertEqual(provider.fetch(['NOPE']), {})
+        self.assertEqual(download.call_count, 1)
+        self.assertEqual(provider.breaker.state, 'closed')
+        self.assertIn('NOPE', provider.negative)
+
+    def test_unknown_symbols_are_cached(self):
+        fake = FakeQuoteProvider(missing=['NOPE'])
+        provider = GuardedProvider(fake, negative_ttl=60)
+        self.assertEqual(list(provider.fetch(['AAPL', 'NOPE'])), ['AAPL'])
+        self.assertEqual(provider.fetch(['NOPE']), {})
+        provider.fetch(['AAPL', 'NOPE'])
+        self.assertEqual(fake.calls, 2)
+
+    def test_failover(self):
+        first = FakeQuoteProvider(prices={'AAPL': 1}, missing=['MSFT'])
+        provider = FailoverProvider([GuardedProvider(FlakyQuoteProvider(failures=1)), first, FakeQuoteProvider(prices={'MSFT': 2})])
+        with self.assertLogs('portfolio_management.quotes', 'WARNING'):
+            prices = provider.fetch(['AAPL', 'MSFT'])
+        self.assertEqual(prices, {'AAPL': Decimal('1.00'), 'MSFT': Decimal('2.00')})
+
+        provider = FailoverProvider([FlakyQuoteProvider(failures=1), FlakyQuoteProvider(failures=1)])
+        with self.assertLogs('portfolio_management.quotes', 'WARNING'), self.assertRaises(ConnectionError):
+            provider.fetch(['AAPL'])
+
+    async def test_async_fetch(self):
+        fake = FakeQuoteProvider(prices={'AAPL': 110}, latency=0.01)
+        provider = FailoverProvider([GuardedProvider(FlakyQuoteProvider(failures=1)), GuardedProvider(fake, TokenBucket(100))])
+        with self.assertLogs('portfolio_management.quotes', 'WARNING'):
+            prices = await asyncio.gather(*(provider.afetch([symbol]) for symbol in ['AAPL', 'MSFT']))
+        self.assertEqual(prices[0], {'AAPL': Decimal('110.00')})
+        self.assertIn('MSFT', prices[1])
+
+    @override_settings(QUOTE_PROVIDER=f'{FAKE_PROVIDER}, portfolio_management.tests.CountingQuoteProvider')
+    def test_configured_failover(self):
+        provider = get_quote_provider()
+        self.assertIsInstance(provider, FailoverProvider)
+        self.assertEqual([str(p) for p in provider.providers], ['FakeQuoteProvider', 'CountingQuoteProvider'])
+
+    def test_current_price_errors_are_logged(self):
+        with mock.patch('portfolio_management.utils.get_quote_provider', return_value=FlakyQuoteProvider()):
+            with self.assertLogs('portfolio_management.utils', 'ERROR'):
+                self.assertIsNone(get_current_price('AAPL'))
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER)
+class UpdateCurrentPriceCommandTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+
+    def test_updates_prices_and_holdings(self):
+        Investment.objects.create(
+            portfolio=self.portfolio,
+            symbol='AAPL',
+            quantity=5,
+            transaction_type='Buy',
+            date=timezone.now().date(),
+            price=100
+        )
+        out = StringIO()
+        call_command('update_current_price', '--batch-size', '10', stdout=out)
+        price = FakeQuoteProvider().quote('AAPL')
+        self.assertEqual(CurrentPrice.objects.get(symbol='AAPL').price, price)
+        self.assertEqual(Holding.objects.get(symbol='AAPL').current_price, price)
+        self.assertIn('Updated 1/1 prices', out.getvalue())
+
+
+class HoldingRevalueTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        self.other_portfolio = Portfolio.objects.create(user=self.user, name="Other Portfolio")
+        for portfolio in (self.portfolio, self.other_portfolio):
+            Holding.objects.create(
+                portfolio=portfolio,
+                symbol='AAPL',
+                quantity=10,
+                purchase_price=100,
+                purchase_date=timezone.now().date(),
+                current_price=100
+            )
+        Holding.objects.create(
+            portfolio=self.portfolio,
+            symbol='MSFT',
+            quantity=2,
+            purchase_price=50,
+            purchase_date=timezone.now().date(),
+            current_price=50
+        )
+
+    def test_revalue_updates_holdings_and_portfolios(self):
+        portfolio_ids = Holding.revalue({'AAPL': Decimal('120'), 'MSFT': Decimal('40')})
+        self.assertEqual(portfolio_ids, {self.portfolio.id, self.other_portfolio.id})
+
+        holding = Holding.objects.get(portfolio=self.portfolio, symbol='AAPL')
+        self.assertEqual(holding.current_price, 120)
+        self.assertEqual(holding.capital_gain, 200)
+        self.assertEqual(holding.performance, 20)
+        holding = Holding.objects.get(portfolio=self.portfolio, symbol='MSFT')
+        self.assertEqual(holding.capital_gain, -20)
+        self.assertEqual(holding.performance, -20)
+
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, 1280)
+        self.assertEqual(self.portfolio.capital_gain, 180)
+
+    def test_revalue_gains_above_a_thousand_percent(self):
+        Holding.revalue({'MSFT': Decimal('2500')})
+        self.assertEqual(Holding.objects.get(portfolio=self.portfolio, symbol='MSFT').performance, 4900)
+
+    def test_revalue_query_count_does_not_grow_with_holdings(self):
+        for day in range(1, 11):
+            Holding.objects.create(
+                portfolio=self.portfolio,
+                symbol='AAPL',
+                quantity=1,
+                purchase_price=90,
+                purchase_date=timezone.now().date().replace(day=day),
+                current_price=100
+            )
+        # Two updates, the touched portfolios, their totals and bulk update,
+        # the version bump and their owners for the dashboard cache.
+        with self.assertNumQueries(7):
+            Holding.revalue({'AAPL': Decimal('120')})
+
+    def test_store_current_prices(self):
+        CurrentPrice.objects.create(symbol='AAPL', price=100)
+        CurrentPrice.store({'AAPL': Decimal('120'), 'MSFT': Decimal('40')})
+        self.assertEqual(CurrentPrice.objects.get(symbol='AAPL').price, 120)
+        self.assertEqual(CurrentPrice.objects.get(symbol='MSFT').price, 40)
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER)
+class DeferredRecomputeTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        Holding.objects.bulk_create(
+            Holding(
+                portfolio=self.portfolio,
+                symbol='AAPL',
+                quantity=2,
+                purchase_price=100,
+                purchase_date=timezone.now().date().replace(day=day),
+                current_price=110
+            )
+            for day in range(1, 6)
+        )
+
+    def sell(self, quantity):
+        return Investment.objects.create(
+            portfolio=self.portfolio,
+            symbol='AAPL',
+            quantity=quantity,
+            transaction_type='Sell',
+            date=timezone.now().date(),
+            price=120
+        )
+
+    def test_sell_across_lots_recomputes_once_on_commit(self):
+        with mock.patch.object(Portfolio, 'bulk_update_performance') as update_performance:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.sell(9)
+                update_performance.assert_not_called()
+        self.assertEqual(update_performance.call_count, 1)
+
+    def test_portfolio_totals_are_current_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sell(3)
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, 770)
+
+    def test_batch_context_recomputes_once_on_exit(self):
+        with mock.patch.object(Portfolio, 'bulk_update_performance') as update_performance:
+            with deferred_portfolio_updates():
+                self.sell(1)
+                self.sell(2)
+                self.sell(3)
+                update_performance.assert_not_called()
+        self.assertEqual(update_performance.call_count, 1)
+
+    def test_rolled_back_changes_are_not_recomputed(self):
+        with mock.patch.object(Portfolio, 'bulk_update_performance') as update_performance:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertRaises(ValidationError):
+                    self.sell(100)
+            self.assertEqual(callbacks, [])
+        update_performance.assert_not_called()
+
+
+@override_settings(QUOTE_PROVIDER='portfolio_management.tests.CountingQuoteProvider')
+class PriceCacheTestCase(TestCase):
+    def setUp(self):
+        price_cache.clear()
+        CountingQuoteProvider.fetched = []
+
+    def tearDown(self):
+        price_cache.clear()
+
+    def test_db_then_local_hit(self):
+        CurrentPrice.objects.create(symbol='AAPL', price=110)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_current_price_for_symbol('AAPL'), 110)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_price_for_symbol('AAPL'), 110)
+        stats = price_cache.stats()
+        self.assertEqual(stats['db_hits'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['hit_ratio'], 1)
+        self.assertEqual(CountingQuoteProvider.fetched, [])
+
+    def test_provider_fetch_is_stored(self):
+        price = get_current_price_for_symbol('MSFT')
+        self.assertEqual(price, FakeQuoteProvider().quote('MSFT'))
+        self.assertEqual(CurrentPrice.objects.get(symbol='MSFT').price, price)
+        self.assertEqual(price_cache.stats()['provider_fetches'], 1)
+        self.assertIsNone(price_cache.get('NOPE', fetch=False))
+        self.assertEqual(CountingQuoteProvider.fetched, ['MSFT'])
+
+    def test_expired_entries_are_reloaded(self):
+        CurrentPrice.objects.create(symbol='AAPL', price=110)
+        with override_settings(PRICE_CACHE_TTL=-1):
+            get_current_price_for_symbol('AAPL')
+            with self.assertNumQueries(1):
+                get_current_price_for_symbol('AAPL')
+
+    @override_settings(PRICE_CACHE_ALIAS='default')
+    def test_shared_cache_hit(self):
+        price_cache.set_many({'AAPL': Decimal('110')})
+        other_process = PriceCache()
+        with self.assertNumQueries(0):
+            self.assertEqual(other_process.get('AAPL'), 110)
+        self.assertEqual(other_process.stats()['shared_hits'], 1)
+
+    @override_settings(PRICE_CACHE_ALIAS='default')
+    def test_fetch_leaves_another_process_lock(self):
+        shared = price_cache.shared
+        lock_key = f'{price_cache.key_prefix}lock:MSFT'
+        shared.add(lock_key, 1, 60)
+        self.addCleanup(shared.delete, lock_key)
+        with mock.patch.object(price_cache, '_wait_for_shared', return_value=None):
+            self.assertIsNotNone(price_cache.get('MSFT'))
+        self.assertEqual(shared.get(lock_key), 1)
+
+    def test_get_many_in_one_query(self):
+        CurrentPrice.store({'AAPL': Decimal('110'), 'MSFT': Decimal('50')})
+        get_current_price_for_symbol('AAPL')
+        with self.assertNumQueries(1):
+            self.assertEqual(price_cache.get_many(['AAPL', 'MSFT', 'NOPE']), {'AAPL': 110, 'MSFT': 50})
+        with self.assertNumQueries(0):
+            self.assertEqual(price_cache.get_many(['AAPL', 'MSFT']), {'AAPL': 110, 'MSFT': 50})
+        self.assertEqual(price_cache.stats()['misses'], 1)
+        self.assertEqual(CountingQuoteProvider.fetched, [])
+
+    def test_concurrent_misses_share_one_lookup(self):
+        calls = []
+
+        def slow_lookup(symbol, fetch):
+            calls.append(symbol)
+            time.sleep(0.1)
+            cache.set_many({symbol: Decimal('110')})
+            return Decimal('110')
+
+        cache = PriceCache()
+        with mock.patch.object(cache, '_lookup', side_effect=slow_lookup):
+            threads = [threading.Thread(target=cache.get, args=('AAPL',)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(calls, ['AAPL'])
+        self.assertEqual(cache.stats()['coalesced'], 7)
+
+
+class CountingQuoteProvider(FakeQuoteProvider):
+    fetched = []
+
+    def fetch(self, symbols, timeout=None):
+        CountingQuoteProvider.fetched.extend(symbols)
+        return super().fetch(symbols, timeout)
+
+
+@override_settings(QUOTE_PROVIDER='portfolio_management.tests.CountingQuoteProvider', BACKGROUND_TASKS_EAGER=True)
+class PriceBackfillTestCase(TestCase):
+    def setUp(self):
+        price_cache.clear()
+        CountingQuoteProvider.fetched = []
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+
+    def buy(self, symbol, quantity=5):
+        return Investment.objects.create(
+            portfolio=self.portfolio,
+            symbol=symbol,
+            quantity=quantity,
+            transaction_type='Buy',
+            date=timezone.now().date(),
+            price=100
+        )
+
+    def test_holding_without_price_is_saved_pending(self):
+        with mock.patch('portfolio_management.models.schedule_price_backfill') as schedule:
+            self.buy('AAPL')
+        holding = Holding.objects.get(symbol='AAPL')
+        self.assertTrue(holding.price_pending)
+        self.assertIsNone(holding.capital_gain)
+        schedule.assert_called_once_with(['AAPL'])
+        self.assertEqual(CountingQuoteProvider.fetched, [])
+
+    def test_known_price_is_used_without_backfill(self):
+        CurrentPrice.objects.create(symbol='AAPL', price=110)
+        with mock.patch('portfolio_management.models.schedule_price_backfill') as schedule:
+            self.buy('AAPL')
+        self.assertEqual(Holding.objects.get(symbol='AAPL').capital_gain, 50)
+        schedule.assert_not_called()
+
+    def test_backfill_runs_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.buy('AAPL')
+            self.buy('MSFT')
+        price = FakeQuoteProvider().quote('AAPL')
+        holding = Holding.objects.get(symbol='AAPL')
+        self.assertEqual(holding.current_price, price)
+        self.assertFalse(holding.price_pending)
+        self.assertEqual(sorted(CountingQuoteProvider.fetched), ['AAPL', 'MSFT'])
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, 5 * price + 5 * FakeQuoteProvider().quote('MSFT'))
+
+    def test_backfill_prices_command(self):
+        with mock.patch('portfolio_management.models.schedule_price_backfill'):
+            self.buy('AAPL')
+        out = StringIO()
+        call_command('backfill_prices', stdout=out)
+        self.assertFalse(Holding.objects.get(symbol='AAPL').price_pending)
+        self.assertIn('Backfilled 1/1 prices', out.getvalue())
+
+    def test_queue_coalesces_symbols_scheduled_while_draining(self):
+        queue = PriceBackfillQueue()
+        batches = []
+
+        def backfill(symbols):
+            batches.append(sorted(symbols))
+            if len(batches) == 1:
+                queue.schedule(['MSFT'])
+                queue.schedule(['GOOG'])
+            return mock.Mock(failed=[])
+
+        with mock.patch('portfolio_management.backfill.backfill_prices', side_effect=backfill):
+            queue.schedule(['AAPL'])
+        self.assertEqual(batches, [['AAPL'], ['GOOG', 'MSFT']])
+
+
+class PortfolioItemsEndpointTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        start = date(2024, 1, 1)
+        Investment.objects.bulk_create(
+            Investment(portfolio=self.portfolio, symbol='AAPL', quantity=1, transaction_type='Buy',
+                       date=start + timedelta(days=i), price=100, currency='USD')
+            for i in range(25)
+        )
+        Holding.objects.bulk_create(
+            Holding(portfolio=self.portfolio, symbol='AAPL', quantity=1, purchase_price=100,
+                    purchase_date=start + timedelta(days=i), current_price=110)
+            for i in range(25)
+        )
+
+    def url(self, name):
+        return reverse(f'investment-{name}', args=[self.portfolio.id])
+
+    def test_unpaginated_list_is_a_single_query(self):
+        # Plus the portfolio version lookup for the ETag.
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url('holdings-by-portfolio'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 25)
+
+    def test_cursor_pagination(self):
+        response = self.client.get(self.url('investments-by-portfolio'), {'page_size': 10})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(response.data['results'][0]['date'], '2024-01-25')
+        seen = [row['id'] for row in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [row['id'] for row in response.data['results']]
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_cursor_pagination_across_equal_dates(self):
+        Investment.objects.bulk_create(
+            Investment(portfolio=self.portfolio, symbol='MSFT', quantity=1, transaction_type='Buy',
+                       date=date(2024, 6, 1), price=100, currency='USD')
+            for _ in range(40)
+        )
+        expected = [str(pk) for pk in Investment.objects.order_by('-date', '-id').values_list('id', flat=True)]
+        response = self.client.get(self.url('investments-by-portfolio'), {'page_size': 7})
+        seen = [row['id'] for row in response.data['results']]
+        while response.data['next']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(response.data['next'])
+            self.assertFalse(any('OFFSET' in query['sql'] for query in queries))
+            seen += [row['id'] for row in response.data['results']]
+        self.assertEqual(seen, expected)
+
+        back = []
+        while response.data['previous']:
+            response = self.client.get(response.data['previous'])
+            back = [row['id'] for row in response.data['results']] + back
+        self.assertEqual(back, expected[:len(back)])
+        self.assertEqual(len(back), 63)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url('investments-by-portfolio'), {'cursor': 'cD1ub3Rqc29u'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_ndjson_stream(self):
+        response = self.client.get(self.url('holdings-by-portfolio'), {'stream': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['purchase_date'], '2024-01-01')
+
+    def test_other_users_portfolio_is_not_listed(self):
+        other = CustomUser.objects.create_user(username="other", password="testpassword")
+        self.client.force_authenticate(other)
+        response = self.client.get(self.url('monthly-performance-by-portfolio'))
+        self.assertEqual(response.data, [])
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class InvestmentImportTestCase(TestCase):
+    def setUp(self):
+        price_cache.clear()
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        CurrentPrice.objects.create(symbol='AAPL', price=150)
+
+    def row(self, transaction_type, quantity, day, price=100, symbol='AAPL'):
+        return {
+            'portfolio': str(self.portfolio.id),
+            'symbol': symbol,
+            'quantity': quantity,
+            'transaction_type': transaction_type,
+            'date': f'2024-01-{day:02d}',
+            'price': price,
+            'currency': 'USD',
+        }
+
+    def lots(self):
+        return list(Holding.objects.filter(portfolio=self.portfolio).order_by('purchase_date').values_list('purchase_date__day', 'quantity'))
+
+    def test_replays_fifo_across_chunks(self):
+        Holding.objects.create(portfolio=self.portfolio, symbol='AAPL', quantity=4, purchase_price=90,
+                               purchase_date=date(2023, 12, 1), current_price=150)
+        rows = [
+            self.row('Buy', 10, 1),
+            self.row('Buy', 5, 1),
+            self.row('Sell', 6, 2),
+            self.row('Buy', 3, 3, price=110),
+            self.row('Sell', 12, 4),
+        ]
+        result = InvestmentImporter(chunk_size=2).run(rows)
+        self.assertEqual(result.errors, [])
+        self.assertEqual((result.rows, result.chunks), (5, 3))
+        self.assertEqual(Investment.objects.filter(portfolio=self.portfolio).count(), 5)
+        self.assertEqual(self.lots(), [(1, 1), (3, 3)])
+        holding = Holding.objects.get(portfolio=self.portfolio, purchase_date=date(2024, 1, 1))
+        self.assertEqual(holding.capital_gain, 50)
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, 600)
+
+    def test_atomic_import_rolls_back_everything(self):
+        rows = [self.row('Buy', 10, 1), self.row('Sell', 20, 2)]
+        result = InvestmentImporter(chunk_size=1).run(rows)
+        self.assertEqual(result.errors, [{'row': 2, 'error': 'Insufficient quantity available in holdings for selling'}])
+        self.assertEqual(result.rows, 0)
+        self.assertFalse(Investment.objects.exists())
+        self.assertFalse(Holding.objects.exists())
+
+    def test_per_chunk_import_keeps_committed_chunks(self):
+        rows = [self.row('Buy', 10, 1), {**self.row('Buy', 1, 2), 'currency': 'GBP'}]
+        result = InvestmentImporter(chunk_size=1, atomic=False).run(rows)
+        self.assertEqual(result.rows, 1)
+        self.assertEqual(result.errors[0]['row'], 2)
+        self.assertEqual(self.lots(), [(1, 10)])
+
+    def test_values_beyond_column_limits_are_row_errors(self):
+        rows = [self.row('Buy', 10, 1, symbol='TOOLONGSYMBOL'), self.row('Buy', 10, 2, price='123456789.99')]
+        result = InvestmentImporter().run(rows)
+        self.assertEqual([error['row'] for error in result.errors], [1, 2])
+        self.assertIn('symbol: Ensure this value has at most 10 characters', result.errors[0]['error'])
+        self.assertIn('price: Ensure that there are no more than 10 digits in total.', result.errors[1]['error'])
+        self.assertFalse(Investment.objects.exists())
+
+    def test_rejected_chunk_leaves_no_positions(self):
+        InvestmentImporter(atomic=False).run([self.row('Buy', 10, 1)])
+        positions = Position.objects.count()
+        rows = [self.row('Buy', 1, 2, symbol='MSFT'), self.row('Sell', 5, 3, symbol='TSLA')]
+        result = InvestmentImporter(atomic=False).run(rows)
+        self.assertEqual(result.errors, [{'row': 2, 'error': 'Insufficient quantity available in holdings for selling'}])
+        self.assertEqual(Position.objects.count(), positions)
+
+    def test_import_endpoint_csv(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        other = Portfolio.objects.create(user=CustomUser.objects.create_user(username="other"), name="Other")
+        body = "portfolio,symbol,quantity,transaction_type,date,price,currency\n"
+        body += f"{self.portfolio.id},AAPL,10,Buy,2024-01-01,100,USD\n"
+        body += f"{self.portfolio.id},MSFT,5,Buy,2024-01-02,50,USD\n"
+        response = client.post(reverse('investment-import-investments'), body, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['imported'], 2)
+        self.assertTrue(Holding.objects.get(symbol='MSFT').price_pending)
+
+        body = f"portfolio,symbol,quantity,transaction_type,date,price,currency\n{other.id},AAPL,1,Buy,2024-01-01,1,USD\n"
+        response = client.post(reverse('investment-import-investments'), body, content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Unknown portfolio', response.data['errors'][0]['error'])
+
+    def test_import_investments_command(self):
+        path = f'/tmp/import-{self.portfolio.id}.ndjson'
+        with open(path, 'w') as f:
+            for row in [self.row('Buy', 10, 1), self.row('Sell', 4, 2)]:
+                f.write(json.dumps(row) + '\n')
+        out = StringIO()
+        call_command('import_investments', path, '--chunk-size', '1', stdout=out)
+        self.assertIn('Imported 2 investments in 2 chunks across 1 portfolios', out.getvalue())
+        self.assertEqual(self.lots(), [(1, 6)])
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER)
+class PortfolioAnalyticsTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        history_backfill.clear()
+
+    def trade(self, transaction_type, symbol, quantity, day, price):
+        Investment.objects.bulk_create([Investment(
+            portfolio=self.portfolio, symbol=symbol, quantity=quantity, transaction_type=transaction_type,
+            date=day, price=price, currency='USD',
+        )])
+
+    def closes(self, rows):
+        frame = pd.DataFrame(rows).set_index('date')
+        frame.index = pd.to_datetime(frame.index)
+        return frame
+
+    def test_returns_with_cash_flows(self):
+        self.trade('Buy', 'AAPL', 10, date(2024, 1, 1), 100)
+        self.trade('Buy', 'AAPL', 10, date(2024, 1, 3), 110)
+        closes = self.closes([
+            {'date': '2024-01-01', 'AAPL': 100},
+            {'date': '2024-01-02', 'AAPL': 110},
+            {'date': '2024-01-03', 'AAPL': 99},
+            {'date': '2024-01-04', 'AAPL': 110},
+        ])
+        result = portfolio_analytics(self.portfolio.id, end=date(2024, 1, 4), closes=closes, series=True)
+        self.assertEqual(result['value'], 2200)
+        # +10%, then -10% on 1100, then +11.11% on the 1980 held: the new money does not count.
+        self.assertAlmostEqual(result['time_weighted_return'], 1.1 * 0.9 * (110 / 99) - 1, places=6)
+        self.assertAlmostEqual(result['max_drawdown'], -0.1, places=6)
+        self.assertGreater(result['money_weighted_return'], 0)
+        self.assertEqual([row['flow'] for row in result['series']], [1000, 0, 1100, 0])
+        self.assertEqual(result['contributions'][0]['pnl'], 2200 - 2100)
+
+    def test_contribution_per_symbol_and_sells(self):
+        self.trade('Buy', 'AAPL', 10, date(2024, 1, 1), 100)
+        self.trade('Buy', 'MSFT', 10, date(2024, 1, 1), 50)
+        self.trade('Sell', 'MSFT', 10, date(2024, 1, 2), 40)
+        closes = self.closes([
+            {'date': '2024-01-01', 'AAPL': 100, 'MSFT': 50},
+            {'date': '2024-01-02', 'AAPL': 120, 'MSFT': 40},
+        ])
+        result = portfolio_analytics(self.portfolio.id, end=date(2024, 1, 2), closes=closes)
+        contributions = {row['symbol']: row for row in result['contributions']}
+        self.assertEqual(contributions['AAPL']['pnl'], 200)
+        self.assertEqual(contributions['MSFT']['pnl'], -100)
+        self.assertAlmostEqual(contributions['AAPL']['contribution'], 200 / 1500, places=6)
+        self.assertAlmostEqual(result['time_weighted_return'], (1200 + 400) / 1500 - 1, places=6)
+
+    def test_ten_years_of_daily_data(self):
+        symbols = [f'SYM{i}' for i in range(20)]
+        days = pd.bdate_range('2014-01-01', '2023-12-31')
+        Investment.objects.bulk_create(
+            Investment(portfolio=self.portfolio, symbol=symbols[i % 20], quantity=1, transaction_type='Buy',
+                       date=day.date(), price=100, currency='USD')
+            for i, day in enumerate(days[::5])
+        )
+        PriceHistory.store(FakeQuoteProvider().history(symbols, days[0].date(), days[-1].date()))
+        # Timed from the stored history, like the endpoint.
+        started = time.monotonic()
+        result = portfolio_analytics(self.portfolio.id, end=days[-1].date(), background=True)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(result['contributions']), 20)
+        self.assertIsNotNone(result['volatility'])
+
+    def test_background_backfill_is_not_repeated(self):
+        self.trade('Buy', 'AAPL', 10, date(2024, 1, 1), 100)
+        with mock.patch('portfolio_management.backfill.run_in_background') as run:
+            for _ in range(3):
+                portfolio_analytics(self.portfolio.id, background=True)
+        self.assertEqual(run.call_count, 1)
+
+    @override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, BACKGROUND_TASKS_EAGER=True)
+    def test_analytics_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = reverse('portfolio-analytics', args=[self.portfolio.id])
+        self.assertEqual(client.get(url).status_code, 404)
+        self.trade('Buy', 'AAPL', 10, date(2024, 1, 1), 100)
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('time_weighted_return', response.data)
+        self.assertTrue(PriceHistory.objects.filter(symbol='AAPL').exists())
+
+        # The downloaded closes bumped the version, so the first ETag is stale.
+        response = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+class HistoryRecordingProvider(FakeQuoteProvider):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def history(self, symbols, start, end, timeout=None):
+        self.requests.append((sorted(symbols), start, end))
+        return super().history(symbols, start, end, timeout)
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER)
+class PriceHistoryTestCase(TestCase):
+    def setUp(self):
+        history_backfill.clear()
+
+    def test_backfill_only_fetches_missing_ranges(self):
+        provider = HistoryRecordingProvider()
+        starts = {'AAPL': date(2024, 1, 1), 'MSFT': date(2024, 1, 1)}
+        result = backfill_price_history(starts, date(2024, 1, 31), provider=provider)
+        self.assertEqual(provider.requests, [(['AAPL', 'MSFT'], date(2024, 1, 1), date(2024, 1, 31))])
+        self.assertEqual(result.rows, 2 * 23)
+        self.assertEqual(PriceHistory.objects.count(), 2 * 23)
+
+        provider.requests.clear()
+        backfill_price_history(starts, date(2024, 1, 31), provider=provider)
+        self.assertEqual(provider.requests, [])
+
+        starts['GOOG'] = date(2024, 1, 15)
+        backfill_price_history(starts, date(2024, 2, 2), provider=provider)
+        self.assertEqual(provider.requests, [
+            (['AAPL', 'MSFT'], date(2024, 2, 1), date(2024, 2, 2)),
+            (['GOOG'], date(2024, 1, 15), date(2024, 2, 2)),
+        ])
+
+    def test_weekend_gap_is_not_refetched(self):
+        provider = HistoryRecordingProvider()
+        backfill_price_history({'AAPL': date(2024, 1, 1)}, date(2024, 1, 5), provider=provider)
+        provider.requests.clear()
+        backfill_price_history({'AAPL': date(2024, 1, 1)}, date(2024, 1, 7), provider=provider)
+        self.assertEqual(provider.requests, [])
+
+    def test_empty_ranges_are_not_refetched(self):
+        provider = HistoryRecordingProvider()
+        provider.missing = {'NOPE'}
+        starts = {'AAPL': date(2024, 1, 1), 'NOPE': date(2024, 1, 1)}
+        backfill_price_history(starts, date(2024, 1, 31), provider=provider)
+        provider.requests.clear()
+        backfill_price_history(starts, date(2024, 1, 31), provider=provider)
+        self.assertEqual(provider.requests, [])
+
+    def test_backfill_stops_before_today(self):
+        provider = HistoryRecordingProvider()
+        today = date.today()
+        backfill_price_history({'AAPL': today - timedelta(days=10)}, today, provider=provider)
+        self.assertEqual(provider.requests, [(['AAPL'], today - timedelta(days=10), today - timedelta(days=1))])
+        self.assertLess(PriceHistory.objects.latest('date').date, today)
+
+    def test_closes_match_provider(self):
+        provider = FakeQuoteProvider()
+        backfill_price_history({'AAPL': date(2024, 1, 1)}, date(2024, 3, 29), provider=provider)
+        closes = PriceHistory.closes(['AAPL'], date(2024, 2, 1), date(2024, 2, 29))
+        bars = provider.history(['AAPL'], date(2024, 2, 1), date(2024, 2, 29))
+        self.assertEqual(list(closes.index), list(bars['date']))
+        self.assertEqual(list(closes['AAPL']), list(bars['close']))
+
+    def test_command_starts_at_first_trade(self):
+        user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        portfolio = Portfolio.objects.create(user=user, name="Test Portfolio")
+        Investment.objects.bulk_create([
+            Investment(portfolio=portfolio, symbol='AAPL', quantity=1, transaction_type='Buy',
+                       date=date(2024, 1, 8), price=100, currency='USD'),
+        ])
+        out = StringIO()
+        call_command('backfill_price_history', '--end', '2024-01-12', stdout=out)
+        self.assertEqual(PriceHistory.objects.filter(symbol='AAPL').count(), 5)
+        self.assertIn('Stored 5 bars for 1 symbols', out.getvalue())
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER)
+class MonthlyPerformanceBackfillTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        self.other_portfolio = Portfolio.objects.create(user=self.user, name="Other Portfolio")
+        Investment.objects.bulk_create([
+            Investment(portfolio=self.portfolio, symbol='AAPL', quantity=10, transaction_type='Buy',
+                       date=date(2024, 1, 10), price=100, currency='USD'),
+            Investment(portfolio=self.portfolio, symbol='AAPL', quantity=10, transaction_type='Buy',
+                       date=date(2024, 2, 5), price=120, currency='USD'),
+            Investment(portfolio=self.portfolio, symbol='AAPL', quantity=15, transaction_type='Sell',
+                       date=date(2024, 3, 5), price=130, currency='USD'),
+            Investment(portfolio=self.other_portfolio, symbol='AAPL', quantity=1, transaction_type='Buy',
+                       date=date(2024, 3, 1), price=150, currency='USD'),
+        ])
+        PriceHistory.objects.bulk_create(
+            PriceHistory(symbol='AAPL', date=day, close=close)
+            for day, close in [
+                (date(2024, 1, 10), 100), (date(2024, 1, 31), 110), (date(2024, 2, 29), 125),
+                (date(2024, 3, 28), 140), (date(2024, 4, 15), 140),
+            ]
+        )
+
+    def months(self, portfolio):
+        return [
+            (row.year, row.month, row.value, row.capital_gain, row.performance)
+            for row in MonthlyPerformance.objects.filter(portfolio=portfolio, year=2024).order_by('month')
+        ]
+
+    def test_backfill_replays_history_with_fifo_cost(self):
+        MonthlyPerformance.objects.create(portfolio=self.portfolio, month=1, year=2024)
+        out = StringIO()
+        call_command('save_monthly_performance', '--backfill', '--end', '2024-04-15', stdout=out)
+        self.assertIn('Backfilled 6 monthly performance rows', out.getvalue())
+        self.assertEqual(self.months(self.portfolio), [
+            (2024, 1, Decimal('1100'), Decimal('100'), Decimal('10')),
+            (2024, 2, Decimal('2500'), Decimal('300'), Decimal('13.64')),
+            # 10 shares at 100 and 5 at 120 were sold, 5 at 120 remain.
+            (2024, 3, Decimal('700'), Decimal('100'), Decimal('16.67')),
+            (2024, 4, Decimal('700'), Decimal('100'), Decimal('16.67')),
+        ])
+        self.assertEqual(self.months(self.other_portfolio), [
+            (2024, 3, Decimal('140'), Decimal('-10'), Decimal('-6.67')),
+            (2024, 4, Decimal('140'), Decimal('-10'), Decimal('-6.67')),
+        ])
+
+    def test_backfill_in_batches(self):
+        with mock.patch.object(MonthlyPerformance, 'store', side_effect=MonthlyPerformance.store) as store:
+            self.assertEqual(backfill_monthly_performance(end=date(2024, 4, 15), batch_size=1), 6)
+        self.assertEqual(store.call_count, 2)
+        self.assertEqual(len(self.months(self.portfolio)), 4)
+        self.assertEqual(self.months(self.other_portfolio), [
+            (2024, 3, Decimal('140'), Decimal('-10'), Decimal('-6.67')),
+            (2024, 4, Decimal('140'), Decimal('-10'), Decimal('-6.67')),
+        ])
+
+    def test_backfill_is_idempotent(self):
+        backfill_monthly_performance(end=date(2024, 4, 15))
+        count = MonthlyPerformance.objects.count()
+        self.assertEqual(backfill_monthly_performance(end=date(2024, 4, 15)), 6)
+        self.assertEqual(MonthlyPerformance.objects.count(), count)
+
+
+class MonthlySnapshotTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolios = [Portfolio.objects.create(user=self.user, name=f"Portfolio {i}") for i in range(5)]
+        Holding.objects.bulk_create([
+            Holding(portfolio=portfolio, symbol='AAPL', quantity=i + 1, purchase_price=100,
+                    purchase_date=date(2024, 1, 1), current_price=110)
+            for i, portfolio in enumerate(self.portfolios)
+        ])
+        self.today = date.today()
+
+    def test_command_upserts_in_batches(self):
+        out = StringIO()
+        # The signal already created this month's zero rows; they get overwritten.
+        call_command('save_monthly_performance', '--batch-size', '2', stdout=out)
+        self.assertIn('saved for 5 portfolios in 3 batches across 1 workers', out.getvalue())
+        rows = MonthlyPerformance.objects.filter(month=self.today.month, year=self.today.year)
+        self.assertEqual(rows.count(), 5)
+        row = rows.get(portfolio=self.portfolios[2])
+        self.assertEqual((row.value, row.capital_gain, row.performance), (330, 30, 10))
+
+    def test_snapshot_queries_per_batch(self):
+        # Stream, totals, bulk_update of the recomputed portfolios, the
+        # version bump, the users whose dashboards to drop and one upsert.
+        with self.assertNumQueries(6):
+            MonthlyPerformance.snapshot(self.today.month, self.today.year, batch_size=10)
+
+    def test_shards_cover_every_portfolio_once(self):
+        counts = [MonthlyPerformance.snapshot(1, 2000, 10, shard, 3)[0] for shard in range(3)]
+        self.assertEqual(sum(counts), 5)
+        self.assertEqual(MonthlyPerformance.objects.filter(month=1, year=2000).count(), 5)
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class PositionTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+
+    def trade(self, transaction_type, quantity, day, price, symbol='AAPL'):
+        return Investment.objects.create(
+            portfolio=self.portfolio, symbol=symbol, quantity=quantity, transaction_type=transaction_type,
+            date=day, price=price, currency='USD',
+        )
+
+    def position(self, symbol='AAPL'):
+        return Position.objects.filter(portfolio=self.portfolio, symbol=symbol).first()
+
+    def test_position_follows_buys_and_fifo_sells(self):
+        self.trade('Buy', 10, date(2024, 1, 1), 100)
+        self.trade('Buy', 10, date(2024, 2, 1), 120)
+        self.trade('Buy', 5, date(2024, 2, 1), 120)
+        self.assertEqual(Holding.objects.get(portfolio=self.portfolio, purchase_date=date(2024, 2, 1)).quantity, 15)
+        self.assertEqual((self.position().quantity, self.position().cost_basis), (25, 2800))
+
+        self.trade('Sell', 12, date(2024, 3, 1), 130)
+        self.assertEqual(list(Holding.objects.filter(portfolio=self.portfolio).values_list('quantity', flat=True)), [13])
+        self.assertEqual((self.position().quantity, self.position().cost_basis), (13, 1560))
+        self.assertEqual(self.position().average_cost, 120)
+
+        self.trade('Sell', 13, date(2024, 3, 2), 130)
+        self.assertIsNone(self.position())
+        self.assertFalse(Holding.objects.filter(portfolio=self.portfolio).exists())
+
+    def test_insufficient_quantity(self):
+        self.trade('Buy', 10, date(2024, 1, 1), 100)
+        with self.assertRaises(ValidationError):
+            self.trade('Sell', 11, date(2024, 3, 1), 130)
+        with self.assertRaises(ValidationError):
+            self.trade('Sell', 1, date(2024, 3, 1), 130, symbol='MSFT')
+        self.assertEqual(self.position().quantity, 10)
+
+    def test_sell_queries_do_not_grow_with_lots(self):
+        def sell_queries(lots, symbol):
+            Holding.objects.bulk_create(
+                Holding(portfolio=self.portfolio, symbol=symbol, quantity=1, purchase_price=100,
+                        purchase_date=date(2024, 1, 1) + timedelta(days=i), current_price=100)
+                for i in range(lots)
+            )
+            Position.rebuild(self.portfolio.id, symbol)
+            with CaptureQueriesContext(connection) as queries:
+                Holding.update_quantity(self.portfolio, symbol, -3)
+            return len(queries)
+
+        self.assertEqual(sell_queries(5, 'AAPL'), sell_queries(200, 'MSFT'))
+        self.assertEqual(self.position('MSFT').quantity, 197)
+        self.assertEqual(Holding.objects.filter(symbol='MSFT').order_by('purchase_date').first().purchase_date, date(2024, 1, 4))
+
+    def test_rebuilds_position_for_lots_written_directly(self):
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.portfolio, symbol='AAPL', quantity=10, purchase_price=100,
+                    purchase_date=date(2024, 1, 1), current_price=100),
+        ])
+        self.trade('Sell', 4, date(2024, 3, 1), 130)
+        self.assertEqual((self.position().quantity, self.position().cost_basis), (6, 600))
+
+    def test_sell_not_covered_by_lots(self):
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.portfolio, symbol='AAPL', quantity=10, purchase_price=100,
+                    purchase_date=date(2024, 1, 1), current_price=100),
+        ])
+        Position.objects.create(portfolio=self.portfolio, symbol='AAPL', quantity=20, cost_basis=2000)
+        with self.assertRaises(ValidationError):
+            self.trade('Sell', 15, date(2024, 3, 1), 130)
+        self.assertEqual(Holding.objects.get(portfolio=self.portfolio).quantity, 10)
+        self.assertFalse(Investment.objects.exists())
+
+    def test_lot_edits_and_deletes_keep_position(self):
+        self.trade('Buy', 10, date(2024, 1, 1), 100)
+        self.trade('Buy', 5, date(2024, 2, 1), 120)
+        first, second = Holding.objects.filter(portfolio=self.portfolio).order_by('purchase_date')
+        first.quantity = 8
+        first.save()
+        self.assertEqual((self.position().quantity, self.position().cost_basis), (13, 1400))
+
+        second.symbol = 'MSFT'
+        second.save()
+        self.assertEqual((self.position().quantity, self.position().cost_basis), (8, 800))
+        self.assertEqual((self.position('MSFT').quantity, self.position('MSFT').cost_basis), (5, 600))
+
+        second.delete()
+        self.assertIsNone(self.position('MSFT'))
+        HoldingAdmin(Holding, admin.site).delete_queryset(None, Holding.objects.filter(portfolio=self.portfolio))
+        self.assertIsNone(self.position())
+
+    def test_import_stores_positions(self):
+        self.trade('Buy', 10, date(2024, 1, 1), 100)
+        InvestmentImporter(user=self.user).run([
+            {'portfolio': self.portfolio.id, 'symbol': 'AAPL', 'quantity': 4, 'transaction_type': 'Sell',
+             'date': '2024-02-01', 'price': 120, 'currency': 'USD'},
+            {'portfolio': self.portfolio.id, 'symbol': 'MSFT', 'quantity': 2, 'transaction_type': 'Buy',
+             'date': '2024-02-01', 'price': 50, 'currency': 'USD'},
+        ])
+        self.assertEqual((self.position().quantity, self.position().cost_basis), (6, 600))
+        self.assertEqual((self.position('MSFT').quantity, self.position('MSFT').cost_basis), (2, 100))
+
+    def test_positions_endpoint(self):
+        self.trade('Buy', 10, date(2024, 1, 1), 100)
+        CurrentPrice.objects.create(symbol='AAPL', price=110)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(reverse('investment-positions-by-portfolio', args=[self.portfolio.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        row = response.data[0]
+        self.assertEqual(
+            (row['symbol'], row['quantity'], row['cost_basis'], row['average_cost'], row['market_value'], row['capital_gain']),
+            ('AAPL', 10, '1000.00', '100.00', '1100.00', '100.00'),
+        )
+
+
+@skipUnlessDBFeature('has_select_for_update')
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class ConcurrentTradingTestCase(TransactionTestCase):
+    threads = 16
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolios = [Portfolio.objects.create(user=self.user, name=f"Portfolio {i}") for i in range(4)]
+
+    def run_concurrently(self, trades):
+        errors = []
+        barrier = threading.Barrier(len(trades))
+
+        def run(trade):
+            barrier.wait()
+            try:
+                Investment.objects.create(date=date(2024, 1, 1), currency='USD', **trade)
+            except ValidationError:
+                errors.append(trade)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(trade,)) for trade in trades]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_sells_never_oversell(self):
+        portfolio = self.portfolios[0]
+        for price in (100, 110):
+            Investment.objects.create(portfolio=portfolio, symbol='AAPL', quantity=10, transaction_type='Buy',
+                                      date=date(2024, 1, 1), price=price, currency='USD')
+        errors = self.run_concurrently([
+            {'portfolio': portfolio, 'symbol': 'AAPL', 'quantity': 1, 'transaction_type': 'Sell', 'price': 120}
+            for _ in range(30)
+        ])
+        self.assertEqual(len(errors), 10)
+        self.assertFalse(Holding.objects.filter(portfolio=portfolio).exists())
+        self.assertFalse(Position.objects.filter(portfolio=portfolio).exists())
+        self.assertEqual(Investment.objects.filter(portfolio=portfolio, transaction_type='Sell').count(), 20)
+
+    def test_import_and_trades_on_new_positions(self):
+        portfolio = self.portfolios[0]
+        symbols = [f'SYM{i}' for i in range(20)]
+        barrier = threading.Barrier(2)
+
+        def run(work):
+            barrier.wait()
+            try:
+                work()
+            finally:
+                connection.close()
+
+        def import_rows():
+            InvestmentImporter().run(
+                {'portfolio': str(portfolio.id), 'symbol': symbol, 'quantity': 1, 'transaction_type': 'Buy',
+                 'date': '2024-01-01', 'price': '100', 'currency': 'USD'}
+                for symbol in symbols
+            )
+
+        def trade():
+            for symbol in reversed(symbols):
+                Investment.objects.create(portfolio=portfolio, symbol=symbol, quantity=1, transaction_type='Buy',
+                                          date=date(2024, 1, 2), price=100, currency='USD')
+
+        threads = [threading.Thread(target=run, args=(work,)) for work in (import_rows, trade)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for symbol in symbols:
+            self.assertEqual(Holding.objects.filter(portfolio=portfolio, symbol=symbol).aggregate(total=Sum('quantity'))['total'], 2)
+            self.assertEqual(Position.objects.get(portfolio=portfolio, symbol=symbol).quantity, 2)
+
+    def test_concurrent_buys_share_one_lot(self):
+        errors = self.run_concurrently([
+            {'portfolio': portfolio, 'symbol': 'AAPL', 'quantity': 1, 'transaction_type': 'Buy', 'price': 100}
+            for portfolio in self.portfolios
+            for _ in range(self.threads // len(self.portfolios))
+        ])
+        self.assertEqual(errors, [])
+        for portfolio in self.portfolios:
+            self.assertEqual(
+                list(Holding.objects.filter(portfolio=portfolio).values_list('quantity', flat=True)),
+                [self.threads // len(self.portfolios)],
+            )
+            self.assertEqual(Position.objects.get(portfolio=portfolio).quantity, self.threads // len(self.portfolios))
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class DashboardTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.other_user = CustomUser.objects.create_user(username="otheruser", password="testpassword")
+        self.portfolios = [Portfolio.objects.create(user=self.user, name=f"Portfolio {i}") for i in range(3)]
+        Portfolio.objects.create(user=self.other_user, name="Other Portfolio")
+        CurrentPrice.store({'AAPL': Decimal('110'), 'MSFT': Decimal('50')})
+        for portfolio in self.portfolios:
+            for symbol in ('AAPL', 'MSFT'):
+                Investment.objects.create(portfolio=portfolio, symbol=symbol, quantity=2, transaction_type='Buy',
+                                          date=date(2024, 1, 1), price=100, currency='USD')
+        dashboard_cache().clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('dashboard')
+
+    def test_dashboard_in_one_request(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        portfolios = response.data['portfolios']
+        self.assertEqual([portfolio['name'] for portfolio in portfolios], ['Portfolio 0', 'Portfolio 1', 'Portfolio 2'])
+        self.assertEqual([position['symbol'] for position in portfolios[0]['positions']], ['AAPL', 'MSFT'])
+        self.assertEqual(portfolios[0]['positions'][0]['market_value'], '220.00')
+        self.assertEqual(len(portfolios[0]['monthly_performance']), 1)
+        self.assertEqual(response.data['positions'], [
+            {'symbol': 'AAPL', 'quantity': 6, 'cost_basis': '600.00', 'market_value': '660.00'},
+            {'symbol': 'MSFT', 'quantity': 6, 'cost_basis': '600.00', 'market_value': '300.00'},
+        ])
+
+    def test_query_count_does_not_grow_with_portfolios(self):
+        with self.assertNumQueries(3):
+            build_dashboard(self.user)
+        Portfolio.objects.create(user=self.user, name="Portfolio 3")
+        with self.assertNumQueries(3):
+            build_dashboard(self.user)
+
+    def test_served_from_cache_until_invalidated(self):
+        self.client.get(self.url)
+        # Only the version lookup for the ETag.
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data['portfolios']), 3)
+
+        with deferred_portfolio_updates():
+            Investment.objects.create(portfolio=self.portfolios[0], symbol='AAPL', quantity=1, transaction_type='Sell',
+                                      date=date(2024, 2, 1), price=120, currency='USD')
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['portfolios'][0]['positions'][0]['quantity'], 1)
+
+        Holding.revalue({'MSFT': Decimal('60')})
+        CurrentPrice.store({'MSFT': Decimal('60')})
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['positions'][1]['market_value'], '360.00')
+
+    def test_monthly_snapshot_invalidates_cache(self):
+        self.client.get(self.url)
+        call_command('save_monthly_performance', stdout=StringIO())
+        today = date.today()
+        row = MonthlyPerformance.objects.get(portfolio=self.portfolios[0], month=today.month, year=today.year)
+        self.assertNotEqual(row.value, 0)
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['portfolios'][0]['monthly_performance'][-1]['value'], str(row.value))
+
+    def test_other_users_cache_is_kept(self):
+        other_client = APIClient()
+        other_client.force_authenticate(self.other_user)
+        other_client.get(self.url)
+        invalidate_portfolio_dashboards([portfolio.id for portfolio in self.portfolios])
+        with self.assertNumQueries(1):
+            response = other_client.get(self.url)
+        self.assertEqual(len(response.data['portfolios']), 1)
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class ConditionalRequestTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_not_modified_without_touching_holdings(self):
+        url = reverse('investment-holdings-by-portfolio', args=[self.portfolio.id])
+        response = self.client.get(url)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('holding', queries[0]['sql'])
+
+    def test_version_bumps_on_trades_and_revaluation(self):
+        urls = [
+            reverse('portfolio-list'),
+            reverse('portfolio-detail', args=[self.portfolio.id]),
+            reverse('investment-positions-by-portfolio', args=[self.portfolio.id]),
+            reverse('dashboard'),
+        ]
+        etags = {url: self.client.get(url)['ETag'] for url in urls}
+
+        with deferred_portfolio_updates():
+            Investment.objects.create(portfolio=self.portfolio, symbol='AAPL', quantity=1, transaction_type='Buy',
+                                      date=date(2024, 1, 1), price=100, currency='USD')
+        for url in urls:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 200)
+            etags[url] = self.client.get(url)['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 304)
+
+        Holding.revalue({'AAPL': Decimal('120')})
+        for url in urls:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 200)
+
+    def test_investment_delete_bumps_version(self):
+        with deferred_portfolio_updates():
+            investment = Investment.objects.create(portfolio=self.portfolio, symbol='AAPL', quantity=1, transaction_type='Buy',
+                                                   date=date(2024, 1, 1), price=100, currency='USD')
+        url = reverse('investment-investments-by-portfolio', args=[self.portfolio.id])
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse('investment-detail', args=[investment.id]))
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+
+    def test_rename_bumps_version(self):
+        url = reverse('portfolio-detail', args=[self.portfolio.id])
+        etag = self.client.get(url)['ETag']
+        self.client.patch(url, {'name': 'Renamed'})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_if_modified_since(self):
+        url = reverse('portfolio-detail', args=[self.portfolio.id])
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+
+@override_settings(QUOTE_PROVIDER='portfolio_management.tests.CountingQuoteProvider', BACKGROUND_TASKS_EAGER=True)
+class PriceRefreshJobTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        Investment.objects.bulk_create([
+            Investment(portfolio=self.portfolio, symbol=symbol, quantity=1, transaction_type='Buy',
+                       date=date(2024, 1, 1), price=100, currency='USD')
+            for symbol in ('AAPL', 'MSFT')
+        ])
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.portfolio, symbol='AAPL', quantity=1, purchase_price=100,
+                    purchase_date=date(2024, 1, 1), current_price=100),
+        ])
+        CountingQuoteProvider.fetched = []
+        price_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_requires_authentication(self):
+        client = APIClient()
+        self.assertEqual(client.post(reverse('update-current-prices')).status_code, 401)
+        self.assertEqual(client.get(reverse('price-refresh-job', args=[uuid.uuid4()])).status_code, 401)
+        self.assertFalse(PriceRefreshJob.objects.exists())
+
+    def test_post_enqueues_and_status_reports_result(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('update-current-prices'))
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.data['created'])
+        self.assertEqual(response.data['status'], PriceRefreshJob.QUEUED)
+        # Nothing was fetched inside the request.
+        self.assertEqual(CountingQuoteProvider.fetched, [])
+
+        for callback in callbacks:
+            callback()
+        status = self.client.get(response.data['url']).data
+        self.assertEqual(status['status'], PriceRefreshJob.SUCCEEDED)
+        self.assertEqual((status['total'], status['done'], status['updated'], status['portfolios']), (2, 2, 2, 1))
+        self.assertEqual(status['failed_symbols'], [])
+        self.assertIsNotNone(status['duration'])
+        self.assertEqual(sorted(CountingQuoteProvider.fetched), ['AAPL', 'MSFT'])
+        self.assertIsNotNone(Holding.objects.get(symbol='AAPL').capital_gain)
+
+    def test_concurrent_posts_share_the_active_job(self):
+        first = self.client.post(reverse('update-current-prices')).data
+        second = self.client.post(reverse('update-current-prices')).data
+        self.assertEqual(first['id'], second['id'])
+        self.assertFalse(second['created'])
+        self.assertEqual(PriceRefreshJob.objects.count(), 1)
+
+        PriceRefreshJob.run(first['id'])
+        third = self.client.post(reverse('update-current-prices')).data
+        self.assertTrue(third['created'])
+        self.assertNotEqual(third['id'], first['id'])
+
+    def test_abandoned_job_does_not_block(self):
+        job, _ = PriceRefreshJob.enqueue()
+        PriceRefreshJob.objects.filter(id=job.id).update(created_at=timezone.now() - timedelta(days=1))
+        new_job, created = PriceRefreshJob.enqueue()
+        self.assertTrue(created)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (PriceRefreshJob.FAILED, 'Abandoned'))
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get(reverse('price-refresh-job', args=[uuid.uuid4()])).status_code, 404)
+
+
+class PriceStreamTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.other_user = CustomUser.objects.create_user(username="otheruser", password="testpassword")
+        self.portfolios = [Portfolio.objects.create(user=self.user, name=f"Portfolio {i}") for i in range(2)]
+        other_portfolio = Portfolio.objects.create(user=self.other_user, name="Other Portfolio")
+        Holding.objects.bulk_create([
+            Holding(portfolio=self.portfolios[0], symbol='AAPL', quantity=10, purchase_price=100,
+                    purchase_date=date(2024, 1, 1), current_price=100),
+            Holding(portfolio=self.portfolios[1], symbol='AAPL', quantity=1, purchase_price=100,
+                    purchase_date=date(2024, 1, 1), current_price=100),
+            Holding(portfolio=self.portfolios[1], symbol='MSFT', quantity=1, purchase_price=50,
+                    purchase_date=date(2024, 1, 1), current_price=50),
+            Holding(portfolio=other_portfolio, symbol='MSFT', quantity=1, purchase_price=50,
+                    purchase_date=date(2024, 1, 1), current_price=50),
+        ])
+        Portfolio.bulk_update_performance()
+        self.layer = get_channel_layer()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def subscribe(self, user):
+        subscription = self.layer.subscribe(user_group(user.id), loop=self.loop)
+        self.addCleanup(self.layer.unsubscribe, subscription)
+        return subscription
+
+    def receive(self, subscription):
+        return self.loop.run_until_complete(asyncio.wait_for(subscription.get(), 1))
+
+    def test_one_batched_message_per_affected_user(self):
+        subscription = self.subscribe(self.user)
+        other_subscription = self.subscribe(self.other_user)
+        with self.captureOnCommitCallbacks(execute=True):
+            store_prices({'AAPL': Decimal('120')})
+
+        message = self.receive(subscription)
+        self.assertEqual(message['prices'], {'AAPL': Decimal('120')})
+        changes = {row['id']: row['change'] for row in message['portfolios']}
+        self.assertEqual(changes, {self.portfolios[0].id: 200, self.portfolios[1].id: 20})
+        self.assertTrue(subscription.queue.empty())
+        self.assertTrue(other_subscription.queue.empty())
+
+    def test_no_listeners_no_extra_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            store_prices({'AAPL': Decimal('120')})
+        self.assertFalse(any('"current_value"' in query['sql'] and 'DISTINCT' in query['sql'] for query in queries))
+
+    def test_requires_authentication(self):
+        self.assertEqual(self.client.get(reverse('price-stream')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('price-stream'), {'token': 'bad'}).status_code, 401)
+
+    def test_requires_asgi(self):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        response = self.client.get(reverse('price-stream'), headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 501)
+
+    async def test_streams_events(self):
+        token = str(RefreshToken.for_user(self.user).access_token)
+        response = await self.async_client.get(reverse('price-stream'), headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        self.assertEqual(await anext(events), b': connected\n\n')
+        self.assertEqual(self.layer.groups(), {user_group(self.user.id)})
+
+        self.layer.group_send_many({user_group(self.user.id): {'type': 'prices', 'prices': {'AAPL': Decimal('120')}}})
+        event = await asyncio.wait_for(anext(events), 1)
+        self.assertEqual(event, b'event: prices\ndata: {"type": "prices", "prices": {"AAPL": "120"}}\n\n')
+        # A client disconnect cancels the task reading the stream.
+        reader = asyncio.ensure_future(anext(events))
+        await asyncio.sleep(0)
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        self.assertEqual(self.layer.groups(), set())
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False, PORTFOLIO_BASE_CURRENCY='USD')
+class FxValuationTestCase(TestCase):
+    def setUp(self):
+        fx_cache.clear()
+        self.addCleanup(fx_cache.clear)
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        FxRate.store({'EUR': Decimal('1.00')}, 'USD', date(2024, 1, 2))
+        FxRate.store({'EUR': Decimal('1.10')}, 'USD', date(2024, 6, 3))
+        for symbol, currency in [('AAPL', 'USD'), ('SAP', 'EUR')]:
+            Investment.objects.create(
+                portfolio=self.portfolio, symbol=symbol, quantity=10, transaction_type='Buy',
+                date=date(2024, 1, 2), price=100, currency=currency,
+            )
+        Holding.revalue({'AAPL': Decimal('110'), 'SAP': Decimal('120')})
+
+    def test_totals_are_converted_to_base_currency(self):
+        self.portfolio.refresh_from_db()
+        # 10 x 110 USD plus 10 x 120 EUR at today's 1.10, bought at 1.00.
+        self.assertEqual(self.portfolio.current_value, Decimal('2420.00'))
+        self.assertEqual(self.portfolio.capital_gain, Decimal('420.00'))
+        self.assertEqual(Holding.objects.get(symbol='SAP').purchase_fx_rate, Decimal('1.00'))
+
+        with override_settings(PORTFOLIO_BASE_CURRENCY=None):
+            Portfolio.bulk_update_performance([self.portfolio.id])
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, Decimal('2300.00'))
+
+    def test_currency_without_rate_is_not_converted(self):
+        Investment.objects.create(
+            portfolio=self.portfolio, symbol='SHOP', quantity=10, transaction_type='Buy',
+            date=date(2024, 1, 2), price=100, currency='CAD',
+        )
+        fx_cache.clear()
+        with self.assertLogs('portfolio_management.fx', 'WARNING') as logs:
+            Holding.revalue({'SHOP': Decimal('130')})
+        self.assertIn('No USD exchange rates stored for CAD', logs.output[0])
+        self.portfolio.refresh_from_db()
+        # The CAD lot counts in its own amount instead of dropping out.
+        self.assertEqual(self.portfolio.current_value, Decimal('3720.00'))
+        self.assertEqual(self.portfolio.capital_gain, Decimal('720.00'))
+
+    def test_rates_are_cached(self):
+        with self.assertNumQueries(0):
+            conversion()
+            self.assertEqual(fx_cache.rate_on('EUR', date(2024, 1, 2)), Decimal('1.00'))
+        fx_cache.clear()
+        with self.assertNumQueries(1):
+            conversion()
+            conversion()
+
+    def test_new_rates_revalue_portfolios(self):
+        provider = FakeQuoteProvider(prices={'EURUSD=X': '1.20'}, missing=['CADUSD=X'])
+        with self.assertLogs('portfolio_management.fx', 'WARNING'):
+            missing = refresh_fx_rates(['USD', 'EUR', 'CAD'], provider=provider)
+        self.assertEqual(missing, ['CAD'])
+        self.portfolio.refresh_from_db()
+        self.assertEqual(self.portfolio.current_value, Decimal('2540.00'))
+
+    def test_analytics_use_historical_rates(self):
+        closes = pd.DataFrame(
+            {'AAPL': [100, 110], 'SAP': [100, 120]},
+            index=pd.to_datetime(['2024-01-02', '2024-06-03']),
+        )
+        result = portfolio_analytics(self.portfolio.id, end=date(2024, 6, 3), closes=closes)
+        self.assertAlmostEqual(result['value'], 2420)
+
+    def test_update_fx_rates_command(self):
+        out = StringIO()
+        call_command('update_fx_rates', stdout=out)
+        self.assertIn('Updated 1 USD exchange rates', out.getvalue())
+        self.assertEqual(FxRate.objects.get(date=date.today()).rate, FakeQuoteProvider().quote('EURUSD=X'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        sticky_cache().clear()
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica']) as replica:
+            self.response = self.client.get(url)
+        self.assertEqual(self.response.status_code, 200)
+        return len(primary), len(replica)
+
+    def test_reads_go_to_replica(self):
+        for url in [reverse('portfolio-list'), reverse('investment-holdings-by-portfolio', args=[self.portfolio.id])]:
+            primary, replica = self.get(url)
+            self.assertEqual(primary, 0)
+            self.assertGreater(replica, 0)
+        self.assertEqual(self.get(reverse('portfolio-list'))[1], 2)
+        self.assertEqual([portfolio['name'] for portfolio in self.response.json()], ["Test Portfolio"])
+
+    def test_user_reads_own_writes_from_primary(self):
+        response = self.client.post(reverse('investment-list'), {
+            'portfolio': self.portfolio.id, 'symbol': 'AAPL', 'quantity': 5, 'transaction_type': 'Buy',
+            'date': '2024-01-01', 'price': '100.00', 'currency': 'USD',
+        })
+        self.assertEqual(response.status_code, 201)
+        primary, replica = self.get(reverse('portfolio-list'))
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+        other = CustomUser.objects.create_user(username="otheruser", password="testpassword")
+        self.client.force_authenticate(other)
+        self.assertEqual(self.get(reverse('portfolio-list'))[0], 0)
+
+    def test_router_keeps_transactions_and_writes_on_primary(self):
+        router = ReplicaRouter()
+        with replica_routing() as routing:
+            routing.replica = 'replica'
+            self.assertEqual(router.db_for_read(Portfolio), 'replica')
+            with transaction.atomic():
+                self.assertIsNone(router.db_for_read(Portfolio))
+            self.assertIsNone(router.db_for_write(Portfolio))
+            self.assertIsNone(router.db_for_read(Portfolio))
+        self.assertIsNone(router.db_for_read(Portfolio))
+
+
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.portfolio = Portfolio.objects.create(user=self.user, name="Test Portfolio")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        metrics.clear()
+
+    def test_profile_counts_queries_and_provider_calls(self):
+        provider = GuardedProvider(FakeQuoteProvider())
+        with profile() as outer:
+            Portfolio.objects.count()
+            with profile() as inner:
+                list(Holding.objects.all())
+                provider.fetch(['AAPL'])
+            # Batches fetched on the pool's threads still count.
+            PriceFetcher(provider, batch_size=1, workers=2).fetch(['MSFT', 'GOOG'])
+        self.assertEqual((inner.sql_count, inner.provider_calls), (1, 1))
+        self.assertEqual((outer.sql_count, outer.provider_calls), (2, 3))
+        self.assertGreater(outer.latency, 0)
+        with profile() as idle:
+            pass
+        self.assertEqual(idle.as_dict()['sql_count'], 0)
+
+    @override_settings(PROFILING_ENABLED=True)
+    def test_requests_are_reported(self):
+        with self.assertLogs('core.profiling', 'INFO') as logs:
+            response = self.client.get(reverse('portfolio-list'))
+        self.assertEqual(response['X-SQL-Queries'], '2')
+        self.assertEqual(response['X-Provider-Calls'], '0')
+        self.assertIn('sql;dur=', response['Server-Timing'])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['status'], line['sql_count']), ('portfolio-list', 200, 2))
+
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_request_sql_queries_bucket{view="portfolio-list",method="GET",status="200",le="2"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{view="portfolio-list",method="GET",status="200"} 1', body)
+
+    @override_settings(PROFILING_ENABLED=True, PROFILING_METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_disabled_by_default(self):
+        response = self.client.get(reverse('portfolio-list'))
+        self.assertNotIn('X-SQL-Queries', response)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+
+class SyntheticDataTestCase(TestCase):
+    def test_generate(self):
+        CurrentPrice.store({'SYNA': Decimal('50')})
+        PriceHistory.objects.create(symbol='SYNA', date=date(2024, 1, 2), close=50)
+        data = generate(users=2, portfolios=4, trades=300, symbols=20, sell_ratio=0.5, seed=1, prefix='synth')
+        self.assertEqual((len(data.users), len(data.portfolios), data.trades), (2, 4, 300))
+        self.assertEqual(Portfolio.objects.filter(user__username__startswith='synth-').count(), 4)
+        self.assertTrue(Investment.objects.filter(transaction_type='Sell').exists())
+        self.assertFalse(Position.objects.filter(quantity__lt=0).exists())
+        self.assertFalse(Holding.objects.filter(current_price__isnull=True).exists())
+        # Zipf: the first symbols take most of the trades.
+        counts = Counter(Investment.objects.values_list('symbol', flat=True))
+        self.assertGreater(counts['SYN0000'], counts['SYN0019'])
+
+        delete_synthetic('synth')
+        self.assertFalse(Portfolio.objects.exists())
+        # Real tickers sharing the prefix are kept.
+        self.assertEqual(list(CurrentPrice.objects.values_list('symbol', flat=True)), ['SYNA'])
+        self.assertEqual(list(PriceHistory.objects.values_list('symbol', flat=True)), ['SYNA'])
+
+    def test_benchmark_command(self):
+        user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        portfolio = Portfolio.objects.create(user=user, name="Real Portfolio")
+        out = StringIO()
+        scenarios = ['buy', 'sell', 'price_refresh', 'monthly_snapshot', 'holdings']
+        call_command(
+            'benchmark', users=1, portfolios=2, trades=100, symbols=5, iterations=2, runs=1,
+            scenario=scenarios, stdout=out,
+        )
+        lines = out.getvalue().splitlines()
+        for scenario in scenarios:
+            self.assertTrue(any(line.startswith(scenario) for line in lines), scenario)
+        self.assertEqual(list(Portfolio.objects.all()), [portfolio])
+        # The snapshot left the real portfolio alone.
+        self.assertEqual(Portfolio.objects.get().version, portfolio.version)
+
+
+@override_settings(QUOTE_PROVIDER=FAKE_PROVIDER, PRICE_BACKFILL_ENABLED=False)
+class QueryBudgetTestCase(TestCase):
+    """Pins the queries of the hot paths as a function of input size.
+
+    Each budget runs at several sizes, so a query per lot, holding or row
+    fails the test even when the smallest case stays within budget.
+    """
+    SIZES = [1, 10, 50]
+
+    def setUp(self):
+        price_cache.clear()
+        dashboard_cache().clear()
+        self.user = CustomUser.objects.create_user(username="testuser", password="testpassword")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        CurrentPrice.store({'AAPL': Decimal('110')})
+
+    def assertQueryBudget(self, budget, prepare):
+        """``prepare(n)`` builds an input of size n and returns the operation to measure."""
+        for n in self.SIZES:
+            # Each size starts from cold caches and is rolled back afterwards,
+            # together with the commit callbacks it registered.
+            price_cache.clear()
+            dashboard_cache().clear()
+            with self.subTest(n=n), transaction.atomic():
+                operation = prepare(n)
+                # Commit callbacks count too: they recompute the portfolio.
+                with self.assertNumQueries(budget(n)), self.captureOnCommitCallbacks(execute=True):
+                    operation()
+                transaction.set_rollback(True)
+
+    def portfolio_with_lots(self, n, symbol='AAPL'):
+        portfolio = Portfolio.objects.create(user=self.user, name=f"Portfolio {n}")
+        Holding.objects.bulk_create(
+            Holding(portfolio=portfolio, symbol=symbol, quantity=3, purchase_price=100,
+                    purchase_date=date(2024, 1, 1) + timedelta(days=i), current_price=110)
+            for i in range(n)
+        )
+        Investment.objects.bulk_create(
+            Investment(portfolio=portfolio, symbol=symbol, quantity=3, transaction_type='Buy',
+                       date=date(2024, 1, 1) + timedelta(days=i), price=100, currency='USD')
+            for i in range(n)
+        )
+        MonthlyPerformance.objects.bulk_create(
+            MonthlyPerformance(portfolio=portfolio, value=100, capital_gain=10, performance=10,
+                               month=i % 12 + 1, year=2000 + i // 12)
+            for i in range(n)
+        )
+        Position.rebuild(portfolio.id, symbol)
+        return portfolio
+
+    def trade(self, portfolio, transaction_type, quantity, day=date(2024, 6, 1), price=120):
+        return lambda: Investment(
+            portfolio=portfolio, symbol='AAPL', quantity=quantity, transaction_type=transaction_type,
+            date=day, price=price, currency='USD',
+        ).save()
+
+    def test_buy_new_lot(self):
+        # Position lock, lot lookup, price, insert and position update, the
+        # investment, then the portfolio recompute; savepoints included.
+        self.assertQueryBudget(lambda n: 15, lambda n: self.trade(self.portfolio_with_lots(n), 'Buy', 5))
+
+    def test_buy_into_existing_lot(self):
+        self.assertQueryBudget(lambda n: 13, lambda n: self.trade(self.portfolio_with_lots(n), 'Buy', 5, date(2024, 1, 1), price=100))
+
+    def test_sell_across_lots(self):
+        # Empties n lots and partly sells one more: one delete and one update at any size.
+        self.assertQueryBudget(lambda n: 16, lambda n: self.trade(self.portfolio_with_lots(n + 1), 'Sell', 3 * n + 1))
+
+    def test_create_investment_endpoint(self):
+        def prepare(n):
+            portfolio = self.portfolio_with_lots(n)
+            return lambda: self.client.post(reverse('investment-list'), {
+                'portfolio': portfolio.id, 'symbol': 'AAPL', 'quantity': 1, 'transaction_type': 'Sell',
+                'date': '2024-06-01', 'price': 120, 'currency': 'USD',
+            })
+        # A sell plus the portfolio lookup for validation.
+        self.assertQueryBudget(lambda n: 16, prepare)
+
+    def test_list_portfolios(self):
+        def prepare(n):
+            Portfolio.objects.bulk_create(Portfolio(user=self.user, name=f"Listed {n}-{i}") for i in range(n))
+            return lambda: self.client.get(reverse('portfolio-list'))
+        # The version lookup for the ETag and the list.
+        self.assertQueryBudget(lambda n: 2, prepare)
+
+    def test_portfolio_item_endpoints(self):
+        for name in ['holdings', 'positions', 'investments', 'monthly-performance']:
+            def prepare(n):
+                url = reverse(f'investment-{name}-by-portfolio', args=[self.portfolio_with_lots(n).id])
+                return lambda: self.client.get(url)
+            with self.subTest(name):
+                self.assertQueryBudget(lambda n: 2, prepare)
+
+    def test_list_and_retrieve_investments(self):
+        def prepare(n):
+            investment = Investment.objects.filter(portfolio=self.portfolio_with_lots(n)).first()
+            return lambda: (self.client.get(reverse('investment-list')),
+                            self.client.get(reverse('investment-detail', args=[investment.id])))
+        self.assertQueryBudget(lambda n: 2, prepare)
+
+    def test_import(self):
+        def prepare(n):
+            portfolio = Portfolio.objects.create(user=self.user, name=f"Imported {n}")
+            rows = [
+                {'portfolio': str(portfolio.id), 'symbol': f'SYM{i}', 'quantity': 2, 'transaction_type': 'Buy',
+                 'date': f'2024-01-{i % 28 + 1:02d}', 'price': 100, 'currency': 'USD'}
+                for i in range(n)
+            ]
+            return lambda: self.client.post(reverse('investment-import-investments'), rows, format='json')
+        # One chunk of n rows on n symbols: positions are created, locked and
+        # prices loaded together.
+        self.assertQueryBudget(lambda n: 16, prepare)
+
+    def test_revalue_symbol(self):
+        def prepare(n):
+            for _ in range(n):
+                self.portfolio_with_lots(3, symbol='MSFT')
+            return lambda: Holding.revalue({'MSFT': Decimal('120')})
+        self.assertQueryBudget(lambda n: 7, prepare)
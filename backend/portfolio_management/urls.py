@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import PortfolioViewSet, InvestmentViewSet, update_current_prices
+from .views import PortfolioViewSet, InvestmentViewSet, update_current_prices, price_refresh_job, price_cache_stats, dashboard, price_stream
 
 router = DefaultRouter()
 router.register(r'portfolios', PortfolioViewSet, basename='portfolio')
@@ -9,5 +9,9 @@ router.register(r'investments', InvestmentViewSet)
 urlpatterns = [
     path('', include(router.urls)),
     path('investments/<uuid:pk>/investments_by_portfolio/', InvestmentViewSet.as_view({'get': 'investments_by_portfolio'}), name='investments-by-portfolio'),
+    path('dashboard/', dashboard, name='dashboard'),
+    path('price_stream/', price_stream, name='price-stream'),
     path('update_current_prices/', update_current_prices, name='update-current-prices'),
+    path('update_current_prices/<uuid:pk>/', price_refresh_job, name='price-refresh-job'),
+    path('price_cache_stats/', price_cache_stats, name='price-cache-stats'),
 ]
\ No newline at end of file
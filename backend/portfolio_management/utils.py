@@ -1,12 +1,26 @@
-import yfinance as yf
+import logging
+
+from .quotes import ProviderUnavailable, get_quote_provider
+
+
+logger = logging.getLogger(__name__)
 
 
 def get_current_price(symbol):
     try:
-        stock = yf.Ticker(symbol)
-        current_price = stock.history(period='1d')['Close'].iloc[-1]
-        return current_price
-    except Exception as e:
-        print(f"Error fetching current price for symbol {symbol}: {e}")
-        return None
-    
+        return get_quote_provider().fetch([symbol]).get(symbol)
+    except ProviderUnavailable as e:
+        logger.warning("Skipped fetching current price for symbol %s: %s", symbol, e)
+    except Exception:
+        logger.exception("Error fetching current price for symbol %s", symbol)
+    return None
+
+
+async def aget_current_price(symbol):
+    try:
+        return (await get_quote_provider().afetch([symbol])).get(symbol)
+    except ProviderUnavailable as e:
+        logger.warning("Skipped fetching current price for symbol %s: %s", symbol, e)
+    except Exception:
+        logger.exception("Error fetching current price for symbol %s", symbol)
+    return None
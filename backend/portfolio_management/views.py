@@ -1,49 +1,206 @@
-from rest_framework import viewsets
+import asyncio
+from io import BytesIO
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework import viewsets, status
+from core.db_routers import ReplicaReadsMixin
 from rest_framework.decorators import action, permission_classes, api_view
-from django.core.management import call_command
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
-from .models import Portfolio, Holding, Investment, MonthlyPerformance
-from .serializers import PortfolioSerializer, HoldingSerializer, InvestmentSerializer, MonthlyPerformanceSerializer
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from .models import Portfolio, Holding, Investment, MonthlyPerformance, PriceRefreshJob
+from .price_cache import price_cache
+from .analytics import portfolio_analytics
+from .conditional import conditional_on_portfolios, portfolio_condition
+from .dashboard import get_dashboard, positions_with_prices
+from .streaming import get_channel_layer, sse_event, user_group
+from .importer import InvestmentImporter, IMPORT_CHUNK_SIZE, read_rows
+from .pagination import HoldingCursorPagination, InvestmentCursorPagination, MonthlyPerformanceCursorPagination, PositionCursorPagination, ndjson_response
+from .serializers import PortfolioSerializer, HoldingSerializer, InvestmentSerializer, MonthlyPerformanceSerializer, PositionSerializer, PriceRefreshJobSerializer
 
 @permission_classes([IsAuthenticated])
-class PortfolioViewSet(viewsets.ModelViewSet):
+class PortfolioViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     serializer_class = PortfolioSerializer
     basename = 'portfolio'
     def get_queryset(self):
         user = self.request.user
         return Portfolio.objects.filter(user=user)
+
+    @conditional_on_portfolios
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_on_portfolios
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @action(detail=True, methods=['get'])
+    @conditional_on_portfolios
+    def analytics(self, request, pk=None):
+        portfolio = self.get_object()
+        # Never wait on the quote provider here; missing closes are downloaded in the background.
+        result = portfolio_analytics(portfolio.id, series=request.query_params.get('series') == '1', background=True)
+        if result is None:
+            return Response({'error': 'Portfolio has no investments'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(result)
     
 @permission_classes([IsAuthenticated])
-class InvestmentViewSet(viewsets.ModelViewSet):
+class InvestmentViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     queryset = Investment.objects.all()
     serializer_class = InvestmentSerializer
 
+    IMPORT_FORMATS = {
+        'text/csv': 'csv',
+        'application/x-ndjson': 'ndjson',
+        'application/json': 'json',
+    }
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_investments(self, request):
+        format = self.IMPORT_FORMATS.get(request.content_type.split(';')[0].strip())
+        if format is None:
+            return Response(
+                {'error': f"Send text/csv, application/x-ndjson or application/json, not {request.content_type}"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+        try:
+            chunk_size = int(request.query_params.get('chunk_size', IMPORT_CHUNK_SIZE))
+        except ValueError:
+            return Response({'error': 'chunk_size must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        importer = InvestmentImporter(
+            user=request.user,
+            chunk_size=chunk_size,
+            atomic=request.query_params.get('mode', 'atomic') != 'chunk',
+        )
+        # Read the body straight from the stream rather than through request.data.
+        result = importer.run(read_rows(request.stream or BytesIO(), format))
+        return Response(
+            {
+                'imported': result.rows,
+                'chunks': result.chunks,
+                'portfolios': len(result.portfolio_ids),
+                'errors': result.errors,
+            },
+            status=status.HTTP_400_BAD_REQUEST if result.errors else status.HTTP_201_CREATED,
+        )
+
+    def portfolio_items(self, request, queryset, serializer_class, pagination_class):
+        queryset = queryset.filter(portfolio__user=request.user).order_by(*pagination_class.ordering)
+
+        if request.query_params.get('stream') == 'ndjson':
+            return ndjson_response(queryset, serializer_class)
+
+        paginator = pagination_class()
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            return paginator.get_paginated_response(serializer_class(page, many=True).data)
+
+        serializer = serializer_class(queryset, many=True)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['get'])
+    @conditional_on_portfolios
     def holdings_by_portfolio(self, request, pk=None):
-        portfolio = Portfolio.objects.get(pk=pk)
-        holdings = Holding.objects.filter(portfolio=portfolio)
-        serializer = HoldingSerializer(holdings, many=True)
-        return Response(serializer.data)
-    
+        holdings = Holding.objects.filter(portfolio_id=pk).only(
+            'id', 'symbol', 'currency', 'quantity', 'purchase_price', 'purchase_date', 'current_price', 'performance', 'capital_gain'
+        )
+        return self.portfolio_items(request, holdings, HoldingSerializer, HoldingCursorPagination)
+
+    @action(detail=True, methods=['get'])
+    @conditional_on_portfolios
+    def positions_by_portfolio(self, request, pk=None):
+        positions = positions_with_prices().filter(portfolio_id=pk)
+        return self.portfolio_items(request, positions, PositionSerializer, PositionCursorPagination)
+
     @action(detail=True, methods=['get'])
+    @conditional_on_portfolios
     def investments_by_portfolio(self, request, pk=None):
-        portfolio = Portfolio.objects.get(pk=pk)
-        investments = Investment.objects.filter(portfolio=portfolio)
-        serializer = InvestmentSerializer(investments, many=True)
-        return Response(serializer.data)
-    
+        investments = Investment.objects.filter(portfolio_id=pk).only(
+            'id', 'symbol', 'quantity', 'transaction_type', 'date', 'price', 'currency'
+        )
+        return self.portfolio_items(request, investments, InvestmentSerializer, InvestmentCursorPagination)
+
     @action(detail=True, methods=['get'])
+    @conditional_on_portfolios
     def monthly_performance_by_portfolio(self, request, pk=None):
-        portfolio = Portfolio.objects.get(pk=pk)
-        monthly_performance = MonthlyPerformance.objects.filter(portfolio=portfolio)
-        serializer = MonthlyPerformanceSerializer(monthly_performance, many=True)
-        return Response(serializer.data)
+        monthly_performance = MonthlyPerformance.objects.filter(portfolio_id=pk).only(
+            'id', 'portfolio_id', 'value', 'capital_gain', 'performance', 'month', 'year'
+        )
+        return self.portfolio_items(request, monthly_performance, MonthlyPerformanceSerializer, MonthlyPerformanceCursorPagination)
 
 @api_view(['POST'])
+@permission_classes([IsAuthenticated])
 def update_current_prices(request):
+    job, created = PriceRefreshJob.enqueue()
+    data = PriceRefreshJobSerializer(job).data
+    data['created'] = created
+    data['url'] = reverse('price-refresh-job', args=[job.id])
+    return Response(data, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def price_refresh_job(request, pk):
+    return Response(PriceRefreshJobSerializer(get_object_or_404(PriceRefreshJob, pk=pk)).data)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@portfolio_condition
+def dashboard(request):
+    return Response(get_dashboard(request.user))
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def price_cache_stats(request):
+    return Response(price_cache.stats())
+
+def stream_user(request):
+    # EventSource cannot send headers, so the access token may also come as ?token=.
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else request.GET.get('token')
+    if not raw_token:
+        return None
     try:
-        call_command('update_current_price') 
-        return Response({'success': True})
-    except Exception as e:
-        return Response({'success': False, 'error': str(e)}, status=500)
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+@require_GET
+async def price_stream(request):
+    """Server-Sent Events with the price changes and portfolio value deltas of the user's portfolios."""
+    user = await sync_to_async(stream_user)(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    if not isinstance(request, ASGIRequest):
+        # A WSGI server would buffer the never-ending stream and hang the worker.
+        return JsonResponse({'detail': 'The price stream needs an ASGI server.'}, status=501)
+
+    layer = get_channel_layer()
+    subscription = layer.subscribe(user_group(user.pk))
+    keepalive = getattr(settings, 'PRICE_STREAM_KEEPALIVE', 15)
+
+    async def events():
+        try:
+            yield ': connected\n\n'
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                else:
+                    yield sse_event(message)
+        finally:
+            layer.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,10 +1,15 @@
 import axios from "axios";
 import Button from "./Button";
+import { getCookie } from "../utils/getCookie";
 
 function UpdateCurrentPrice() {
   const handleButtonClick = () => {
     axios
-      .post("http://127.0.0.1:8000/api/portfolio/update_current_prices/")
+      .post("http://127.0.0.1:8000/api/portfolio/update_current_prices/", null, {
+        headers: {
+          Authorization: `Bearer ${getCookie("_auth")}`,
+        },
+      })
       .then((response) => {
         console.log(response.data);
       })